@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import subprocess
+import tempfile
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from nbf import NbfArray, DRAM_REGION_START
+from nbf import OPCODE_FENCE, OPCODE_WRITE_4, OPCODE_WRITE_8
+from host import HostApp, parse_window_size
+
+# bits on the line per byte: start, 8 data, stop
+LINE_BITS_PER_BYTE = 10
+
+# benchmark result format, bumped when fields change meaning
+BENCHMARK_SCHEMA_VERSION = 1
+
+def synthetic_image(size_bytes: int) -> NbfArray:
+    """
+    A program that writes "size_bytes" of DRAM in 8-byte stores, fenced at the end, like the
+    bulk of a real program image.
+    """
+    words = max(1, size_bytes // 8)
+    addresses = DRAM_REGION_START + 8 * np.arange(words, dtype=np.uint64)
+    data = np.arange(words, dtype=np.uint64) * np.uint64(0x9e3779b97f4a7c15)
+    stores = NbfArray.from_values(OPCODE_WRITE_8, addresses, data)
+    fence = NbfArray.from_values(OPCODE_FENCE, 0, 0)
+    return NbfArray(np.concatenate([stores.records, fence.records]))
+
+def load_image(spec: str) -> Tuple[str, NbfArray]:
+    """
+    Resolves an image given as an nbf file path, a binary image path, or "synthetic:<MB>".
+    """
+    if spec.startswith('synthetic:'):
+        megabytes = float(spec.split(':', 1)[1])
+        return spec, synthetic_image(int(megabytes * 1024 * 1024))
+    return os.path.basename(spec), NbfArray.from_file(spec)
+
+def payload_bytes(program: NbfArray) -> int:
+    """
+    Bytes of memory written by a program's stores.
+    """
+    opcodes = program.opcodes
+    return int(8 * np.count_nonzero(opcodes == OPCODE_WRITE_8) + 4 * np.count_nonzero(opcodes == OPCODE_WRITE_4))
+
+def percentile_ms(samples, q: float) -> Optional[float]:
+    if len(samples) == 0:
+        return None
+    return float(np.percentile(np.frombuffer(samples, dtype=np.float64), q) * 1000)
+
+class EmulatorProcess:
+    """
+    Runs emulator.py in its own process, so its work does not count towards the host's CPU time.
+    """
+    def __init__(self, baud: int, extra_args: List[str]):
+        self._directory = tempfile.TemporaryDirectory()
+        self.port_name = os.path.join(self._directory.name, 'fpga')
+        emulator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emulator.py')
+        self._process = subprocess.Popen(
+            [sys.executable, emulator, '--baud', str(baud), '--link', self.port_name] + extra_args,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+        )
+        banner = self._process.stdout.readline()
+        if not banner.startswith('Emulating'):
+            self.close()
+            raise RuntimeError(f"emulator failed to start: {banner.strip()}")
+
+    def close(self):
+        self._process.terminate()
+        self._process.wait()
+        self._directory.cleanup()
+
+class InProcessEmulator:
+    """
+    Runs the emulator on a thread behind a memory port, so that no operating system I/O is
+    measured. Its work does count towards the host's CPU time.
+    """
+    def __init__(self, baud: int, extra_args: List[str]):
+        from emulator import FpgaHostEmulator, _argument_parser, _config_from_args
+        config = _config_from_args(_argument_parser().parse_args(['--baud', str(baud)] + extra_args))
+        self._emulator = FpgaHostEmulator(config, device='memory')
+        self._emulator.start()
+        self.port_name = self._emulator.port_name
+
+    def close(self):
+        self._emulator.stop()
+
+def _run_operation(app: HostApp, operation: str, program: Optional[NbfArray], window: Optional[int], write_responses: bool, words: int) -> int:
+    """
+    Runs one operation and returns the payload bytes it moved.
+    """
+    if operation == 'load':
+        app.run_engine(lambda engine: engine.load(program, ignore_unfreezes=True, sliding_window_num_commands=window, write_responses=write_responses))
+        return payload_bytes(program)
+    elif operation == 'verify':
+        app.run_engine(lambda engine: engine.verify(program, window))
+        return 8 * int(np.count_nonzero(program.opcode_mask(OPCODE_WRITE_8) & program.dram_mask()))
+    elif operation == 'test':
+        app.test_memory(sliding_window_num_commands=window, write_responses=write_responses, words=words)
+        return 2 * 8 * words
+    raise ValueError(f"unknown operation '{operation}'")
+
+def run_benchmark(port_name: str, baud: int, operation: str, image_name: Optional[str], program: Optional[NbfArray], window: Optional[int], write_responses: bool, words: int, timeout: float) -> Dict[str, Any]:
+    app = HostApp(serial_port_name=port_name, serial_port_baud=baud, timeout=timeout)
+    try:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        payload = _run_operation(app, operation, program, window, write_responses, words)
+        cpu_seconds = time.process_time() - cpu_start
+        elapsed = time.perf_counter() - wall_start
+    finally:
+        app.close_port()
+
+    line_bytes = app.transmit.bytes_written
+    return {
+        'operation': operation,
+        'image': image_name,
+        'words': words if operation == 'test' else None,
+        'baud': baud,
+        'window': 'auto' if window is None else window,
+        'final_window': app.window.size if window is None else window,
+        'write_responses': write_responses,
+        'commands_sent': app.commands_sent,
+        'commands_received': app.commands_received,
+        'reply_violations': app.reply_violations,
+        'elapsed_seconds': elapsed,
+        'cpu_seconds': cpu_seconds,
+        'commands_per_second': app.commands_sent / elapsed,
+        'payload_bytes_per_second': payload / elapsed,
+        'link_utilization': line_bytes * LINE_BITS_PER_BYTE / baud / elapsed,
+        'reply_latency_p50_ms': percentile_ms(app.reply_latencies, 50),
+        'reply_latency_p99_ms': percentile_ms(app.reply_latencies, 99),
+        # where the time went; see metrics.METRICS_PHASES
+        'seconds': dict(app.metrics.seconds),
+    }
+
+def benchmark_matrix(args) -> Iterator[Dict[str, Any]]:
+    images = [load_image(spec) for spec in args.images]
+    for baud in args.bauds:
+        emulator_class = InProcessEmulator if args.emulator_device == 'memory' else EmulatorProcess
+        emulator = None if args.port else emulator_class(baud, args.emulator_args)
+        port_name = args.port or emulator.port_name
+        try:
+            for (image_name, program), write_responses, window in itertools.product(images, args.write_responses, args.windows):
+                for operation in ('load', 'verify'):
+                    if operation in args.operations:
+                        yield run_benchmark(port_name, baud, operation, image_name, program, window, write_responses, args.words, args.timeout)
+            if 'test' in args.operations:
+                for write_responses, window in itertools.product(args.write_responses, args.windows):
+                    yield run_benchmark(port_name, baud, 'test', None, None, window, write_responses, args.words, args.timeout)
+        finally:
+            if emulator is not None:
+                emulator.close()
+
+def _format_result(result: Dict[str, Any]) -> str:
+    subject = result['image'] if result['operation'] != 'test' else f"{result['words']} words"
+    latency = "n/a" if result['reply_latency_p50_ms'] is None else f"{result['reply_latency_p50_ms']:.2f}/{result['reply_latency_p99_ms']:.2f} ms"
+    return (f"{result['operation']:<6} {subject:<20} baud {result['baud']:<8} window {str(result['window']):<5} "
+            f"wr_resp {int(result['write_responses'])}  {result['commands_per_second']:>9.0f} cmd/s "
+            f"{result['payload_bytes_per_second']:>9.0f} B/s  link {result['link_utilization']:6.1%}  "
+            f"cpu {result['cpu_seconds']:6.2f} s  p50/p99 {latency}")
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(',')]
+
+def _window_list(value: str) -> List[Optional[int]]:
+    return [parse_window_size(v) for v in value.split(',')]
+
+def _bool_list(value: str) -> List[bool]:
+    return [v.strip().lower() in ('1', 'on', 'true', 'yes') for v in value.split(',')]
+
+if __name__ == "__main__":
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Benchmark host.py load, verify and test across a matrix of settings, against emulator.py or a board")
+    parser.add_argument('-p', '--port', dest='port', type=str, default=None, help='Benchmark a board on this serial port instead of the emulator')
+    parser.add_argument('--bauds', type=_int_list, default=[1000000], dest='bauds', help='Comma-separated baud rates')
+    parser.add_argument('--windows', type=_window_list, default=[None, 16, 256], dest='windows', help='Comma-separated window sizes, or "auto"')
+    parser.add_argument('--write-responses', type=_bool_list, default=[False, True], dest='write_responses', help='Comma-separated write response settings (on/off)')
+    parser.add_argument('--images', type=lambda v: v.split(','), dest='images', help='Comma-separated nbf files, binary images, or synthetic:<MB>',
+                        default=[os.path.join(repository, 'nbf', 'hello_world.nbf'), os.path.join(repository, 'nbf', 'cache_hammer.nbf'), 'synthetic:1'])
+    parser.add_argument('--operations', type=lambda v: v.split(','), default=['load', 'verify', 'test'], dest='operations', help='Comma-separated subset of load, verify, test')
+    parser.add_argument('--words', type=int, default=8192, dest='words', help='Words written and read by each memory test')
+    parser.add_argument('-t', '--timeout', dest='timeout', type=float, default=3.0, help='Timeout in seconds')
+    parser.add_argument('--emulator-args', type=str, default='', dest='emulator_args', help='Extra arguments for emulator.py, e.g. "--latency-us 50"')
+    parser.add_argument('--emulator-device', choices=['pty', 'memory'], default='pty', dest='emulator_device', help='Connect to the emulator through a pty in another process, or a memory pipe in this one')
+    parser.add_argument('-o', '--output', type=str, default=None, dest='output', help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    args.emulator_args = args.emulator_args.split()
+
+    if args.port and len(args.bauds) > 1:
+        parser.error("a board runs at a single baud rate")
+
+    results = []
+    for result in benchmark_matrix(args):
+        print(_format_result(result), file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'schema_version': BENCHMARK_SCHEMA_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': args.port or 'emulator',
+        'emulator_args': args.emulator_args,
+        'emulator_device': None if args.port else args.emulator_device,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
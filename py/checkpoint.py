@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import time
+import hashlib
+from typing import Optional
+
+from nbf import NbfArray
+
+# commands streamed between the fences a load adds to confirm its progress
+DEFAULT_CHECKPOINT_COMMANDS = 1 << 16
+
+# DRAM words read back before a resumed load trusts the board to still hold what was loaded
+DEFAULT_RESUME_VERIFY_WORDS = 64
+
+CHECKPOINT_VERSION = 1
+
+def default_checkpoint_directory() -> str:
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'arty-parrot', 'checkpoints')
+
+def program_digest(program: NbfArray) -> str:
+    return hashlib.blake2b(program.wire.data, digest_size=16).hexdigest()
+
+class LoadCheckpoint:
+    """
+    How far a load of a program onto a board is known to have got, kept on disk per board so
+    that a load that fails part way can be resumed instead of started over.
+
+    The position is the number of leading commands of the program that the board has
+    executed, as confirmed by the reply to a fence sent after them. It only moves forward while
+    every reply of the load has been as expected, and it is saved each time it does, so a
+    checkpoint never claims more than the board is known to hold.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.digest: Optional[str] = None
+        self.commands = 0
+        self.position = 0
+        self.saved_time: Optional[float] = None
+
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            if stored.get('version') == CHECKPOINT_VERSION:
+                self.digest = stored['digest']
+                self.commands = stored['commands']
+                self.position = stored['position']
+                self.saved_time = stored['saved_time']
+
+    @staticmethod
+    def for_board(board_id: str, directory: Optional[str] = None) -> 'LoadCheckpoint':
+        """
+        Opens the checkpoint of a board, identified by its port name or another stable id.
+        """
+        directory = directory or default_checkpoint_directory()
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', board_id).strip('_') or 'board'
+        return LoadCheckpoint(os.path.join(directory, name + '.json'))
+
+    def resume_position(self, digest: str, commands: int) -> int:
+        """
+        Returns the number of commands of the given program that need not be sent again, which
+        is zero unless the checkpoint is of the same program.
+        """
+        if self.digest != digest or self.commands != commands:
+            return 0
+        return self.position
+
+    def start(self, digest: str, commands: int, position: int = 0):
+        self.digest = digest
+        self.commands = commands
+        self.position = position
+        self.save()
+
+    def advance(self, position: int):
+        if position > self.position:
+            self.position = position
+            self.save()
+
+    def clear(self):
+        self.digest = None
+        self.commands = 0
+        self.position = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = self.path + '.tmp'
+        self.saved_time = time.time()
+        with open(temporary, 'w') as f:
+            json.dump({
+                'version': CHECKPOINT_VERSION,
+                'digest': self.digest,
+                'commands': self.commands,
+                'position': self.position,
+                'saved_time': self.saved_time,
+            }, f)
+            f.flush()
+            # the checkpoint has to survive whatever interrupts the load
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+if __name__ == '__main__':
+    import tempfile
+    import unittest
+
+    class TestLoadCheckpoint(unittest.TestCase):
+        def test_round_trip(self):
+            program = NbfArray.dram_writes(range(16))
+            digest = program_digest(program)
+            self.assertNotEqual(digest, program_digest(NbfArray.dram_writes(range(1, 17))))
+
+            with tempfile.TemporaryDirectory() as directory:
+                checkpoint = LoadCheckpoint.for_board('/dev/ttyUSB1', directory)
+                self.assertEqual(checkpoint.resume_position(digest, len(program)), 0)
+                checkpoint.start(digest, len(program))
+                checkpoint.advance(8)
+                checkpoint.advance(4)
+
+                reopened = LoadCheckpoint.for_board('/dev/ttyUSB1', directory)
+                self.assertEqual(reopened.resume_position(digest, len(program)), 8)
+                self.assertEqual(reopened.resume_position(digest, len(program) + 1), 0)
+                self.assertEqual(reopened.resume_position(program_digest(NbfArray.dram_writes(range(1, 17))), len(program)), 0)
+
+                reopened.clear()
+                self.assertEqual(LoadCheckpoint.for_board('/dev/ttyUSB1', directory).resume_position(digest, len(program)), 0)
+                self.assertEqual(os.listdir(directory), [])
+
+    unittest.main()
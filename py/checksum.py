@@ -0,0 +1,218 @@
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from nbf import NbfArray, ADDRESS_BOOT_PC, DRAM_REGION_START, OPCODE_WRITE_8
+
+# the helper and its parameters and results live in the last MiB of the board's 256 MiB of DRAM,
+# which the program being verified must leave alone
+DEFAULT_CHECKSUM_SCRATCH_ADDRESS = DRAM_REGION_START + (255 << 20)
+CHECKSUM_SCRATCH_BYTES = 1 << 20
+# words of DRAM summarized by each digest
+DEFAULT_CHECKSUM_BLOCK_WORDS = 512
+# runs of fewer words than this are cheaper to read back than to checksum
+CHECKSUM_MIN_RUN_WORDS = 4
+
+# 64-bit FNV-1a, applied to whole words rather than bytes
+FNV_OFFSET_BASIS = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+
+# RV64IM checksum routine. It reads its parameters from the block at CHECKSUM_PARAMS_OFFSET:
+# the number of ranges, the words per block, a pointer to the digest array, the FNV prime and
+# offset basis, followed by (address, words) pairs. Every range is cut into blocks of up to
+# "block words" words, and each block's digest is stored in turn. It then fences, reports done
+# and spins.
+CHECKSUM_HELPER_CODE = (
+    0x00000417,  # entry: auipc s0, 0
+    0x10040413,  #        addi  s0, s0, 0x100
+    0x00043283,  #        ld    t0, 0(s0)
+    0x00843303,  #        ld    t1, 8(s0)
+    0x01043383,  #        ld    t2, 16(s0)
+    0x01843e03,  #        ld    t3, 24(s0)
+    0x02043e83,  #        ld    t4, 32(s0)
+    0x02840493,  #        addi  s1, s0, 40
+    0x04028863,  # range: beq   t0, zero, done
+    0x0004b583,  #        ld    a1, 0(s1)
+    0x0084b603,  #        ld    a2, 8(s1)
+    0x01048493,  #        addi  s1, s1, 16
+    0xfff28293,  #        addi  t0, t0, -1
+    0xfe0606e3,  # block: beq   a2, zero, range
+    0x00030693,  #        mv    a3, t1
+    0x00667463,  #        bgeu  a2, t1, full
+    0x00060693,  #        mv    a3, a2
+    0x40d60633,  # full:  sub   a2, a2, a3
+    0x000e8713,  #        mv    a4, t4
+    0x0005b783,  # word:  ld    a5, 0(a1)
+    0x00f74733,  #        xor   a4, a4, a5
+    0x03c70733,  #        mul   a4, a4, t3
+    0x00858593,  #        addi  a1, a1, 8
+    0xfff68693,  #        addi  a3, a3, -1
+    0xfe0696e3,  #        bnez  a3, word
+    0x00e3b023,  #        sd    a4, 0(t2)
+    0x00838393,  #        addi  t2, t2, 8
+    0xfc9ff06f,  #        j     block
+    0x0ff0000f,  # done:  fence
+    0x00102837,  #        lui   a6, 0x102
+    0x00083023,  #        sd    zero, 0(a6)
+    0x0000006f,  # spin:  j     spin
+)
+CHECKSUM_PARAMS_OFFSET = 0x100
+_PARAMS_HEADER_WORDS = 5
+
+def _instruction_words(instructions) -> List[int]:
+    """
+    Packs 32-bit instructions into little-endian 64-bit words.
+    """
+    instructions = list(instructions) + [0] * (len(instructions) % 2)
+    return [instructions[i] | (instructions[i + 1] << 32) for i in range(0, len(instructions), 2)]
+
+def trampoline_word(target: int) -> int:
+    """
+    The word at the boot PC that jumps to the helper: "auipc t0, hi; jalr zero, lo(t0)".
+    """
+    offset = target - ADDRESS_BOOT_PC
+    upper = (offset + 0x800) >> 12
+    lower = offset - (upper << 12)
+    auipc = ((upper & 0xfffff) << 12) | (5 << 7) | 0x17
+    jalr = ((lower & 0xfff) << 20) | (5 << 15) | 0x67
+    return auipc | (jalr << 32)
+
+class ChecksumPlan(NamedTuple):
+    # where the helper is placed
+    scratch_address: int
+    # (address, words) of every range the helper summarizes
+    ranges: List[Tuple[int, int]]
+    # the most words summarized by one digest
+    words_per_block: int
+    # start address and words of every block, in the order the helper stores their digests
+    block_addresses: np.ndarray
+    block_lengths: np.ndarray
+    # what the blocks should hash to
+    expected_digests: np.ndarray
+    # final (address, data) of the words to read back instead: those too scattered to
+    # checksum, and the word at the boot PC, once the trampoline has been replaced
+    loose_addresses: np.ndarray
+    loose_data: np.ndarray
+
+    @property
+    def params_address(self) -> int:
+        return self.scratch_address + CHECKSUM_PARAMS_OFFSET
+
+    @property
+    def digest_address(self) -> int:
+        return self.params_address + 8 * (_PARAMS_HEADER_WORDS + 2 * len(self.ranges))
+
+def block_digests(data: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    The helper's digest of each block of words data[start:start + length].
+    """
+    digests = np.full(len(starts), FNV_OFFSET_BASIS, dtype=np.uint64)
+    prime = np.uint64(FNV_PRIME)
+    with np.errstate(over='ignore'):
+        for i in range(int(lengths.max()) if len(lengths) else 0):
+            active = lengths > i
+            digests[active] = (digests[active] ^ data[starts[active] + i]) * prime
+    return digests
+
+def plan_checksums(program: NbfArray, scratch_address: int = DEFAULT_CHECKSUM_SCRATCH_ADDRESS, block_words: int = DEFAULT_CHECKSUM_BLOCK_WORDS) -> ChecksumPlan:
+    """
+    Splits the DRAM a program leaves behind into blocks for the helper, expecting the boot PC to
+    hold the trampoline while it runs. Raises ValueError if the program uses the scratch region
+    or has more blocks than fit in it.
+    """
+    addresses, data = program.final_dram_words()
+    scratch_end = scratch_address + CHECKSUM_SCRATCH_BYTES
+    if np.any((addresses >= scratch_address) & (addresses < scratch_end)):
+        raise ValueError(f"program writes to the checksum scratch region at 0x{scratch_address:010x}")
+
+    # the helper sees the trampoline at the boot PC
+    boot = addresses == ADDRESS_BOOT_PC
+    hashed_data = data.copy()
+    hashed_data[boot] = trampoline_word(scratch_address)
+
+    run_starts = np.flatnonzero(np.concatenate(([True], np.diff(addresses) != 8)))
+    run_lengths = np.diff(np.append(run_starts, len(addresses)))
+    long_runs = run_lengths >= CHECKSUM_MIN_RUN_WORDS
+    loose = np.repeat(~long_runs, run_lengths) | boot
+
+    ranges = [(int(addresses[start]), int(length)) for start, length in zip(run_starts[long_runs], run_lengths[long_runs])]
+    starts = []
+    lengths = []
+    for start, length in zip(run_starts[long_runs].tolist(), run_lengths[long_runs].tolist()):
+        offsets = np.arange(0, length, block_words)
+        starts.append(start + offsets)
+        lengths.append(np.minimum(block_words, length - offsets))
+    starts = np.concatenate(starts) if starts else np.empty(0, dtype=np.int64)
+    lengths = np.concatenate(lengths) if lengths else np.empty(0, dtype=np.int64)
+
+    params_bytes = 8 * (_PARAMS_HEADER_WORDS + 2 * len(ranges) + len(starts))
+    if CHECKSUM_PARAMS_OFFSET + params_bytes > CHECKSUM_SCRATCH_BYTES:
+        raise ValueError(f"{len(ranges)} ranges and {len(starts)} blocks do not fit in the checksum scratch region")
+
+    return ChecksumPlan(
+        scratch_address=scratch_address,
+        ranges=ranges,
+        words_per_block=block_words,
+        block_addresses=addresses[starts],
+        block_lengths=lengths,
+        expected_digests=block_digests(hashed_data, starts, lengths),
+        loose_addresses=addresses[loose],
+        loose_data=data[loose],
+    )
+
+def helper_program(plan: ChecksumPlan) -> NbfArray:
+    """
+    The writes that place the helper, its parameters and the trampoline in DRAM.
+    """
+    code = _instruction_words(CHECKSUM_HELPER_CODE)
+    params = [len(plan.ranges), plan.words_per_block, plan.digest_address, FNV_PRIME, FNV_OFFSET_BASIS]
+    for address, words in plan.ranges:
+        params += [address, words]
+
+    addresses = [plan.scratch_address + 8 * i for i in range(len(code))]
+    addresses += [plan.params_address + 8 * i for i in range(len(params))]
+    addresses.append(ADDRESS_BOOT_PC)
+    values = code + params + [trampoline_word(plan.scratch_address)]
+    return NbfArray.from_values(OPCODE_WRITE_8, np.array(addresses, dtype=np.uint64), np.array(values, dtype=np.uint64))
+
+if __name__ == '__main__':
+    import unittest
+    from nbf import ADDRESS_CSR_FREEZE
+    from emulator import CoreModel, FpgaHostModel
+
+    def _run(start, words) -> NbfArray:
+        return NbfArray.dram_writes([(start + 8 * i) * 0x9e3779b97f4a7c15 & (2 ** 64 - 1) for i in range(words)], start)
+
+    freeze = NbfArray.from_rows([(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1)])
+
+    class TestChecksum(unittest.TestCase):
+        def test_plan(self):
+            program = NbfArray.concatenate(freeze, _run(ADDRESS_BOOT_PC, 20), _run(DRAM_REGION_START + 0x1000, 2))
+            plan = plan_checksums(program, block_words=8)
+            self.assertEqual(plan.ranges, [(ADDRESS_BOOT_PC, 20)])
+            self.assertEqual(list(plan.block_lengths), [8, 8, 4])
+            # the boot word is read back, since the helper sees the trampoline in its place
+            self.assertEqual(list(plan.loose_addresses), [ADDRESS_BOOT_PC, DRAM_REGION_START + 0x1000, DRAM_REGION_START + 0x1008])
+
+            with self.assertRaises(ValueError):
+                plan_checksums(_run(DEFAULT_CHECKSUM_SCRATCH_ADDRESS, 4))
+
+        def test_helper_matches_host(self):
+            program = NbfArray.concatenate(freeze, _run(ADDRESS_BOOT_PC, 37), _run(DRAM_REGION_START + 0x10000, 300))
+            plan = plan_checksums(program, block_words=64)
+
+            model = FpgaHostModel()
+            for command in list(program) + list(helper_program(plan)):
+                model.execute(command)
+            # corrupt one word of the second range
+            model.memory[DRAM_REGION_START + 0x10000 + 8 * 100] ^= 1
+
+            messages, done = CoreModel(model).run()
+            self.assertTrue(done)
+            self.assertEqual(len(messages), 1)
+            digests = [model.memory[plan.digest_address + 8 * i] for i in range(len(plan.expected_digests))]
+            mismatched = [i for i, digest in enumerate(digests) if digest != int(plan.expected_digests[i])]
+            self.assertEqual(mismatched, [2])
+            self.assertEqual(int(plan.block_addresses[2]), DRAM_REGION_START + 0x10000 + 8 * 64)
+
+    unittest.main()
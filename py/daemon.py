@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import itertools
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from nbf import NbfArray, NbfCommand, ADDRESS_CSR_FREEZE, DRAM_REGION_START
+from nbf import OPCODE_FENCE, OPCODE_READ_4, OPCODE_READ_8, OPCODE_WRITE_4, OPCODE_WRITE_8
+from host import HostApp, HostEngine, ConsoleSink, LogDomain, add_image_cache_arguments, configure_image_cache, log, parse_memtest_patterns, parse_window_size, set_log_output, set_log_tag
+from host import DEFAULT_CONSOLE_FLUSH_SECONDS, DEFAULT_TX_BUFFER_BYTES
+from images import CACHE_MODE_CSRS, csr_preamble, open_program
+from manifest import BoardManifest
+from memtest import DEFAULT_MEMTEST_PATTERNS, MEMTEST_PATTERNS, parse_range
+
+DAEMON_PROTOCOL_VERSION = 1
+
+# the CSRs that every program and memory test sets up before touching memory
+SETUP_CSRS = (ADDRESS_CSR_FREEZE,) + CACHE_MODE_CSRS
+
+JOB_KINDS = ('load', 'verify', 'test', 'dump', 'listen')
+# jobs that depend on what a particular board holds, so cannot be scheduled on any board
+BOARD_SPECIFIC_JOBS = frozenset(['verify', 'dump', 'listen'])
+
+def default_socket_path() -> str:
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'arty-parrot.sock')
+    return f"/tmp/arty-parrot-{os.getuid()}.sock"
+
+class JobError(Exception):
+    """
+    A job that failed without leaving its board in an unknown state.
+    """
+
+class BoardState:
+    """
+    What the daemon knows a board's setup CSRs hold: the freeze bit and the cache modes. A value
+    is known once the daemon has written it, and everything is forgotten when a job fails, since
+    the board may then be in any state.
+    """
+    def __init__(self):
+        self.csrs: Dict[int, int] = {}
+
+    def forget(self):
+        self.csrs.clear()
+
+    def observe(self, program: NbfArray):
+        """
+        Records the values a program leaves in the setup CSRs.
+        """
+        writes = program.opcode_mask(OPCODE_WRITE_4, OPCODE_WRITE_8) & np.isin(program.addresses, np.array(SETUP_CSRS, dtype=np.uint64))
+        for index in np.flatnonzero(writes).tolist():
+            command = program[index]
+            self.csrs[command.address_int] = command.data_int
+
+    def strip_setup(self, program: NbfArray) -> Tuple[NbfArray, int]:
+        """
+        Drops setup commands at the start of a program that the board does not need: writes of
+        setup CSRs to the values they already hold, reads that check such values, and fences
+        that no longer follow any command. Returns the rest of the program and the number of
+        commands dropped.
+        """
+        csr_access = program.opcode_mask(OPCODE_WRITE_4, OPCODE_WRITE_8, OPCODE_READ_4, OPCODE_READ_8) & np.isin(program.addresses, np.array(SETUP_CSRS, dtype=np.uint64))
+        setup = csr_access | program.opcode_mask(OPCODE_FENCE)
+        prefix = len(program) if setup.all() else int(np.argmin(setup))
+
+        keep = np.ones(len(program), dtype=bool)
+        known = dict(self.csrs)
+        # CSRs the kept commands write, whose reads check those writes and must be kept too
+        written = set()
+        # whether a command was kept since the last fence
+        unfenced = False
+        for index in range(prefix):
+            command = program[index]
+            address = command.address_int
+            if command.opcode == OPCODE_FENCE:
+                keep[index] = unfenced
+                unfenced = False
+                continue
+
+            # nbf files read the setup CSRs back with the value they expect in the data
+            if address not in written and known.get(address) == command.data_int:
+                keep[index] = False
+                continue
+            if command.opcode in (OPCODE_WRITE_4, OPCODE_WRITE_8):
+                known[address] = command.data_int
+                written.add(address)
+            unfenced = True
+
+        skipped = len(program) - int(np.count_nonzero(keep))
+        return (program[keep] if skipped else program), skipped
+
+    def to_json(self) -> Dict[str, int]:
+        return {f"0x{address:010x}": value for address, value in sorted(self.csrs.items())}
+
+class Job:
+    """
+    A request from a client, queued on a board. Events are sent back to the client as JSON lines
+    while it runs; a client that has gone away simply stops receiving them.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, request: Dict[str, Any], writer: Optional[asyncio.StreamWriter] = None):
+        self.id = next(Job._ids)
+        self.kind: str = request['job']
+        self.request = request
+        self.writer = writer
+        self.board: Optional['BoardSession'] = None
+        # set if the client disconnected before the job started
+        self.abandoned = False
+        self.finished = asyncio.get_running_loop().create_future()
+
+    def send(self, event: Dict[str, Any]):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(json.dumps(event).encode('utf-8') + b'\n')
+
+class _JobOutput:
+    """
+    Sends what a program prints to the client of a job, as the stream of a ConsoleSink.
+    Characters are carried as latin-1 text, which maps every byte to one character.
+    """
+    def __init__(self, job: Job):
+        self.job = job
+
+    def write(self, data: bytes):
+        self.job.send({'event': 'output', 'text': bytes(data).decode('latin-1')})
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class BoardSession:
+    """
+    One board served by the daemon. Its port stays open and its HostEngine keeps running between
+    jobs, which are run one at a time in the order they were queued. The engine is restarted,
+    and the board state forgotten, after a job fails.
+    """
+    def __init__(self, port: str, args):
+        self.port = port
+        self.name = os.path.basename(port) or port
+        self.args = args
+        self.state = BoardState()
+        self.queue: 'asyncio.Queue[Job]' = asyncio.Queue()
+        self.current: Optional[Job] = None
+        self.app: Optional[HostApp] = None
+        self.engine: Optional[HostEngine] = None
+
+        self.jobs_run = 0
+        self.jobs_failed = 0
+        self.setup_commands_skipped = 0
+
+    @property
+    def load(self) -> int:
+        """
+        Jobs queued or running on the board.
+        """
+        return self.queue.qsize() + (self.current is not None)
+
+    def submit(self, job: Job):
+        job.board = self
+        job.send({'event': 'queued', 'job': job.id, 'board': self.name, 'position': self.load})
+        self.queue.put_nowait(job)
+
+    def _log_line(self, line: str):
+        if self.current is not None:
+            self.current.send({'event': 'log', 'line': line})
+        else:
+            print(line, flush=True)
+
+    async def run(self):
+        # the engine's tasks are started from this one, so they inherit its log tag and output
+        set_log_tag(self.name)
+        set_log_output(self._log_line)
+        try:
+            while True:
+                job = await self.queue.get()
+                if job.abandoned:
+                    continue
+                self.current = job
+                try:
+                    await self._run_job(job)
+                finally:
+                    self.current = None
+        finally:
+            await self._close_engine()
+
+    async def _open_engine(self) -> HostEngine:
+        if self.engine is None:
+            args = self.args
+            self.app = HostApp(serial_port_name=self.port, serial_port_baud=args.baud_rate, timeout=args.timeout, tx_buffer_bytes=args.tx_buffer_bytes)
+            self.app.show_progress = False
+            self.app.manifest = BoardManifest.for_board(self.port, args.manifest_dir)
+            self.app.port.reset_input_buffer()
+            self.engine = HostEngine(self.app)
+            await self.engine.start()
+        return self.engine
+
+    async def _close_engine(self):
+        engine, self.engine = self.engine, None
+        app, self.app = self.app, None
+        if engine is not None:
+            try:
+                await engine.stop(drain=False)
+            except Exception:
+                pass
+        if app is not None:
+            try:
+                app.port.close()
+            except Exception:
+                pass
+
+    async def _run_job(self, job: Job):
+        job.send({'event': 'started', 'job': job.id, 'board': self.name})
+        start = time.perf_counter()
+        result: Dict[str, Any] = {}
+        error = None
+        commands_sent = bytes_written = reply_violations = 0
+        try:
+            engine = await self._open_engine()
+            commands_sent = self.app.commands_sent
+            bytes_written = self.app.transmit.bytes_written
+            reply_violations = self.app.reply_violations
+            result = await getattr(self, '_' + job.kind)(job, engine)
+        except JobError as e:
+            error = str(e)
+            log(LogDomain.COMMAND, f"Failed: {e}")
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            log(LogDomain.COMMAND, f"Failed: {error}, resetting the board's connection")
+            self.state.forget()
+            await self._close_engine()
+
+        if self.app is not None:
+            result['commands_sent'] = self.app.commands_sent - commands_sent
+            result['bytes_written'] = self.app.transmit.bytes_written - bytes_written
+            result['reply_violations'] = self.app.reply_violations - reply_violations
+        result['elapsed'] = time.perf_counter() - start
+        ok = error is None and not result.get('corrupted') and not result.get('core_status') and not result.get('reply_violations')
+
+        self.jobs_run += 1
+        self.jobs_failed += not ok
+        job.send({'event': 'done', 'job': job.id, 'board': self.name, 'ok': ok, 'error': error, 'result': result})
+        if not job.finished.done():
+            job.finished.set_result(ok)
+
+    ## Jobs
+
+    async def _program(self, request: Dict[str, Any]) -> NbfArray:
+        def read():
+            program = open_program(request['file'], request.get('mem_base', DRAM_REGION_START), request.get('skip_bss', False))
+            return program if isinstance(program, NbfArray) else NbfArray.from_file(program)
+        # parsing a new file should not hold up the other boards
+        return await asyncio.get_running_loop().run_in_executor(None, read)
+
+    def _strip_setup(self, program: NbfArray) -> Tuple[NbfArray, int]:
+        stripped, skipped = self.state.strip_setup(program)
+        if skipped:
+            self.setup_commands_skipped += skipped
+            log(LogDomain.COMMAND, f"Skipping {skipped} setup commands the board does not need")
+        return stripped, skipped
+
+    async def _load(self, job: Job, engine: HostEngine) -> Dict[str, Any]:
+        request = job.request
+        window = request.get('window_size')
+        verify = request.get('verify', False)
+        ignore_unfreezes = request.get('no_unfreeze', False) or verify
+        program = await self._program(request)
+        sent = program.without_unfreezes() if ignore_unfreezes else program
+        stripped, skipped = self._strip_setup(sent)
+
+        await engine.load(
+            stripped,
+            sliding_window_num_commands=window,
+            manifest=self.app.manifest,
+            incremental=request.get('incremental', False),
+            spot_check_blocks=request.get('spot_checks', 4),
+            bursts=not request.get('no_bursts', False),
+        )
+        self.state.observe(sent)
+        result: Dict[str, Any] = {'commands': len(program), 'setup_commands_skipped': skipped}
+
+        if verify:
+            result['corrupted'] = await self._verify_program(engine, program, request)
+            if result['corrupted'] > 0:
+                log(LogDomain.COMMAND, "Not unfreezing a corrupted program")
+                return result
+            unfreeze_command = NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0)
+            if not request.get('no_unfreeze', False) and program.command_mask(unfreeze_command).any():
+                await engine.unfreeze()
+                self.state.csrs[ADDRESS_CSR_FREEZE] = 0
+
+        if request.get('listen', False):
+            result['core_status'] = await self._listen_until_done(job, engine)
+        return result
+
+    async def _verify_program(self, engine: HostEngine, program: NbfArray, request: Dict[str, Any]) -> int:
+        window = request.get('window_size')
+        if request.get('checksum', False):
+            corrupted = await engine.verify_checksums(program, window)
+            # the checksum helper runs on the core, which is frozen again afterwards
+            self.state.csrs[ADDRESS_CSR_FREEZE] = 1
+            return corrupted
+        return await engine.verify(program, window)
+
+    async def _verify(self, job: Job, engine: HostEngine) -> Dict[str, Any]:
+        program = await self._program(job.request)
+        return {'corrupted': await self._verify_program(engine, program, job.request)}
+
+    async def _test(self, job: Job, engine: HostEngine) -> Dict[str, Any]:
+        window = job.request.get('window_size')
+        setup, skipped = self._strip_setup(csr_preamble())
+        for command in setup:
+            await engine.send(command, window)
+        await engine.wait_for_replies()
+        self.state.observe(setup)
+
+        report = await engine.test_memory(
+            sliding_window_num_commands=window,
+            words=job.request.get('words', 8192),
+            configure=False,
+            ranges=[parse_range(value) for value in job.request.get('ranges') or []],
+            patterns=job.request.get('patterns', DEFAULT_MEMTEST_PATTERNS),
+            seed=job.request.get('seed', 0)
+        )
+        result = report.to_json()
+        result['setup_commands_skipped'] = skipped
+        return result
+
+    async def _dump(self, job: Job, engine: HostEngine) -> Dict[str, Any]:
+        address = job.request['address']
+        values = await engine.dump(address, job.request.get('words', 1), job.request.get('window_size'))
+        return {'address': address, 'data': values}
+
+    async def _listen(self, job: Job, engine: HostEngine) -> Dict[str, Any]:
+        return {'core_status': await self._listen_until_done(job, engine)}
+
+    async def _listen_until_done(self, job: Job, engine: HostEngine) -> int:
+        timeout = job.request.get('timeout')
+        console = ConsoleSink(_JobOutput(job), self.args.flush_seconds)
+        engine.console = console
+        try:
+            return await asyncio.wait_for(engine.listen(), timeout)
+        except asyncio.TimeoutError:
+            raise JobError(f"no core reported done within {timeout} seconds")
+        finally:
+            console.close()
+            engine.console = None
+            engine.listening = False
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'port': self.port,
+            'running': self.current.kind if self.current is not None else None,
+            'queued': self.queue.qsize(),
+            'jobs_run': self.jobs_run,
+            'jobs_failed': self.jobs_failed,
+            'setup_commands_skipped': self.setup_commands_skipped,
+            'connected': self.engine is not None,
+            'csrs': self.state.to_json(),
+        }
+
+class BoardDaemon:
+    """
+    Serves jobs for a set of boards over a Unix socket. Each connection carries one request, a
+    JSON object on a single line, and receives JSON events, one per line, until the job is done.
+    Jobs that name a board (by port or port basename) are queued on it; the others go to the
+    board with the fewest jobs queued or running.
+    """
+    def __init__(self, ports: List[str], args):
+        self.args = args
+        self.boards = [BoardSession(port, args) for port in ports]
+        self._tasks: List[asyncio.Task] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.socket_path = socket_path
+        self._tasks = [asyncio.ensure_future(board.run()) for board in self.boards]
+        self._server = await asyncio.start_unix_server(self._serve_client, path=socket_path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _board_for(self, request: Dict[str, Any]) -> BoardSession:
+        name = request.get('board')
+        if name is not None:
+            for board in self.boards:
+                if name in (board.name, board.port):
+                    return board
+            raise JobError(f"no board named \"{name}\"")
+        if request['job'] in BOARD_SPECIFIC_JOBS and len(self.boards) > 1:
+            raise JobError(f"{request['job']} jobs must name a board")
+        return min(self.boards, key=lambda board: board.load)
+
+    def status(self) -> Dict[str, Any]:
+        return {'protocol': DAEMON_PROTOCOL_VERSION, 'pid': os.getpid(), 'boards': [board.status() for board in self.boards]}
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(event: Dict[str, Any]):
+            writer.write(json.dumps(event).encode('utf-8') + b'\n')
+
+        try:
+            request = json.loads(await reader.readline())
+            if request.get('job') == 'status':
+                reply({'event': 'done', 'ok': True, 'error': None, 'result': self.status()})
+                return
+            if request.get('job') not in JOB_KINDS:
+                raise JobError(f"unknown job \"{request.get('job')}\"")
+
+            job = Job(request, writer)
+            self._board_for(request).submit(job)
+            disconnected = asyncio.ensure_future(reader.read())
+            await asyncio.wait([job.finished, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not job.finished.done():
+                # the client went away; a queued job is dropped, a running one completes
+                job.abandoned = True
+            disconnected.cancel()
+        except (ValueError, KeyError, JobError) as e:
+            reply({'event': 'done', 'ok': False, 'error': str(e), 'result': {}})
+        finally:
+            try:
+                await writer.drain()
+                writer.close()
+            except (ConnectionError, OSError):
+                pass
+
+def submit(socket_path: str, request: Dict[str, Any], on_event: Callable[[Dict[str, Any]], None] = lambda event: None) -> Dict[str, Any]:
+    """
+    Sends a request to a daemon, calls "on_event" with every event it sends back, and returns
+    the final "done" event.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with client.makefile('rb') as events:
+            for line in events:
+                event = json.loads(line)
+                on_event(event)
+                if event['event'] == 'done':
+                    return event
+    raise ConnectionError("the daemon closed the connection before the job was done")
+
+def _print_event(event: Dict[str, Any]):
+    kind = event['event']
+    if kind == 'log':
+        print(event['line'], flush=True)
+    elif kind == 'output':
+        sys.stdout.buffer.write(event['text'].encode('latin-1'))
+        sys.stdout.flush()
+    elif kind == 'queued' and event['position'] > 0:
+        print(f"Queued on {event['board']} behind {event['position']} jobs", file=sys.stderr, flush=True)
+
+def _client_request(args) -> Dict[str, Any]:
+    request: Dict[str, Any] = {'job': args.command, 'board': args.board}
+    if getattr(args, 'file', None) is not None:
+        # the daemon may run in another directory
+        request['file'] = os.path.abspath(args.file)
+        request['mem_base'] = args.mem_base
+        request['skip_bss'] = args.skip_bss
+    for option in ('window_size', 'verify', 'checksum', 'listen', 'no_unfreeze', 'incremental', 'spot_checks', 'no_bursts', 'words', 'ranges', 'patterns', 'seed', 'address', 'timeout'):
+        if hasattr(args, option):
+            request[option] = getattr(args, option)
+    return request
+
+def _client_command(args) -> int:
+    done = submit(args.socket, _client_request(args), _print_event)
+    result = done['result']
+    if args.command == 'status':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    elif args.command == 'dump':
+        for i, value in enumerate(result.get('data', [])):
+            print(f"0x{result['address'] + 8 * i:010x}: 0x{value:016x}")
+    elif args.command == 'test' and 'faults' in result:
+        print(f"{result['words']} words checked, {result['faults']} faulty")
+    if done['error'] is not None:
+        print(f"Job failed: {done['error']}", file=sys.stderr)
+    elif 'elapsed' in result:
+        print(f"Job done on {done['board']} in {result['elapsed']:.2f} s: {result['commands_sent']} commands sent", file=sys.stderr)
+    return 0 if done['ok'] else 1
+
+def _serve_command(args):
+    from farm import expand_ports
+
+    async def serve():
+        daemon = BoardDaemon(expand_ports(args.ports), args)
+        await daemon.start(args.socket)
+        print(f"Serving {', '.join(board.port for board in daemon.boards)} on {args.socket}", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await daemon.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+def _add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('-p', '--ports', dest='ports', action='append', required=True, help='Serial ports of the boards to serve: names, comma-separated lists or glob patterns (repeatable)')
+    parser.add_argument('-b', '--baud', dest='baud_rate', type=int, default=1000000, help='Serial port baud rate')
+    parser.add_argument('-t', '--timeout', dest='timeout', type=float, default=3.0, help='Timeout in seconds')
+    parser.add_argument('--tx-buffer-size', type=int, default=DEFAULT_TX_BUFFER_BYTES, dest='tx_buffer_bytes', help='Coalesce outgoing commands into writes of up to this many bytes')
+    parser.add_argument('--manifest-dir', type=str, default=None, dest='manifest_dir', help='Directory of board manifests')
+    parser.add_argument('--flush-seconds', type=float, default=DEFAULT_CONSOLE_FLUSH_SECONDS, dest='flush_seconds', help='Longest time printed characters are buffered before being sent to the client')
+    add_image_cache_arguments(parser)
+
+def _add_program_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('file', help="NBF-formatted file, binary NBF image, .mem file or RISC-V ELF file")
+    parser.add_argument('--mem-base', type=lambda v: int(v, 0), default=DRAM_REGION_START, dest='mem_base', help='Address that the offsets of a .mem file are relative to')
+    parser.add_argument('--skip-bss', action='store_true', dest='skip_bss', help='Do not write the zero-filled bss of ELF segments')
+    parser.add_argument('--checksum', action='store_true', dest='checksum', help='Verify through checksums computed on the board')
+
+if __name__ == '__main__' and sys.argv[1:2] == ['self-test']:
+    import tempfile
+    import threading
+    import unittest
+    from emulator import EmulatorConfig, FpgaHostEmulator
+    from images import csr_postamble
+    from nbf_cache import set_default_image_cache
+
+    set_default_image_cache(None)
+
+    def _program_file(directory: str, words: List[int]) -> str:
+        program = NbfArray.concatenate(csr_preamble(), NbfArray.dram_writes(words), csr_postamble())
+        path = os.path.join(directory, 'program.nbf')
+        with open(path, 'w') as f:
+            f.write(program.to_text())
+        return path
+
+    class TestBoardState(unittest.TestCase):
+        def test_strip_setup(self):
+            state = BoardState()
+            preamble = csr_preamble()
+            self.assertEqual(state.strip_setup(preamble)[1], 0)
+
+            state.observe(preamble)
+            stripped, skipped = state.strip_setup(preamble)
+            self.assertEqual((len(stripped), skipped), (0, len(preamble)))
+
+            # once unfrozen, only the freeze and its fence are needed
+            state.observe(csr_postamble())
+            stripped, skipped = state.strip_setup(preamble)
+            self.assertEqual([command.opcode for command in stripped], [OPCODE_WRITE_8, OPCODE_FENCE])
+            self.assertEqual(stripped[0].address_int, ADDRESS_CSR_FREEZE)
+
+            state.forget()
+            self.assertEqual(state.strip_setup(preamble)[1], 0)
+
+    class TestBoardDaemon(unittest.TestCase):
+        def test_jobs(self):
+            config = EmulatorConfig(program_output=b'hello\n')
+            with FpgaHostEmulator(config) as emulator, tempfile.TemporaryDirectory() as directory:
+                args = argparse.Namespace(baud_rate=config.baud, timeout=2.0, tx_buffer_bytes=DEFAULT_TX_BUFFER_BYTES, manifest_dir=directory, flush_seconds=0.01)
+                socket_path = os.path.join(directory, 'daemon.sock')
+                loop = asyncio.new_event_loop()
+                daemon = BoardDaemon([emulator.port_name], args)
+                loop.run_until_complete(daemon.start(socket_path))
+                server = threading.Thread(target=loop.run_forever)
+                server.start()
+                try:
+                    path = _program_file(directory, list(range(100, 164)))
+                    output = []
+                    collect = lambda event: output.append(event['text']) if event['event'] == 'output' else None
+                    first = submit(socket_path, {'job': 'load', 'file': path, 'verify': True, 'listen': True, 'timeout': 5}, collect)
+                    self.assertTrue(first['ok'], first)
+                    self.assertEqual(first['result']['setup_commands_skipped'], 0)
+                    self.assertEqual((first['result']['corrupted'], first['result']['core_status']), (0, 0))
+                    self.assertEqual("".join(output), 'hello\n')
+
+                    # the board is known to have its caches set up, so only the freeze is sent
+                    second = submit(socket_path, {'job': 'load', 'file': path, 'no_unfreeze': True})
+                    self.assertTrue(second['ok'], second)
+                    self.assertEqual(second['result']['setup_commands_skipped'], len(csr_preamble()) - 2)
+                    test = submit(socket_path, {'job': 'test', 'words': 16})
+                    self.assertTrue(test['ok'], test)
+                    self.assertEqual(test['result']['setup_commands_skipped'], len(csr_preamble()))
+                    self.assertEqual((test['result']['words'], test['result']['faults']), (16, 0))
+                    test = submit(socket_path, {'job': 'test', 'ranges': ['0x80001000:4K'], 'patterns': ['address', 'random']})
+                    self.assertEqual((test['result']['words'], test['result']['faults']), (1024, 0))
+                    self.assertFalse(submit(socket_path, {'job': 'test', 'ranges': ['0x80000004:4K']})['ok'])
+
+                    dump = submit(socket_path, {'job': 'dump', 'address': DRAM_REGION_START + 8 * 32, 'words': 4})
+                    self.assertEqual(dump['result']['data'], [132, 133, 134, 135])
+                    status = submit(socket_path, {'job': 'status'})['result']
+                    self.assertEqual(status['boards'][0]['jobs_run'], 6)
+
+                    self.assertFalse(submit(socket_path, {'job': 'load', 'file': path, 'board': 'nope'})['ok'])
+                    self.assertFalse(submit(socket_path, {'job': 'load', 'file': os.path.join(directory, 'missing.nbf')})['ok'])
+                    self.assertEqual(submit(socket_path, {'job': 'status'})['result']['boards'][0]['csrs'], {})
+                finally:
+                    asyncio.run_coroutine_threadsafe(daemon.stop(), loop).result()
+                    loop.call_soon_threadsafe(loop.stop)
+                    server.join()
+                    loop.close()
+
+    unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+
+elif __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep boards' ports open and run load, verify, test, dump and listen jobs on them, submitted over a Unix socket. Run \"daemon.py self-test\" for its self-tests.")
+    parser.add_argument('--socket', type=str, default=default_socket_path(), dest='socket', help='Path of the Unix socket the daemon listens on')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve_parser = commands.add_parser('serve', help='Run the daemon')
+    _add_server_arguments(serve_parser)
+    serve_parser.set_defaults(handler=_serve_command)
+
+    def job_parser(name: str, help: str) -> argparse.ArgumentParser:
+        job = commands.add_parser(name, help=help)
+        job.add_argument('--board', type=str, default=None, dest='board', help='Port, or port basename, of the board to run on (defaults to the least busy board)')
+        job.set_defaults(handler=lambda args: sys.exit(_client_command(args)))
+        return job
+
+    load_parser = job_parser('load', 'Load a program')
+    _add_program_arguments(load_parser)
+    load_parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Maximum number of outstanding replies, or "auto"')
+    load_parser.add_argument('--verify', action='store_true', dest='verify', help='Verify memory after loading, and only then unfreeze the program')
+    load_parser.add_argument('--listen', action='store_true', dest='listen', help='Stream what the program prints until its core reports done')
+    load_parser.add_argument('--timeout', type=float, default=None, dest='timeout', help='Seconds to listen before giving up')
+    load_parser.add_argument('--no-unfreeze', action='store_true', dest='no_unfreeze', help='Suppress any "unfreeze" commands in the input file')
+    load_parser.add_argument('--incremental', action='store_true', dest='incremental', help='Only send DRAM blocks that differ from what the board was last loaded with')
+    load_parser.add_argument('--spot-checks', type=int, default=4, dest='spot_checks', help='Number of unchanged blocks to read back before an incremental load trusts the board manifest')
+    load_parser.add_argument('--no-bursts', action='store_true', dest='no_bursts', help='Send single writes even if the FPGA host supports burst writes')
+
+    verify_parser = job_parser('verify', 'Verify memory against a program')
+    _add_program_arguments(verify_parser)
+    verify_parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Maximum number of outstanding replies, or "auto"')
+
+    test_parser = job_parser('test', 'Run the memory test')
+    test_parser.add_argument('--words', type=int, default=8192, dest='words', help='Number of words to write and read from memory')
+    test_parser.add_argument('--range', type=str, action='append', default=None, dest='ranges', help='Test START:SIZE (e.g. 0x80000000:64M) instead, or "all" of DRAM; may be repeated')
+    test_parser.add_argument('--patterns', type=parse_memtest_patterns, default=list(DEFAULT_MEMTEST_PATTERNS), dest='patterns', help=f"Comma-separated patterns to write and check, of {', '.join(MEMTEST_PATTERNS)}")
+    test_parser.add_argument('--seed', type=int, default=0, dest='seed', help='Seed of the random pattern')
+    test_parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Maximum number of outstanding replies, or "auto"')
+
+    dump_parser = job_parser('dump', 'Print words of memory')
+    dump_parser.add_argument('address', type=lambda v: int(v, 0), help='Address of the first word')
+    dump_parser.add_argument('words', type=int, nargs='?', default=1, help='Number of 8-byte words')
+
+    listen_parser = job_parser('listen', 'Stream what the program prints until its core reports done')
+    listen_parser.add_argument('--timeout', type=float, default=None, dest='timeout', help='Seconds to listen before giving up')
+
+    job_parser('status', 'Print the state and queue of every board')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        configure_image_cache(args)
+    args.handler(args)
@@ -0,0 +1,795 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tty
+import time
+import select
+import argparse
+import threading
+
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from nbf import NBF_COMMAND_LENGTH_BYTES, NbfCommand, NbfStreamDecoder, ADDRESS_CSR_FREEZE, opcode_name
+from nbf import ADDRESS_BOOT_PC, ADDRESS_PUTCH, ADDRESS_FINISH
+from nbf import OPCODE_FENCE, OPCODE_FINISH, OPCODE_READ_4, OPCODE_READ_8, OPCODE_WRITE_4, OPCODE_WRITE_8
+from nbf import OPCODE_PUTCH, OPCODE_CORE_DONE, OPCODE_ERROR
+from nbf import OPCODE_CTRL_SET, OPCODE_CTRL_CLEAR, OPCODE_CTRL_WRITE, OPCODE_CTRL_READ
+from nbf import CTRL_BIT_READ_ERROR, CTRL_BIT_WRITE_ERROR, CTRL_BIT_WRITE_RESP, CTRL_BIT_BURST_WRITE
+from transport import MemoryPort
+
+# fpga_host_ctrl_s is {wr_resp, wr_error, rd_error}
+CTRL_REGISTER_MASK = (1 << CTRL_BIT_READ_ERROR) | (1 << CTRL_BIT_WRITE_ERROR) | (1 << CTRL_BIT_WRITE_RESP)
+CTRL_ERROR_MASK = (1 << CTRL_BIT_READ_ERROR) | (1 << CTRL_BIT_WRITE_ERROR)
+
+# messages from the FPGA host itself, rather than a core, carry an all-ones address
+FPGA_HOST_ADDRESS = (1 << 40) - 1
+
+# opcodes that become IO commands to BlackParrot, and so see the memory latency
+MEMORY_OPCODES = frozenset([OPCODE_WRITE_4, OPCODE_WRITE_8, OPCODE_READ_4, OPCODE_READ_8])
+
+# the emulator wakes up at least this often, so it can be stopped
+EMULATOR_POLL_SECONDS = 0.05
+# how often the emulator retries a transmit to a full memory pipe, which it cannot wait on
+MEMORY_TX_RETRY_SECONDS = 0.0005
+
+# a program still running after this many instructions is taken to never finish
+CORE_MAX_INSTRUCTIONS = 50_000_000
+
+_XLEN_MASK = (1 << 64) - 1
+
+class EmulatorConfig(NamedTuple):
+    # line rate; every byte takes a start bit, 8 data bits and a stop bit
+    baud: int = 1000000
+    # commands the FPGA host processes per second once they are buffered, 0 for no limit
+    commands_per_second: float = 0.0
+    # time from a memory command leaving the NBF buffer until its response is ready
+    latency_seconds: float = 0.0
+    # uart_rx_buffer_els_p, uart_tx_buffer_els_p and nbf_buffer_els_p of bp_fpga_host
+    rx_buffer_bytes: int = 256
+    tx_buffer_bytes: int = 256
+    nbf_buffer_els: int = 4
+    # initial control register, fpga_host_ctrl_gp
+    ctrl_reset: int = 0
+    # accept burst writes, fpga_host_caps_gp.burst_write
+    burst_writes: bool = True
+    # drop every Nth command as if the receive FIFO had overflowed, 0 to disable
+    overflow_every: int = 0
+    # characters the "program" prints after it is unfrozen, before its core reports done
+    program_output: bytes = b''
+    # time the program runs after it is unfrozen
+    program_seconds: float = 0.0
+    # echo every byte back instead of decoding NBF, like the arty_uart loopback design
+    loopback: bool = False
+    # bytes of not-yet-transmitted host data read ahead from the pty; beyond this the host's
+    # writes block, as they would on a real serial link
+    read_ahead_bytes: int = 4096
+
+    @property
+    def byte_seconds(self) -> float:
+        return 10 / self.baud
+
+class FpgaHostModel:
+    """
+    Functional model of the NBF protocol implemented by bp_fpga_host, as defined in
+    bp_fpga_host_pkgdef.svh: 4 and 8 byte memory reads and writes, fences, finish, and the
+    control register with its write response enable and error bits. execute() returns the
+    messages the FPGA host sends back for a command.
+
+    Burst writes are expanded into 8-byte writes by NbfStreamDecoder before they get here;
+    "burst_writes" only decides whether control register reads advertise them.
+    """
+    def __init__(self, ctrl_reset: int = 0, burst_writes: bool = True):
+        self.ctrl = ctrl_reset & CTRL_REGISTER_MASK
+        self.capabilities = (1 << CTRL_BIT_BURST_WRITE) if burst_writes else 0
+        # sparse memory of 8-byte words, keyed by their aligned address
+        self.memory: Dict[int, int] = {}
+
+    def flag_read_error(self):
+        """
+        Records a receive error (frame, parity or overflow), which bp_fpga_host_io_in reports
+        through the rd_error bit.
+        """
+        self.ctrl |= 1 << CTRL_BIT_READ_ERROR
+
+    def _store(self, address: int, data: int, size: int):
+        word_address = address & ~0x7
+        shift = (address & 0x7) * 8
+        mask = ((1 << (size * 8)) - 1) << shift
+        word = self.memory.get(word_address, 0)
+        self.memory[word_address] = (word & ~mask) | ((data << shift) & mask)
+
+    def _load(self, address: int, size: int) -> int:
+        word = self.memory.get(address & ~0x7, 0)
+        return (word >> ((address & 0x7) * 8)) & ((1 << (size * 8)) - 1)
+
+    def execute(self, command: NbfCommand) -> List[NbfCommand]:
+        opcode = command.opcode
+        address = command.address_int
+        mask = address & CTRL_REGISTER_MASK
+
+        if opcode in (OPCODE_WRITE_4, OPCODE_WRITE_8):
+            size = 4 if opcode == OPCODE_WRITE_4 else 8
+            self._store(address, command.data_int, size)
+            if self.ctrl & (1 << CTRL_BIT_WRITE_RESP):
+                return [NbfCommand.with_values(opcode, address, 0)]
+            return []
+        elif opcode in (OPCODE_READ_4, OPCODE_READ_8):
+            size = 4 if opcode == OPCODE_READ_4 else 8
+            return [NbfCommand.with_values(opcode, address, self._load(address, size))]
+        elif opcode in (OPCODE_FENCE, OPCODE_FINISH):
+            return [NbfCommand.with_values(opcode, 0, 0)]
+        elif opcode == OPCODE_CTRL_SET:
+            self.ctrl |= mask
+            return []
+        elif opcode == OPCODE_CTRL_CLEAR:
+            self.ctrl &= ~mask
+            return []
+        elif opcode == OPCODE_CTRL_WRITE:
+            self.ctrl = mask & command.data_int & ~CTRL_ERROR_MASK
+            return []
+        elif opcode == OPCODE_CTRL_READ:
+            reply = NbfCommand.with_values(OPCODE_CTRL_READ, 0, self.ctrl | self.capabilities)
+            # reading the control register clears its error bits
+            self.ctrl &= ~CTRL_ERROR_MASK
+            return [reply]
+        else:
+            return [NbfCommand.with_values(OPCODE_ERROR, FPGA_HOST_ADDRESS, opcode)]
+
+def _signed(value: int, bits: int) -> int:
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+class UnsupportedInstruction(Exception):
+    pass
+
+class CoreModel:
+    """
+    Runs a program from the boot PC against an FpgaHostModel's memory, for the small RV64IM
+    subset that helper programs such as checksum.py's are written in: integer loads, stores,
+    arithmetic and branches, mul, and fences as no-ops. Stores to ADDRESS_PUTCH and
+    ADDRESS_FINISH become the messages the FPGA host would send. Anything else, such as CSR
+    accesses, raises UnsupportedInstruction.
+    """
+    def __init__(self, model: FpgaHostModel):
+        self.model = model
+        self.registers = [0] * 32
+        self.instructions = 0
+
+    def _load(self, address: int, size: int, signed: bool) -> int:
+        value = self.model._load(address, size)
+        return _signed(value, size * 8) & _XLEN_MASK if signed else value
+
+    def run(self, pc: int = ADDRESS_BOOT_PC, max_instructions: int = CORE_MAX_INSTRUCTIONS) -> Tuple[List[NbfCommand], bool]:
+        """
+        Returns the messages the program sent, and whether it reported done.
+        """
+        x = self.registers
+        messages: List[NbfCommand] = []
+        for _ in range(max_instructions):
+            self.instructions += 1
+            instruction = self.model._load(pc, 4)
+            opcode = instruction & 0x7f
+            rd = (instruction >> 7) & 0x1f
+            funct3 = (instruction >> 12) & 0x7
+            rs1 = x[(instruction >> 15) & 0x1f]
+            rs2 = x[(instruction >> 20) & 0x1f]
+            funct7 = instruction >> 25
+            i_imm = _signed(instruction >> 20, 12)
+            next_pc = pc + 4
+            result = None
+
+            if opcode == 0x37:
+                result = _signed(instruction & 0xfffff000, 32)
+            elif opcode == 0x17:
+                result = pc + _signed(instruction & 0xfffff000, 32)
+            elif opcode == 0x6f:
+                offset = ((instruction >> 31) << 20) | (((instruction >> 12) & 0xff) << 12) | (((instruction >> 20) & 1) << 11) | (((instruction >> 21) & 0x3ff) << 1)
+                result, next_pc = next_pc, pc + _signed(offset, 21)
+            elif opcode == 0x67 and funct3 == 0:
+                result, next_pc = next_pc, (rs1 + i_imm) & ~1
+            elif opcode == 0x63:
+                offset = ((instruction >> 31) << 12) | (((instruction >> 7) & 1) << 11) | (((instruction >> 25) & 0x3f) << 5) | (((instruction >> 8) & 0xf) << 1)
+                if funct3 in (0, 1):
+                    taken = rs1 == rs2
+                elif funct3 in (4, 5):
+                    taken = _signed(rs1, 64) < _signed(rs2, 64)
+                elif funct3 in (6, 7):
+                    taken = rs1 < rs2
+                else:
+                    raise UnsupportedInstruction(f"0x{instruction:08x} at 0x{pc:x}")
+                if taken != bool(funct3 & 1):
+                    next_pc = pc + _signed(offset, 13)
+            elif opcode == 0x03 and funct3 != 7:
+                size = 1 << (funct3 & 3)
+                result = self._load((rs1 + i_imm) & _XLEN_MASK, size, not funct3 & 4)
+            elif opcode == 0x23 and funct3 < 4:
+                size = 1 << funct3
+                address = (rs1 + _signed(((instruction >> 25) << 5) | ((instruction >> 7) & 0x1f), 12)) & _XLEN_MASK
+                if address == ADDRESS_PUTCH:
+                    messages.append(NbfCommand.with_values(OPCODE_PUTCH, FPGA_HOST_ADDRESS, rs2 & 0xff))
+                elif address & ~0xfff == ADDRESS_FINISH:
+                    messages.append(NbfCommand.with_values(OPCODE_CORE_DONE, (address >> 3) & 0x1ff, rs2 & 0xff))
+                    return messages, True
+                else:
+                    self.model._store(address, rs2, size)
+            elif opcode == 0x13:
+                shamt = (instruction >> 20) & 0x3f
+                if funct3 == 0:
+                    result = rs1 + i_imm
+                elif funct3 == 1:
+                    result = rs1 << shamt
+                elif funct3 == 4:
+                    result = rs1 ^ i_imm
+                elif funct3 == 5:
+                    result = _signed(rs1, 64) >> shamt if instruction >> 30 & 1 else rs1 >> shamt
+                elif funct3 == 6:
+                    result = rs1 | i_imm
+                elif funct3 == 7:
+                    result = rs1 & i_imm
+                else:
+                    result = int((_signed(rs1, 64) < i_imm) if funct3 == 2 else (rs1 < (i_imm & _XLEN_MASK)))
+            elif opcode == 0x33 and funct7 in (0x00, 0x20):
+                if funct3 == 0:
+                    result = rs1 - rs2 if funct7 else rs1 + rs2
+                elif funct3 == 1:
+                    result = rs1 << (rs2 & 0x3f)
+                elif funct3 == 4:
+                    result = rs1 ^ rs2
+                elif funct3 == 5:
+                    result = _signed(rs1, 64) >> (rs2 & 0x3f) if funct7 else rs1 >> (rs2 & 0x3f)
+                elif funct3 == 6:
+                    result = rs1 | rs2
+                elif funct3 == 7:
+                    result = rs1 & rs2
+                else:
+                    result = int((_signed(rs1, 64) < _signed(rs2, 64)) if funct3 == 2 else (rs1 < rs2))
+            elif opcode == 0x33 and funct7 == 0x01 and funct3 == 0:
+                result = rs1 * rs2
+            elif opcode == 0x0f:
+                pass
+            else:
+                raise UnsupportedInstruction(f"0x{instruction:08x} at 0x{pc:x}")
+
+            if result is not None and rd != 0:
+                x[rd] = result & _XLEN_MASK
+            pc = next_pc & _XLEN_MASK
+        return messages, False
+
+class FpgaHostEmulator:
+    """
+    Stands in for an Arty board running bp_fpga_host behind a pseudo-terminal, so that host.py
+    and uart.py can connect to "port_name" unmodified. With device="memory" it serves an
+    in-process memory transport instead, named "memory://...", which takes the operating system
+    out of the measurement.
+
+    Timing is modeled rather than measured: every byte the host writes arrives at the configured
+    line rate, commands wait in a receive buffer of rx_buffer_bytes plus nbf_buffer_els commands
+    and are processed at commands_per_second, memory commands take latency_seconds to respond,
+    and responses leave at line rate through a transmit buffer of tx_buffer_bytes, stalling the
+    command processor while it is full. A command arriving to a full receive buffer is dropped
+    and sets rd_error, as bp_fpga_host_io_in does on a UART overflow; the model drops whole
+    commands rather than single bytes, so that the stream stays framed.
+
+    Unfreezing the core (writing 0 to the freeze CSR) runs the loaded program on a CoreModel
+    if it stays within the modeled instruction subset. Other programs are replaced by a stand-in,
+    which prints "program_output" and reports its core done.
+    """
+    def __init__(self, config: EmulatorConfig = EmulatorConfig(), device: str = 'pty'):
+        self.config = config
+        self.model = FpgaHostModel(config.ctrl_reset, config.burst_writes)
+        self._decoder = NbfStreamDecoder(config.burst_writes)
+
+        self._memory: Optional[MemoryPort] = None
+        if device == 'memory':
+            self._memory = MemoryPort()
+            self.port_name = self._memory.name
+            self._wake = threading.Event()
+            self._memory.on_connect = self._wake.set
+            self._rx_buffer = bytearray(65536)
+        elif device == 'pty':
+            self._master, self._slave = os.openpty()
+            tty.setraw(self._slave)
+            os.set_blocking(self._master, False)
+            self.port_name = os.ttyname(self._slave)
+            self._wake_r, self._wake_w = os.pipe()
+        else:
+            raise ValueError(f"unknown emulator device \"{device}\"")
+
+        self._buffered_commands = config.rx_buffer_bytes // NBF_COMMAND_LENGTH_BYTES + config.nbf_buffer_els
+        self._service_seconds = 1 / config.commands_per_second if config.commands_per_second > 0 else 0.0
+        self._rx_line_free = 0.0
+        # start times of admitted commands that may not have left the receive buffer yet
+        self._waiting: Deque[float] = deque()
+        self._busy_until = 0.0
+        self._tx_line_free = 0.0
+        self._last_tx_ready = 0.0
+        self._tx_queue: Deque[Tuple[float, bytes]] = deque()
+        self._tx_out = bytearray()
+
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+        self.commands_received = 0
+        self.commands_by_opcode: Dict[int, int] = {}
+        self.messages_sent = 0
+        self.overflows = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def __enter__(self) -> 'FpgaHostEmulator':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """
+        Serves the pty on a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name="fpga-host-emulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        if self._memory is not None:
+            self._wake.set()
+            if self._memory.device is not None:
+                self._memory.device.cancel_read()
+        else:
+            os.write(self._wake_w, b'\0')
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._memory is not None:
+            self._memory.close()
+        else:
+            for fd in (self._master, self._slave, self._wake_r, self._wake_w):
+                os.close(fd)
+
+    ## Receive
+
+    def _receive(self, data: bytes, now: float):
+        self.bytes_received += len(data)
+        byte_seconds = self.config.byte_seconds
+        if self.config.loopback:
+            self._rx_line_free = max(now, self._rx_line_free) + len(data) * byte_seconds
+            self._transmit(data, self._rx_line_free)
+            return
+
+        for command, length in self._decoder.feed(data):
+            self._rx_line_free = max(now, self._rx_line_free) + length * byte_seconds
+            self._admit(command, self._rx_line_free)
+
+    def _admit(self, command: NbfCommand, arrival: float):
+        self.commands_received += 1
+        self.commands_by_opcode[command.opcode] = self.commands_by_opcode.get(command.opcode, 0) + 1
+
+        waiting = self._waiting
+        while waiting and waiting[0] <= arrival:
+            waiting.popleft()
+        injected = self.config.overflow_every > 0 and self.commands_received % self.config.overflow_every == 0
+        if injected or len(waiting) >= self._buffered_commands:
+            self.overflows += 1
+            self.model.flag_read_error()
+            return
+
+        start = max(arrival, self._busy_until)
+        self._busy_until = start + self._service_seconds
+        waiting.append(start)
+
+        ready = self._busy_until
+        if command.opcode in MEMORY_OPCODES or command.opcode == OPCODE_FENCE:
+            # a fence completes once every memory command before it has
+            ready += self.config.latency_seconds
+        for message in self.model.execute(command):
+            self._transmit(message.to_bytes(), ready)
+
+        if command.matches(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0):
+            self._run_program(ready)
+
+    def _run_program(self, start: float):
+        config = self.config
+        try:
+            messages, done = CoreModel(self.model).run()
+        except UnsupportedInstruction:
+            pass
+        else:
+            for message in messages:
+                self._transmit(message.to_bytes(), start + config.program_seconds)
+            return
+
+        step = config.program_seconds / (len(config.program_output) + 1)
+        for i, character in enumerate(config.program_output):
+            message = NbfCommand.with_values(OPCODE_PUTCH, FPGA_HOST_ADDRESS, character)
+            self._transmit(message.to_bytes(), start + (i + 1) * step)
+        message = NbfCommand.with_values(OPCODE_CORE_DONE, 0, 0)
+        self._transmit(message.to_bytes(), start + config.program_seconds)
+
+    ## Transmit
+
+    def _transmit(self, buffer: bytes, ready: float):
+        byte_seconds = self.config.byte_seconds
+        ready = max(ready, self._last_tx_ready)
+        finish = max(ready, self._tx_line_free) + len(buffer) * byte_seconds
+        # while the transmit buffer is full, the command processor cannot hand over responses
+        buffer_drained = finish - self.config.tx_buffer_bytes * byte_seconds
+        if buffer_drained > ready:
+            self._busy_until = max(self._busy_until, buffer_drained)
+
+        self._last_tx_ready = ready
+        self._tx_line_free = finish
+        self._tx_queue.append((finish, buffer))
+        self.messages_sent += 1
+
+    def _flush_transmit(self, now: float):
+        tx_queue = self._tx_queue
+        while tx_queue and tx_queue[0][0] <= now:
+            self._tx_out += tx_queue.popleft()[1]
+        if self._tx_out:
+            written = self._write_device(self._tx_out)
+            self.bytes_sent += written
+            del self._tx_out[:written]
+
+    ## Device
+
+    def _write_device(self, data: bytearray) -> int:
+        if self._memory is not None:
+            device = self._memory.device
+            try:
+                return device.try_write(data) if device is not None else len(data)
+            except BrokenPipeError:
+                # the host has gone; what it did not read is lost, as on a real line
+                return len(data)
+        try:
+            return os.write(self._master, data)
+        except BlockingIOError:
+            return 0
+
+    def _wait_device(self, receive: bool, timeout: float) -> bytes:
+        """
+        Waits up to "timeout" seconds, for input if "receive" is set, or until the device can take
+        more output, and returns whatever input arrived.
+        """
+        if self._memory is not None:
+            device = self._memory.device
+            if self._tx_out:
+                timeout = min(timeout, MEMORY_TX_RETRY_SECONDS)
+            if not receive or device is None or not device.is_open:
+                # until a host connects, or the transmit buffer drains
+                self._wake.wait(timeout)
+                self._wake.clear()
+                return b''
+            device.timeout = timeout
+            return bytes(self._rx_buffer[:device.read_into(self._rx_buffer)])
+
+        readers = [self._wake_r, self._master] if receive else [self._wake_r]
+        writers = [self._master] if self._tx_out else []
+        readable, _, _ = select.select(readers, writers, [], timeout)
+        if self._master not in readable:
+            return b''
+        try:
+            return os.read(self._master, 65536)
+        except BlockingIOError:
+            return b''
+
+    ## Main loop
+
+    def serve_forever(self):
+        read_ahead_seconds = self.config.read_ahead_bytes * self.config.byte_seconds
+        while not self._stopping:
+            now = time.perf_counter()
+            self._flush_transmit(now)
+
+            timeout = EMULATOR_POLL_SECONDS
+            if self._tx_queue:
+                timeout = min(timeout, self._tx_queue[0][0] - now)
+            backlog_seconds = self._rx_line_free - now
+            receive = backlog_seconds < read_ahead_seconds
+            if not receive:
+                timeout = min(timeout, backlog_seconds - read_ahead_seconds)
+
+            data = self._wait_device(receive, max(0.0, timeout))
+            if data:
+                self._receive(data, time.perf_counter())
+
+    def format_statistics(self) -> List[str]:
+        lines = [
+            f"Received: {self.commands_received} commands ({self.bytes_received} bytes)",
+            f"Sent:     {self.messages_sent} messages ({self.bytes_sent} bytes)",
+            f"Overflows: {self.overflows} commands dropped",
+        ]
+        for opcode in sorted(self.commands_by_opcode):
+            lines.append(f" {opcode_name(opcode):<10} {self.commands_by_opcode[opcode]}")
+        return lines
+
+def _config_from_args(args) -> EmulatorConfig:
+    return EmulatorConfig(
+        baud=args.baud_rate,
+        commands_per_second=args.commands_per_second,
+        latency_seconds=args.latency_us / 1e6,
+        rx_buffer_bytes=args.rx_buffer_bytes,
+        tx_buffer_bytes=args.tx_buffer_bytes,
+        nbf_buffer_els=args.nbf_buffer_els,
+        ctrl_reset=(1 << CTRL_BIT_WRITE_RESP) if args.write_responses else 0,
+        burst_writes=not args.no_burst_writes,
+        overflow_every=args.overflow_every,
+        program_output=args.program_output.encode('utf-8').decode('unicode_escape').encode('latin-1'),
+        program_seconds=args.program_seconds,
+        loopback=args.loopback,
+    )
+
+def _argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Emulate an FPGA host on a pseudo-terminal, for testing host.py and uart.py without a board. Run \"emulator.py self-test\" for its self-tests.")
+    parser.add_argument('-b', '--baud', dest='baud_rate', type=int, default=1000000, help='Emulated line rate')
+    parser.add_argument('--commands-per-second', type=float, default=0.0, dest='commands_per_second', help='Rate at which buffered commands are processed (0 for no limit)')
+    parser.add_argument('--latency-us', type=float, default=0.0, dest='latency_us', help='Memory command latency in microseconds')
+    parser.add_argument('--rx-buffer-bytes', type=int, default=256, dest='rx_buffer_bytes', help='UART receive buffer size (uart_rx_buffer_els_p)')
+    parser.add_argument('--tx-buffer-bytes', type=int, default=256, dest='tx_buffer_bytes', help='UART transmit buffer size (uart_tx_buffer_els_p)')
+    parser.add_argument('--nbf-buffer-els', type=int, default=4, dest='nbf_buffer_els', help='NBF command buffer entries (nbf_buffer_els_p)')
+    parser.add_argument('--write-responses', action='store_true', dest='write_responses', help='Start with write responses enabled, as uart.py expects')
+    parser.add_argument('--no-burst-writes', action='store_true', dest='no_burst_writes', help='Emulate an FPGA host without burst write support')
+    parser.add_argument('--overflow-every', type=int, default=0, dest='overflow_every', help='Drop every Nth command as a receive overflow (0 to disable)')
+    parser.add_argument('--program-output', type=str, default='', dest='program_output', help='Text the program prints once unfrozen (backslash escapes allowed)')
+    parser.add_argument('--program-seconds', type=float, default=0.0, dest='program_seconds', help='Time the program runs before its core reports done')
+    parser.add_argument('--loopback', action='store_true', dest='loopback', help='Echo received bytes, like the UART loopback design used by "uart.py -m test"')
+    parser.add_argument('--link', type=str, default=None, dest='link', help='Also make the pty available at this path')
+    return parser
+
+if __name__ == '__main__' and sys.argv[1:2] == ['self-test']:
+    import unittest
+    import numpy as np
+    from transport import Transport, open_transport
+    from nbf import NbfArray, encode_bursts
+
+    class TestFpgaHostModel(unittest.TestCase):
+        def test_memory(self):
+            model = FpgaHostModel()
+            self.assertEqual(model.execute(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 0x1122334455667788)), [])
+            model.execute(NbfCommand.with_values(OPCODE_WRITE_4, 0x80000004, 0xaabbccdd))
+            reply, = model.execute(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 0))
+            self.assertEqual(reply.data_int, 0xaabbccdd55667788)
+            reply, = model.execute(NbfCommand.with_values(OPCODE_READ_4, 0x80000000, 0))
+            self.assertEqual(reply, NbfCommand.with_values(OPCODE_READ_4, 0x80000000, 0x55667788))
+
+        def test_control_register(self):
+            reply, = FpgaHostModel().execute(NbfCommand.with_values(OPCODE_CTRL_READ, 0, 0))
+            self.assertEqual(reply.data_int, 1 << CTRL_BIT_BURST_WRITE)
+
+            model = FpgaHostModel(burst_writes=False)
+            model.execute(NbfCommand.with_values(OPCODE_CTRL_SET, 1 << CTRL_BIT_WRITE_RESP, 0))
+            reply, = model.execute(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 5))
+            self.assertEqual(reply, NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 0))
+
+            model.flag_read_error()
+            reply, = model.execute(NbfCommand.with_values(OPCODE_CTRL_READ, 0, 0))
+            self.assertEqual(reply.data_int, (1 << CTRL_BIT_WRITE_RESP) | (1 << CTRL_BIT_READ_ERROR))
+            reply, = model.execute(NbfCommand.with_values(OPCODE_CTRL_READ, 0, 0))
+            self.assertEqual(reply.data_int, 1 << CTRL_BIT_WRITE_RESP)
+
+            model.execute(NbfCommand.with_values(OPCODE_CTRL_CLEAR, 1 << CTRL_BIT_WRITE_RESP, 0))
+            self.assertEqual(model.execute(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 5)), [])
+
+    class TestFpgaHostEmulator(unittest.TestCase):
+        def _open(self, emulator: FpgaHostEmulator) -> Transport:
+            return open_transport(emulator.port_name, emulator.config.baud, timeout=2.0)
+
+        def test_round_trip(self):
+            config = EmulatorConfig(program_output=b'hi', latency_seconds=0.001)
+            for device in ('pty', 'memory'):
+                with self.subTest(device=device), FpgaHostEmulator(config, device) as emulator:
+                    port = self._open(emulator)
+                    commands = [
+                        NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 42),
+                        NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 0),
+                        NbfCommand.with_values(OPCODE_FENCE, 0, 0),
+                        NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0),
+                    ]
+                    port.write(b''.join(command.to_bytes() for command in commands))
+                    replies = NbfCommand.from_buffer(port.read(5 * NBF_COMMAND_LENGTH_BYTES))
+                    port.close()
+
+                    self.assertEqual([reply.opcode for reply in replies], [OPCODE_READ_8, OPCODE_FENCE, OPCODE_PUTCH, OPCODE_PUTCH, OPCODE_CORE_DONE])
+                    self.assertEqual(replies[0].data_int, 42)
+                    self.assertEqual(bytes(reply.data[0] for reply in replies[2:4]), b'hi')
+
+        def test_host_over_memory(self):
+            from host import HostApp
+            program = NbfArray.dram_writes(range(1000))
+            with FpgaHostEmulator(EmulatorConfig(baud=100_000_000), 'memory') as emulator:
+                app = HostApp(emulator.port_name, emulator.config.baud)
+                app.show_progress = False
+                app.run_engine(lambda engine: engine.load(program))
+                app.close_port()
+            self.assertEqual(emulator.model.memory[0x80000000 + 8 * 999], 999)
+
+        def test_listen_rate_report(self):
+            import asyncio
+            from host import HostApp, set_log_output, set_log_tag
+            lines = []
+
+            async def listen(engine):
+                # the report goes wherever the caller's log lines go, tagged like them
+                set_log_tag('board')
+                set_log_output(lines.append)
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(engine.listen(report_seconds=0.02), 0.1)
+
+            with FpgaHostEmulator(EmulatorConfig(baud=100_000_000), 'memory') as emulator:
+                app = HostApp(emulator.port_name, emulator.config.baud)
+                app.run_engine(listen, listen=True)
+                app.close_port()
+            self.assertTrue(any(line.endswith("board: 0 frames/s") for line in lines))
+
+        def test_resumed_load(self):
+            import tempfile
+            from host import HostApp
+            from checkpoint import LoadCheckpoint, program_digest
+            program = NbfArray.concatenate(NbfArray.dram_writes(range(1000)), NbfArray.from_rows([(OPCODE_FENCE, 0, 0)]))
+            with tempfile.TemporaryDirectory() as directory, FpgaHostEmulator(EmulatorConfig(baud=100_000_000), 'memory') as emulator:
+                checkpoint = LoadCheckpoint.for_board('board', directory)
+                app = HostApp(emulator.port_name, emulator.config.baud)
+                app.show_progress = False
+
+                def load(resume: bool) -> int:
+                    emulator.commands_by_opcode.clear()
+                    app.run_engine(lambda engine: engine.load(program, checkpoint=checkpoint, resume=resume, checkpoint_commands=300))
+                    return emulator.commands_by_opcode[OPCODE_WRITE_8]
+
+                self.assertEqual(load(False), 1000)
+                # fences after 300, 600 and 900 commands, and the program's own
+                self.assertEqual(emulator.commands_by_opcode[OPCODE_FENCE], 4)
+                self.assertEqual(os.listdir(directory), [])
+
+                # a load that stopped after its fence at 600 commands
+                checkpoint.start(program_digest(program), len(program), 600)
+                emulator.model.memory[0x80000000 + 8 * 999] = 0
+                self.assertEqual(load(True), 400)
+                self.assertEqual(emulator.model.memory[0x80000000 + 8 * 999], 999)
+
+                # the board was reset since, so the boundary reads do not match
+                checkpoint.start(program_digest(program), len(program), 600)
+                emulator.model.memory.clear()
+                self.assertEqual(load(True), 1000)
+                app.close_port()
+
+        def test_manifest_invalidation(self):
+            import tempfile
+            from host import HostApp
+            from manifest import BoardManifest
+            from memtest import MemoryRange
+            program = NbfArray.dram_writes(range(1000))
+            unfreeze = NbfArray.from_rows([(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0)])
+            with tempfile.TemporaryDirectory() as directory, FpgaHostEmulator(EmulatorConfig(baud=100_000_000), 'memory') as emulator:
+                app = HostApp(emulator.port_name, emulator.config.baud)
+                app.show_progress = False
+                app.manifest = BoardManifest.for_board('board', directory)
+
+                def load(source: NbfArray, incremental: bool = False, spot_check_blocks: int = 4) -> int:
+                    emulator.commands_by_opcode.clear()
+                    app.run_engine(lambda engine: engine.load(source, manifest=app.manifest, incremental=incremental, spot_check_blocks=spot_check_blocks))
+                    return emulator.commands_by_opcode.get(OPCODE_WRITE_8, 0)
+
+                # an edit-compile-run loop: each load unfreezes the core, and the next one only
+                # sends the block that was edited, besides the unfreeze itself
+                self.assertEqual(load(NbfArray.concatenate(program, unfreeze)), 1001)
+                self.assertEqual(len(BoardManifest.for_board('board', directory)), 125)
+                edited = NbfArray.dram_writes([7 if i == 500 else i for i in range(1000)])
+                self.assertEqual(load(NbfArray.concatenate(edited, unfreeze), incremental=True), 8 + 1)
+                self.assertEqual(emulator.model.memory[0x80000000 + 8 * 500], 7)
+                app.run_engine(lambda engine: engine.unfreeze())
+                self.assertEqual(load(NbfArray.concatenate(program, unfreeze), incremental=True), 8 + 1)
+
+                # the core overwrote a block once it ran, which the spot checks catch
+                emulator.model.memory[0x80000000 + 8 * 300] = 0
+                self.assertEqual(load(program, incremental=True, spot_check_blocks=125), 1000)
+                self.assertEqual(emulator.model.memory[0x80000000 + 8 * 300], 300)
+
+                # the memory test overwrites a block the spot checks are unlikely to pick
+                app.test_memory(ranges=[MemoryRange(0x80000000 + 8 * 500, 8)], patterns=['random'])
+                self.assertEqual(len(BoardManifest.for_board('board', directory)), 0)
+                self.assertEqual(load(program, incremental=True), 1000)
+                self.assertEqual(emulator.model.memory[0x80000000 + 8 * 500], 500)
+                app.close_port()
+
+        def test_burst_writes(self):
+            writes = NbfArray.from_values(OPCODE_WRITE_8, 0x80000000 + 8 * np.arange(20, dtype=np.uint64), np.arange(20, dtype=np.uint64) + np.uint64(100))
+            with FpgaHostEmulator() as emulator:
+                port = self._open(emulator)
+                port.write(encode_bursts(writes).tobytes() + NbfCommand.with_values(OPCODE_READ_8, 0x80000000 + 8 * 19, 0).to_bytes())
+                reply = NbfCommand.from_bytes(port.read(NBF_COMMAND_LENGTH_BYTES))
+                port.close()
+
+            self.assertEqual(reply.data_int, 119)
+            self.assertEqual(emulator.commands_by_opcode, {OPCODE_WRITE_8: 20, OPCODE_READ_8: 1})
+
+        def test_burst_probe_reports_errors(self):
+            from host import HostApp, set_log_output
+            lines = []
+
+            async def probe(engine):
+                set_log_output(lines.append)
+                return await engine.probe_burst_writes()
+
+            # an error flagged before the host connected is cleared by the probe's read
+            with FpgaHostEmulator(EmulatorConfig(baud=100_000_000, ctrl_reset=1 << CTRL_BIT_READ_ERROR), 'memory') as emulator:
+                app = HostApp(emulator.port_name, emulator.config.baud)
+                self.assertTrue(app.run_engine(probe))
+                app.close_port()
+            self.assertEqual(app.metrics.ctrl_errors['rd_error'], 1)
+            self.assertTrue(any("reported rd_error before the load" in line for line in lines))
+
+        def test_line_rate_and_overflow(self):
+            # 1400 bytes take 0.14 seconds at 100 kbaud, and a slow command processor overflows
+            config = EmulatorConfig(baud=100000, commands_per_second=200)
+            with FpgaHostEmulator(config) as emulator:
+                port = self._open(emulator)
+                start = time.perf_counter()
+                port.write(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 0).to_bytes() * 100)
+                port.write(NbfCommand.with_values(OPCODE_CTRL_READ, 0, 0).to_bytes())
+                replies = NbfCommand.from_buffer(port.read((100 + 1) * NBF_COMMAND_LENGTH_BYTES))
+                elapsed = time.perf_counter() - start
+                port.close()
+
+            self.assertGreater(emulator.overflows, 0)
+            self.assertEqual(len(replies), 101 - emulator.overflows)
+            self.assertEqual(replies[-1].opcode, OPCODE_CTRL_READ)
+            self.assertTrue(replies[-1].data_int & (1 << CTRL_BIT_READ_ERROR))
+            self.assertGreater(elapsed, 0.14)
+
+        def test_link_characterization(self):
+            import uart
+            args = argparse.Namespace(baud=1000000, bauds=None, burst=1000, bursts=[64, 1024], bits=8, parity='none', stopbits=1, timeout=2.0, iters=3, probes=5)
+            with FpgaHostEmulator(EmulatorConfig(loopback=True)) as emulator:
+                port = self._open(emulator)
+                result, = uart.characterizeLink(port, args)
+                port.close()
+
+            self.assertEqual(result['probes']['rtt_us']['count'], 5)
+            self.assertEqual([step['burst_bytes'] for step in result['bursts']], [64, 1024])
+            for step in result['bursts']:
+                self.assertEqual(step['bytes_received'], step['bytes_sent'])
+                self.assertEqual((step['frames_lost'], step['bytes_lost'], step['bytes_duplicated'], step['bytes_corrupted']), (0, 0, 0, 0))
+
+            # a dropped byte costs its frame, and a repeated frame is seen once
+            frames = [uart.encodeLinkFrame(uart.LINK_FRAME_BURST, seq, 0) for seq in range(4)]
+            decoder = uart.LinkFrameDecoder()
+            received = decoder.feed(frames[0] + frames[1][:5] + frames[1][6:] + frames[2] + frames[2] + frames[3])
+            self.assertEqual([seq for _, seq, _ in received], [0, 2, 2, 3])
+            self.assertEqual(decoder.corruptBytes, uart.LINK_FRAME_BYTES - 1)
+
+        def test_injected_overflow(self):
+            config = EmulatorConfig(overflow_every=3)
+            with FpgaHostEmulator(config) as emulator:
+                port = self._open(emulator)
+                port.write(NbfCommand.with_values(OPCODE_FENCE, 0, 0).to_bytes() * 9)
+                replies = NbfCommand.from_buffer(port.read(6 * NBF_COMMAND_LENGTH_BYTES))
+                port.close()
+            self.assertEqual(len(replies), 6)
+            self.assertEqual(emulator.overflows, 3)
+
+    unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+
+elif __name__ == "__main__":
+    args = _argument_parser().parse_args()
+
+    emulator = FpgaHostEmulator(_config_from_args(args))
+    port_name = emulator.port_name
+    if args.link:
+        if os.path.lexists(args.link):
+            os.remove(args.link)
+        os.symlink(emulator.port_name, args.link)
+        port_name = args.link
+    print(f"Emulating FPGA host on {port_name}", flush=True)
+
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link:
+            os.remove(args.link)
+        for line in emulator.format_statistics():
+            print(line)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import time
+import queue
+import asyncio
+import argparse
+import multiprocessing
+
+from multiprocessing import shared_memory
+from typing import List, NamedTuple, Optional, Tuple
+
+from tqdm import tqdm
+
+from nbf import NbfArray, NbfCommand, ADDRESS_CSR_FREEZE, OPCODE_WRITE_8
+from host import HostApp, HostEngine, ConsoleSink, LogDomain, add_image_arguments, add_image_cache_arguments, configure_image_cache, log, parse_window_size, set_log_tag
+from host import DEFAULT_CONSOLE_FLUSH_SECONDS, DEFAULT_TX_BUFFER_BYTES
+from checksum import DEFAULT_CHECKSUM_BLOCK_WORDS, DEFAULT_CHECKSUM_SCRATCH_ADDRESS
+from images import open_program
+from manifest import BoardManifest
+from checkpoint import LoadCheckpoint
+
+# how often the aggregated progress bar is refreshed
+FARM_PROGRESS_SECONDS = 0.1
+
+def expand_ports(specs: List[str]) -> List[str]:
+    """
+    Expands port names, comma-separated lists and glob patterns into a list of distinct ports.
+    """
+    ports: List[str] = []
+    for spec in specs:
+        for name in spec.split(','):
+            matches = sorted(glob.glob(name)) if glob.has_magic(name) else [name]
+            ports += [port for port in matches if port and port not in ports]
+    return ports
+
+class BoardResult(NamedTuple):
+    name: str
+    elapsed: float
+    commands_sent: int
+    bytes_written: int
+    reply_violations: int
+    mismatched: int
+    backoffs: int
+    # corrupt words found by verify, if it ran
+    corrupted: Optional[int]
+    # status the core reported when it finished, if listening
+    core_status: Optional[int]
+    error: Optional[str]
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None or bool(self.corrupted) or bool(self.core_status) or bool(self.reply_violations) or bool(self.mismatched)
+
+    def __str__(self):
+        rate = self.bytes_written / self.elapsed if self.elapsed > 0 else 0.0
+        parts = [
+            f"{self.name:<14} {self.elapsed:7.2f} s",
+            f"{self.commands_sent:>9} sent",
+            f"{rate:>9.0f} B/s",
+            f"{self.reply_violations} violations ({self.mismatched} mismatched)",
+            f"{self.backoffs} backoffs",
+        ]
+        if self.corrupted is not None:
+            parts.append(f"{self.corrupted} corrupt words")
+        if self.core_status is not None:
+            parts.append("PASS" if self.core_status == 0 else f"FAIL, code {self.core_status}")
+        if self.error is not None:
+            parts.append(f"FAILED: {self.error}")
+        return ", ".join(parts)
+
+class _EventLines:
+    """
+    Sends whatever a worker writes to the farm's event queue a line at a time, as ("log", index,
+    text) for its log and ("output", index, bytes) for what its board prints. It serves as the
+    worker's sys.stdout and as the stream of its ConsoleSink.
+    """
+    def __init__(self, events: multiprocessing.Queue, index: int, kind: str):
+        self.events = events
+        self.index = index
+        self.kind = kind
+        self._partial = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._partial += data
+        end = self._partial.rfind(b'\n') + 1
+        for line in self._partial[:end].splitlines():
+            self.events.put((self.kind, self.index, bytes(line)))
+        del self._partial[:end]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._partial:
+            self.write(b'\n')
+
+class FarmBoard:
+    """
+    One board of the farm, driven by its own HostApp and HostEngine in a worker process.
+    """
+    def __init__(self, index: int, port: str, args, progress, events: multiprocessing.Queue):
+        self.index = index
+        self.port = port
+        self.name = os.path.basename(port) or port
+        self.args = args
+        self.progress = progress
+        self.events = events
+        self.app: Optional[HostApp] = None
+        self.corrupted: Optional[int] = None
+        self.core_status: Optional[int] = None
+
+    def run(self, program: NbfArray) -> BoardResult:
+        args = self.args
+        set_log_tag(self.name)
+        start = time.perf_counter()
+        error = None
+        try:
+            self.app = HostApp(serial_port_name=self.port, serial_port_baud=args.baud_rate, timeout=args.timeout, tx_buffer_bytes=args.tx_buffer_bytes)
+            self.app.show_progress = False
+            self.app.manifest = BoardManifest.for_board(self.port, args.manifest_dir)
+            console = self._console() if args.listen else None
+            try:
+                self.app.run_engine(lambda engine: self._operation(engine, program), listen=args.listen, console=console)
+            finally:
+                if console is not None:
+                    console.close()
+                self.app.close_port()
+        except Exception as e:
+            error = str(e)
+            log(LogDomain.COMMAND, f"Failed: {e}")
+        elapsed = time.perf_counter() - start
+
+        app = self.app
+        if app is None:
+            return BoardResult(self.name, elapsed, 0, 0, 0, 0, 0, None, None, error)
+        self.progress[self.index] = app.commands_sent
+        return BoardResult(
+            name=self.name,
+            elapsed=elapsed,
+            commands_sent=app.commands_sent,
+            bytes_written=app.transmit.bytes_written,
+            reply_violations=app.reply_violations,
+            mismatched=sum(stats.mismatched for stats in app.reply_stats.values()),
+            backoffs=sum(app.window.backoffs.values()),
+            corrupted=self.corrupted,
+            core_status=self.core_status,
+            error=error,
+        )
+
+    def _console(self) -> ConsoleSink:
+        if self.args.output_dir:
+            os.makedirs(self.args.output_dir, exist_ok=True)
+            return ConsoleSink.open(os.path.join(self.args.output_dir, self.name + '.log'), self.args.flush_seconds)
+        return ConsoleSink(_EventLines(self.events, self.index, 'output'), self.args.flush_seconds)
+
+    async def _report_progress(self):
+        while True:
+            self.progress[self.index] = self.app.commands_sent
+            await asyncio.sleep(FARM_PROGRESS_SECONDS)
+
+    async def _operation(self, engine: HostEngine, program: NbfArray):
+        reporter = asyncio.ensure_future(self._report_progress())
+        try:
+            await self._run_steps(engine, program)
+        finally:
+            reporter.cancel()
+
+    async def _run_steps(self, engine: HostEngine, program: NbfArray):
+        args = self.args
+        await engine.load(
+            program,
+            ignore_unfreezes=args.no_unfreeze or args.verify,
+            sliding_window_num_commands=args.window_size,
+            write_responses=args.write_responses,
+            manifest=self.app.manifest,
+            incremental=args.incremental,
+            spot_check_blocks=args.spot_checks,
+            bursts=not args.no_bursts,
+            checkpoint=LoadCheckpoint.for_board(self.port, args.checkpoint_dir),
+            resume=args.resume,
+        )
+
+        if args.verify:
+            if args.checksum:
+                self.corrupted = await engine.verify_checksums(program, args.window_size, args.checksum_scratch, args.checksum_block_words)
+            else:
+                self.corrupted = await engine.verify(program, args.window_size)
+            if self.corrupted > 0:
+                log(LogDomain.COMMAND, "Not unfreezing a corrupted program")
+                return
+            unfreeze_command = NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0)
+            if not args.no_unfreeze and program.command_mask(unfreeze_command).any():
+                await engine.unfreeze()
+
+        if args.listen:
+            self.core_status = await engine.listen()
+
+def _board_worker(index: int, port: str, image_name: str, image_length: int, args, progress, events: multiprocessing.Queue):
+    """
+    Worker process entry point: drives one board with the image in shared memory.
+    """
+    sys.stdout = _EventLines(events, index, 'log')
+    image = shared_memory.SharedMemory(name=image_name)
+    try:
+        program = NbfArray.from_bytes(image.buf[:image_length])
+        result = FarmBoard(index, port, args, progress, events).run(program)
+        del program
+        sys.stdout.close()
+        events.put(('result', index, result))
+    finally:
+        image.close()
+
+def board_commands(program: NbfArray, args) -> int:
+    """
+    The commands each board is sent for the progress bar: the program, and with "verify" a read
+    of each word the program leaves in DRAM.
+    """
+    commands = len(program)
+    if args.verify and not args.checksum:
+        commands += len(program.final_dram_words()[0])
+    return commands
+
+def run_farm(ports: List[str], program: NbfArray, args) -> Tuple[List[BoardResult], float]:
+    """
+    Runs every board at once, one worker process each, sharing one copy of the encoded program.
+    Shows their combined progress and output. Returns each board's result and the elapsed time.
+    """
+    names = [os.path.basename(port) or port for port in ports]
+    commands_per_board = board_commands(program, args)
+
+    wire = program.wire
+    image = shared_memory.SharedMemory(create=True, size=max(1, len(wire)))
+    image.buf[:len(wire)] = wire
+    progress = multiprocessing.Array('q', len(ports), lock=False)
+    events = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_board_worker, args=(index, port, image.name, len(wire), args, progress, events), name=f"farm-{names[index]}", daemon=True)
+        for index, port in enumerate(ports)
+    ]
+
+    results: List[Optional[BoardResult]] = [None] * len(ports)
+    start = time.perf_counter()
+    try:
+        for worker in workers:
+            worker.start()
+        with tqdm(total=commands_per_board * len(ports), desc=f"{len(ports)} boards", unit="cmd") as bar:
+            while any(result is None for result in results):
+                try:
+                    kind, index, payload = events.get(timeout=FARM_PROGRESS_SECONDS)
+                except queue.Empty:
+                    for index, worker in enumerate(workers):
+                        if results[index] is None and not worker.is_alive():
+                            results[index] = BoardResult(names[index], time.perf_counter() - start, 0, 0, 0, 0, 0, None, None, f"worker exited with code {worker.exitcode}")
+                else:
+                    if kind == 'result':
+                        results[index] = payload
+                    elif kind == 'output':
+                        tqdm.write(f"[{names[index]}] {payload.decode('utf-8', errors='replace')}")
+                    else:
+                        tqdm.write(payload.decode('utf-8', errors='replace'))
+                # incremental, resumed and checksummed runs send fewer commands, so a finished
+                # board counts as all of its share
+                bar.update(sum(commands_per_board if result is not None else min(commands_per_board, sent) for result, sent in zip(results, progress)) - bar.n)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        image.close()
+        image.unlink()
+    return results, time.perf_counter() - start
+
+if __name__ == '__main__' and sys.argv[1:2] == ['self-test']:
+    import io
+    import tempfile
+    import unittest
+    from contextlib import redirect_stdout
+    from emulator import EmulatorConfig, FpgaHostEmulator
+    from images import csr_postamble, csr_preamble
+    from nbf_cache import set_default_image_cache
+
+    set_default_image_cache(None)
+
+    class TestFarm(unittest.TestCase):
+        def test_boards(self):
+            program = NbfArray.concatenate(csr_preamble(), NbfArray.dram_writes(range(100)), csr_postamble())
+            with FpgaHostEmulator(EmulatorConfig(program_output=b'hello from a\n')) as first, \
+                    FpgaHostEmulator(EmulatorConfig(program_output=b'hello from b\n')) as second, \
+                    tempfile.TemporaryDirectory() as directory:
+                args = argparse.Namespace(
+                    baud_rate=1000000, timeout=2.0, tx_buffer_bytes=DEFAULT_TX_BUFFER_BYTES, window_size=None,
+                    no_unfreeze=False, no_bursts=False, write_responses=False, verify=True, checksum=False,
+                    incremental=False, spot_checks=0, manifest_dir=directory, resume=False, checkpoint_dir=directory,
+                    listen=True, output_dir=None, flush_seconds=0.01,
+                )
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    results, _ = run_farm([first.port_name, second.port_name], program, args)
+
+            for result in results:
+                self.assertFalse(result.failed, str(result))
+                self.assertEqual((result.corrupted, result.core_status, result.reply_violations), (0, 0, 0))
+            lines = output.getvalue().splitlines()
+            for port, text in ((first.port_name, 'hello from a'), (second.port_name, 'hello from b')):
+                self.assertIn(f"[{os.path.basename(port)}] {text}", lines)
+
+        def test_board_commands(self):
+            # CSR writes and a repeated store are not read back by verify
+            program = NbfArray.concatenate(csr_preamble(), NbfArray.dram_writes(range(100)), NbfArray.dram_writes([7]), csr_postamble())
+            self.assertEqual(board_commands(program, argparse.Namespace(verify=True, checksum=False)), len(program) + 100)
+            self.assertEqual(board_commands(program, argparse.Namespace(verify=True, checksum=True)), len(program))
+            self.assertEqual(board_commands(program, argparse.Namespace(verify=False, checksum=False)), len(program))
+
+        def test_failed(self):
+            result = BoardResult('board', 1.0, 10, 140, 0, 0, 0, 0, 0, None)
+            self.assertFalse(result.failed)
+            self.assertTrue(result._replace(reply_violations=1).failed)
+            self.assertTrue(result._replace(corrupted=2).failed)
+            self.assertTrue(result._replace(core_status=1).failed)
+
+    unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load, verify, run and listen to one program on many boards at once. Run \"farm.py self-test\" for its self-tests.")
+    parser.add_argument('file', help="NBF-formatted file, binary NBF image, .mem file or RISC-V ELF file to load")
+    parser.add_argument('-p', '--ports', dest='ports', action='append', required=True, help='Serial ports: names, comma-separated lists or glob patterns such as "/dev/ttyUSB*" (repeatable)')
+    parser.add_argument('-b', '--baud', dest='baud_rate', type=int, default=1000000, help='Serial port baud rate')
+    parser.add_argument('-t', '--timeout', dest='timeout', type=float, default=3.0, help='Timeout in seconds')
+    parser.add_argument('--tx-buffer-size', type=int, default=DEFAULT_TX_BUFFER_BYTES, dest='tx_buffer_bytes', help='Coalesce outgoing commands into writes of up to this many bytes')
+    add_image_cache_arguments(parser)
+    add_image_arguments(parser)
+    parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Maximum number of outstanding replies per board, or "auto"')
+    parser.add_argument('--no-unfreeze', action='store_true', dest='no_unfreeze', help='Suppress any "unfreeze" commands in the input file')
+    parser.add_argument('--no-bursts', action='store_true', dest='no_bursts', help='Send single writes even if the boards support burst writes')
+    parser.add_argument('--write-responses', action='store_true', dest='write_responses', help='Enable write responses in FPGA Host')
+    parser.add_argument('--verify', action='store_true', dest='verify', help='Verify memory after loading, and only then unfreeze the program')
+    parser.add_argument('--checksum', action='store_true', dest='checksum', help='Verify through checksums computed on the boards')
+    parser.add_argument('--checksum-scratch', type=lambda v: int(v, 0), default=DEFAULT_CHECKSUM_SCRATCH_ADDRESS, dest='checksum_scratch', help='Address of the 1 MiB of DRAM that holds the checksum helper')
+    parser.add_argument('--checksum-block-words', type=int, default=DEFAULT_CHECKSUM_BLOCK_WORDS, dest='checksum_block_words', help='Words of memory summarized by each checksum')
+    parser.add_argument('--incremental', action='store_true', dest='incremental', help='Only send DRAM blocks that differ from what each board was last loaded with')
+    parser.add_argument('--spot-checks', type=int, default=4, dest='spot_checks', help='Number of unchanged blocks to read back before an incremental load trusts a board manifest')
+    parser.add_argument('--manifest-dir', type=str, default=None, dest='manifest_dir', help='Directory of board manifests')
+    parser.add_argument('--resume', action='store_true', dest='resume', help='On each board, only send the commands after the checkpoint of an interrupted load of the same program')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, dest='checkpoint_dir', help='Directory of load checkpoints')
+    parser.add_argument('--listen', action='store_true', dest='listen', help='Print what each board prints, tagged with its port, until every core reports done')
+    parser.add_argument('--output-dir', type=str, default=None, dest='output_dir', help='Write what each board prints to <port>.log in this directory instead of standard output')
+    parser.add_argument('--flush-seconds', type=float, default=DEFAULT_CONSOLE_FLUSH_SECONDS, dest='flush_seconds', help='Longest time printed characters are buffered before being written out')
+    args = parser.parse_args()
+    configure_image_cache(args)
+
+    ports = expand_ports(args.ports)
+    if not ports:
+        parser.error("no serial ports match")
+
+    # parsed and encoded once; every board streams the same records
+    program = open_program(args.file, args.mem_base, args.skip_bss)
+    if not isinstance(program, NbfArray):
+        program = NbfArray.from_file(program)
+    try:
+        results, elapsed = run_farm(ports, program, args)
+    except KeyboardInterrupt:
+        print("Aborted")
+        sys.exit(1)
+
+    total_bytes = sum(result.bytes_written for result in results)
+    log(LogDomain.COMMAND, f"Farm: {len(results)} boards in {elapsed:.2f} s, {total_bytes / elapsed:.0f} B/s combined")
+    for result in results:
+        log(LogDomain.COMMAND, f" {result}")
+    failed = [result.name for result in results if result.failed]
+    if failed:
+        log(LogDomain.COMMAND, f"Failed: {', '.join(failed)}")
+        sys.exit(1)
@@ -1,23 +1,65 @@
 #!/usr/bin/env python3
 
 import sys
+import json
+import time
+import asyncio
 import argparse
+import functools
+import contextvars
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Optional
+from collections import deque
+from typing import Any, Awaitable, BinaryIO, Callable, Deque, Dict, List, Optional, Sequence, Tuple
 
-import serial
+import numpy as np
 from tqdm import tqdm
 
-from nbf import NBF_COMMAND_LENGTH_BYTES, NbfCommand, NbfFile, ADDRESS_CSR_FREEZE
+from nbf import NBF_COMMAND_LENGTH_BYTES, NbfCommand, NbfArray, NbfBinaryFile, ADDRESS_CSR_FREEZE, ADDRESS_BOOT_PC
+from nbf import DRAM_REGION_START, compile_nbf, encode_bursts, save_nbf_binary
 from nbf import ADDRESS_CSR_ICACHE_MODE, ADDRESS_CSR_DCACHE_MODE, ADDRESS_CSR_CCE_MODE
 from nbf import OPCODE_FENCE, OPCODE_FINISH, OPCODE_READ_4, OPCODE_READ_8, OPCODE_WRITE_4, OPCODE_WRITE_8
 from nbf import OPCODE_PUTCH, OPCODE_CORE_DONE, OPCODE_ERROR
 from nbf import OPCODE_CTRL_SET, OPCODE_CTRL_CLEAR, OPCODE_CTRL_WRITE, OPCODE_CTRL_READ
-from nbf import CTRL_BIT_READ_ERROR, CTRL_BIT_WRITE_ERROR, CTRL_BIT_WRITE_RESP
-
-DRAM_REGION_START = 0x00_8000_0000
-DRAM_REGION_END = 0x10_0000_0000
+from nbf import CTRL_BIT_READ_ERROR, CTRL_BIT_WRITE_ERROR, CTRL_BIT_WRITE_RESP, CTRL_BIT_BURST_WRITE
+from replies import OpcodeReplyStats, ReplyStatus, ReplyTracker, format_reply_stats
+from checksum import DEFAULT_CHECKSUM_BLOCK_WORDS, DEFAULT_CHECKSUM_SCRATCH_ADDRESS, helper_program, plan_checksums
+from nbf_cache import DEFAULT_IMAGE_CACHE_BYTES, ImageCache, set_default_image_cache
+from images import open_program
+from manifest import BoardManifest, dram_blocks
+from checkpoint import DEFAULT_CHECKPOINT_COMMANDS, DEFAULT_RESUME_VERIFY_WORDS, LoadCheckpoint, program_digest
+from optimizer import optimize_nbf
+from window import WindowController
+from transport import Transport, open_transport
+from metrics import DEFAULT_METRICS_EXPORT_SECONDS, DEFAULT_METRICS_SAMPLE_SECONDS, HostMetrics
+from memtest import DEFAULT_MEMTEST_PATTERNS, DEFAULT_MEMTEST_REGION_BYTES, MEMTEST_PATTERNS, MemoryRange, MemoryTestReport, ReadBlock, iter_blocks, parse_range, parse_size, pattern_block
+from tracing import DEFAULT_TRACE_EVENTS, TRACK_PARSER, TRACK_READER, TRACK_SENDER, TRACK_WRITER, TraceRecorder, run_profiled
+
+# opcodes the target sends on its own, rather than in reply to a command
+UNSOLICITED_OPCODES = frozenset([OPCODE_PUTCH, OPCODE_CORE_DONE, OPCODE_ERROR])
+
+# number of commands written per port write when streaming a program
+STREAM_CHUNK_COMMANDS = 256
+
+# outgoing commands are coalesced until this many bytes are pending, or a command expects a reply
+DEFAULT_TX_BUFFER_BYTES = 4096
+
+# a lower bound on how fast the checksum helper gets through DRAM, for its timeout
+CHECKSUM_MIN_WORDS_PER_SECOND = 1_000_000
+
+# characters printed by a program are written out once this many are pending, or once the oldest
+# has waited this long
+DEFAULT_CONSOLE_FLUSH_BYTES = 64 * 1024
+DEFAULT_CONSOLE_FLUSH_SECONDS = 0.05
+
+# the engine's reader wakes up at least this often, so it can notice timeouts and shut down
+ENGINE_POLL_SECONDS = 0.05
+# the engine stops producing commands while this many bytes are waiting for the writer
+ENGINE_MAX_QUEUED_TX_BYTES = 64 * 1024
+# the engine's reader takes up to this many bytes from the port per read
+ENGINE_READ_BYTES = 64 * 1024
 
 def _debug_format_message(command: NbfCommand) -> str:
     if command.opcode == OPCODE_PUTCH:
@@ -48,23 +90,206 @@ class LogDomain(Enum):
         else:
             raise ValueError(f"unknown log domain '{self}'")
 
-def _log(domain: LogDomain, message: str):
-    tqdm.write(domain.message_prefix + " " + message)
+# lets threads, or asyncio tasks, that each drive a board tag their log lines with it and send
+# them somewhere other than the terminal; tasks inherit both from the task that created them
+_log_tag: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('log_tag', default=None)
+_log_output: contextvars.ContextVar[Optional[Callable[[str], None]]] = contextvars.ContextVar('log_output', default=None)
+
+def set_log_tag(tag: Optional[str]):
+    """
+    Prefixes the calling thread's or task's log lines with "tag", or stops doing so if it is None.
+    """
+    _log_tag.set(tag)
+
+def set_log_output(write: Optional[Callable[[str], None]]):
+    """
+    Hands the calling thread's or task's log lines to "write" instead of printing them, or prints
+    them again if it is None.
+    """
+    _log_output.set(write)
+
+def _tagged(message: str) -> str:
+    tag = _log_tag.get()
+    return message if tag is None else f"{tag}: {message}"
+
+def _write_line(line: str):
+    write = _log_output.get()
+    if write is None:
+        tqdm.write(line)
+    else:
+        write(line)
+
+def log(domain: LogDomain, message: str):
+    _write_line(domain.message_prefix + " " + _tagged(message))
+
+class TransmitBuffer:
+    """
+    Coalesces outgoing commands into large port writes instead of writing and draining the port
+    once per command. Pending bytes are handed to "sink" when a command that expects a reply is
+    sent, or once more than "flush_threshold_bytes" are pending. A threshold of 0 hands over, and
+    drains, every command individually.
+
+    The sink writes to the port directly by default; HostEngine replaces it so that its writer
+    task performs the port writes. Bytes written, and the time spent writing them, are added to
+    "metrics" if given, and every write is recorded in "trace" if set.
+    """
+    def __init__(self, port: Transport, flush_threshold_bytes: int = DEFAULT_TX_BUFFER_BYTES, metrics: Optional[HostMetrics] = None):
+        self.port = port
+        self.flush_threshold_bytes = flush_threshold_bytes
+        self.metrics = metrics
+        self.trace: Optional[TraceRecorder] = None
+        self.sink: Callable[[Any], None] = self.write
+        self._pending = bytearray()
+
+        self.bytes_written = 0
+        self.port_writes = 0
+        self.first_write_time: Optional[float] = None
+        self.last_write_time: Optional[float] = None
+
+    @property
+    def pending_bytes(self) -> int:
+        return len(self._pending)
+
+    def send(self, buffer, expects_reply: bool):
+        if self.flush_threshold_bytes <= 0 or (not self._pending and len(buffer) >= self.flush_threshold_bytes):
+            # large chunks go straight to the sink rather than through the buffer
+            self.sink(buffer)
+            return
+
+        self._pending += buffer
+        if expects_reply or len(self._pending) >= self.flush_threshold_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands all pending bytes to the sink, without waiting for them to leave the host.
+        """
+        if self._pending:
+            pending, self._pending = self._pending, bytearray()
+            self.sink(pending)
+
+    def drain(self):
+        """
+        Writes all pending bytes and waits until the port has transmitted them.
+        """
+        self.flush()
+        start = time.perf_counter()
+        self.port.flush()
+        if self.trace is not None:
+            self.trace.span('drain', TRACK_WRITER, start, time.perf_counter())
+        if self.last_write_time is not None:
+            self.last_write_time = time.perf_counter()
+
+    def write(self, buffer):
+        """
+        Writes a buffer to the port immediately. With coalescing disabled, also drains it.
+        """
+        now = time.perf_counter()
+        if self.first_write_time is None:
+            self.first_write_time = now
+
+        self.port.write(buffer)
+        if self.flush_threshold_bytes <= 0:
+            self.port.flush()
+        self.bytes_written += len(buffer)
+        self.port_writes += 1
+        self.last_write_time = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.tx_bytes += len(buffer)
+            self.metrics.seconds['port_write'] += self.last_write_time - now
+        if self.trace is not None:
+            self.trace.span('write', TRACK_WRITER, now, self.last_write_time, {'bytes': len(buffer)})
+
+    def link_utilization(self) -> Optional[float]:
+        """
+        Fraction of the elapsed transmit time the line would need to carry the bytes written at
+        the configured baud rate, i.e. how well the link was kept busy.
+        """
+        if self.first_write_time is None or self.last_write_time <= self.first_write_time:
+            return None
+
+        line_seconds = self.bytes_written * self.port.bits_per_byte / self.port.baudrate
+        return min(1.0, line_seconds / (self.last_write_time - self.first_write_time))
+
+class ConsoleSink:
+    """
+    Collects the characters a program prints (putch) and writes them to a terminal, file or
+    pipe in large writes: once "flush_bytes" are pending, or once the oldest pending character
+    is "flush_seconds" old. Text already written to sys.stdout is flushed first, so that log
+    lines and program output stay in order.
+    """
+    def __init__(self, stream: BinaryIO, flush_seconds: float = DEFAULT_CONSOLE_FLUSH_SECONDS, flush_bytes: int = DEFAULT_CONSOLE_FLUSH_BYTES):
+        self.stream = stream
+        self.flush_seconds = flush_seconds
+        self.flush_bytes = flush_bytes
+        self._pending = bytearray()
+        self._pending_since = 0.0
+
+        self.bytes_written = 0
+
+    @staticmethod
+    def open(path: Optional[str], flush_seconds: float = DEFAULT_CONSOLE_FLUSH_SECONDS) -> 'ConsoleSink':
+        """
+        Opens a sink for the file at "path", or for standard output if it is None or "-".
+        """
+        if path is None or path == '-':
+            return ConsoleSink(sys.stdout.buffer, flush_seconds)
+        return ConsoleSink(open(path, 'ab'), flush_seconds)
+
+    def write(self, characters: bytes, now: float):
+        if not characters:
+            return
+        if not self._pending:
+            self._pending_since = now
+        self._pending += characters
+        if len(self._pending) >= self.flush_bytes:
+            self.flush()
+
+    def poll(self, now: float):
+        """
+        Flushes pending characters that have waited for "flush_seconds".
+        """
+        if self._pending and now - self._pending_since >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            sys.stdout.flush()
+            self.stream.write(self._pending)
+            self.stream.flush()
+            self.bytes_written += len(self._pending)
+            self._pending = bytearray()
+
+    def close(self):
+        self.flush()
+        if self.stream is not getattr(sys.stdout, 'buffer', None):
+            self.stream.close()
 
 class HostApp:
-    def __init__(self, serial_port_name: str, serial_port_baud: int, timeout: float = 3.0):
-        self.port = serial.Serial(
-            port=serial_port_name,
-            baudrate=serial_port_baud,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            # Without a timeout, SIGINT can't end the process while we are blocking on a read.
-            timeout=timeout
-        )
+    def __init__(self, serial_port_name: str, serial_port_baud: int, timeout: float = 3.0, tx_buffer_bytes: int = DEFAULT_TX_BUFFER_BYTES):
+        # Without a timeout, SIGINT can't end the process while we are blocking on a read.
+        self.port = open_transport(serial_port_name, serial_port_baud, timeout=timeout)
+        self.metrics = HostMetrics()
+        # while an engine runs, the metrics are rewritten to this file (JSON, or Prometheus text for .prom)
+        self.metrics_path: Optional[str] = None
+        self.metrics_export_seconds = DEFAULT_METRICS_EXPORT_SECONDS
+        # set by start_trace()
+        self.trace: Optional[TraceRecorder] = None
+        self.transmit = TransmitBuffer(self.port, tx_buffer_bytes, self.metrics)
         self.commands_sent = 0
         self.commands_received = 0
         self.reply_violations = 0
+        self.reply_stats: Dict[int, OpcodeReplyStats] = {}
+        # round trip time of every correct reply, in seconds
+        self.reply_latencies = array('d')
+        # sizes adaptive windows; kept across operations so that later ones start from what was learned
+        self.window = WindowController()
+        # draws progress bars for long operations
+        self.show_progress = True
+        # what the board's DRAM was last loaded with; removed by anything else that changes DRAM
+        self.manifest: Optional[BoardManifest] = None
+        # whether the FPGA host accepts burst writes, once a control register read has told
+        self.burst_writes: Optional[bool] = None
         # default behavior is writes do not send replies
         # this can be enabled by setting the
         self.opcodes_expecting_replies = [
@@ -77,38 +302,51 @@ class HostApp:
 
     def close_port(self):
         if self.port.is_open:
+            self.transmit.drain()
             self.port.close()
 
-    def _send_message(self, command: NbfCommand):
-        self.port.write(command.to_bytes())
-        self.port.flush()
-        self.commands_sent += 1
-
-    def _receive_message(self, block=True) -> Optional[NbfCommand]:
-        if block or self.port.in_waiting >= NBF_COMMAND_LENGTH_BYTES:
-            buffer = self.port.read(NBF_COMMAND_LENGTH_BYTES)
-
-            if len(buffer) != NBF_COMMAND_LENGTH_BYTES:
-                raise ValueError(f"serial port returned {len(buffer)} bytes, but {NBF_COMMAND_LENGTH_BYTES} requested")
-
-            self.commands_received += 1
-            return NbfCommand.from_bytes(buffer)
-        else:
-            return None
-
-    def _receive_until_opcode(self, opcode: int, block=True) -> Optional[NbfCommand]:
-        message = self._receive_message(block=block)
-        while message is not None and message.opcode != opcode:
-            _log(LogDomain.RECEIVE, _debug_format_message(message))
-            message = self._receive_message()
+    def run_engine(self, operation: Callable[['HostEngine'], Awaitable[Any]], listen: bool = False, console: Optional[ConsoleSink] = None) -> Any:
+        """
+        Runs "operation" against a started HostEngine for this port on a new event loop, and
+        returns its result. Callers that already run an event loop should use HostEngine directly.
+        """
+        async def run():
+            async with HostEngine(self, listen=listen, console=console) as engine:
+                return await operation(engine)
 
-        return message
+        return asyncio.run(run())
 
     def print_summary_statistics(self):
-        _log(LogDomain.COMMAND, f" Sent:     {self.commands_sent} commands")
-        _log(LogDomain.COMMAND, f" Received: {self.commands_received} commands")
+        log(LogDomain.COMMAND, f" Sent:     {self.commands_sent} commands")
+        log(LogDomain.COMMAND, f" Received: {self.commands_received} commands")
         if self.reply_violations > 0:
-            _log(LogDomain.COMMAND, f" Reply violations: {self.reply_violations} commands")
+            log(LogDomain.COMMAND, f" Reply violations: {self.reply_violations} commands")
+        for line in format_reply_stats(self.reply_stats):
+            log(LogDomain.COMMAND, f"  {line}")
+        if self.window.history:
+            backoffs = ", ".join(f"{count} {reason}" for reason, count in self.window.backoffs.items()) or "none"
+            log(LogDomain.COMMAND, f" Window: {self.window.size} commands, peak {self.window.peak_throughput:.0f} replies/s, backoffs: {backoffs}")
+
+        utilization = self.transmit.link_utilization()
+        if utilization is not None:
+            log(LogDomain.COMMAND, f" Transmit: {self.transmit.bytes_written} bytes in {self.transmit.port_writes} writes, link {utilization:.1%} busy")
+        for line in self.metrics.summary_lines():
+            log(LogDomain.COMMAND, f" {line}")
+
+    def start_trace(self, capacity: int = DEFAULT_TRACE_EVENTS) -> TraceRecorder:
+        """
+        Starts recording a timeline of port writes and reads, parsing, operations and the times
+        they block, keeping the last "capacity" events.
+        """
+        self.trace = self.transmit.trace = TraceRecorder(capacity)
+        return self.trace
+
+    def write_metrics(self):
+        """
+        Writes the metrics to "metrics_path", if set.
+        """
+        if self.metrics_path:
+            self.metrics.write(self.metrics_path)
 
     def _nbf_expects_reply(self, command: NbfCommand):
         """
@@ -142,246 +380,1272 @@ class HostApp:
         else:
             return False
 
-    def _validate_reply(self, command: NbfCommand, reply: NbfCommand) -> bool:
-        if not self._nbf_correct_reply(command, reply):
-            self.reply_violations += 1
-            _log(LogDomain.REPLY, f'Unexpected reply: {command} -> {reply}')
-            # TODO: abort on invalid reply?
-            return False
-        return True
-
-    def _validate_outstanding_replies(self, command_queue_expecting_replies: list, sliding_window_num_commands: int, log_all_rx: bool = False):
-        """
-        Reads replies from the incoming data stream, matching them with the provided command queue
-        in-order and validating each. If more than "sliding_window_num_commands" commands are in the
-        queue, blocks waiting for an incoming command. Pops all validated commands from the front of
-        the queue, in-place.
-        """
-        while len(command_queue_expecting_replies) > 0:
-            sent_command = command_queue_expecting_replies[0]
-
-            is_window_full = len(command_queue_expecting_replies) > sliding_window_num_commands
-            reply = self._receive_until_opcode(
-                sent_command.opcode,
-                block=is_window_full
-            )
-            if reply is None:
-                # all queued packets have been processed
-                break
-
-            if log_all_rx:
-                # TODO: indicate this is an expected reply
-                _log(LogDomain.RECEIVE, _debug_format_message(reply))
-
-            # TODO: verbose/echo mode
-            was_valid = self._validate_reply(sent_command, reply)
-            if was_valid:
-                # TODO: consider aborting on invalid reply
-                command_queue_expecting_replies.pop(0)
-
-    def test_memory(self, verbose: bool = False, sliding_window_num_commands: int = 0, write_responses: bool = False, words: int = 1):
-        command: NbfCommand
-        # configure the system/processor
-        self._send_message(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1))
-        self._send_message(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
-        reply = self._receive_message(block=True)
-        self._send_message(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_ICACHE_MODE, 1))
-        self._send_message(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_DCACHE_MODE, 1))
-        self._send_message(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_CCE_MODE, 1))
-        self._send_message(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
-        reply = self._receive_message(block=True)
-
-        if write_responses:
-          self.opcodes_expecting_replies.extend([OPCODE_WRITE_4, OPCODE_WRITE_8])
-          self._send_message(NbfCommand.with_values(OPCODE_CTRL_SET, CTRL_BIT_WRITE_RESP, 1))
+    def test_memory(self, verbose: bool = False, sliding_window_num_commands: Optional[int] = None, write_responses: bool = False, words: int = 1, ranges: Optional[Sequence[MemoryRange]] = None, patterns: Sequence[str] = DEFAULT_MEMTEST_PATTERNS, seed: int = 0, region_bytes: int = DEFAULT_MEMTEST_REGION_BYTES) -> MemoryTestReport:
+        return self.run_engine(lambda engine: engine.test_memory(
+            verbose=verbose,
+            sliding_window_num_commands=sliding_window_num_commands,
+            write_responses=write_responses,
+            words=words,
+            ranges=ranges,
+            patterns=patterns,
+            seed=seed,
+            region_bytes=region_bytes
+        ))
+
+    def load_file(self, source_file: str, ignore_unfreezes: bool = False, sliding_window_num_commands: Optional[int] = None, log_all_messages: bool = False, write_responses: bool = False, optimize: bool = False, dram_zeroed: bool = False, manifest: Optional[BoardManifest] = None, incremental: bool = False, spot_check_blocks: int = 0, bursts: bool = True, checkpoint: Optional[LoadCheckpoint] = None, resume: bool = False, checkpoint_commands: int = DEFAULT_CHECKPOINT_COMMANDS, resume_verify_words: int = DEFAULT_RESUME_VERIFY_WORDS):
+        return self.run_engine(lambda engine: engine.load(
+            source_file,
+            ignore_unfreezes=ignore_unfreezes,
+            sliding_window_num_commands=sliding_window_num_commands,
+            log_all_messages=log_all_messages,
+            write_responses=write_responses,
+            optimize=optimize,
+            dram_zeroed=dram_zeroed,
+            manifest=manifest,
+            incremental=incremental,
+            spot_check_blocks=spot_check_blocks,
+            bursts=bursts,
+            checkpoint=checkpoint,
+            resume=resume,
+            checkpoint_commands=checkpoint_commands,
+            resume_verify_words=resume_verify_words
+        ))
 
-        outstanding_commands_expecting_replies = []
+    def unfreeze(self):
+        return self.run_engine(lambda engine: engine.unfreeze())
+
+    def listen_perpetually(self, verbose: bool, console: Optional[ConsoleSink] = None, report_seconds: float = 0.0):
+        return self.run_engine(lambda engine: engine.listen(verbose=verbose, report_seconds=report_seconds), listen=True, console=console)
+
+    def verify(self, reference, sliding_window_num_commands: Optional[int] = None):
+        return self.run_engine(lambda engine: engine.verify(reference, sliding_window_num_commands))
+
+def _traced(name: str):
+    """
+    Records each call of a HostEngine operation as a span on the trace's sender track.
+    """
+    def decorate(operation):
+        @functools.wraps(operation)
+        async def traced(self: 'HostEngine', *args, **kwargs):
+            if self.app.trace is None:
+                return await operation(self, *args, **kwargs)
+            with self.app.trace.region(name):
+                return await operation(self, *args, **kwargs)
+        return traced
+    return decorate
+
+class HostEngine:
+    """
+    Full-duplex asyncio driver for a HostApp's port. A writer task and a reader task run at the
+    same time, each doing its blocking port I/O on its own thread. Operations queue commands for
+    the writer and register the replies they expect in a shared ReplyTracker; the reader
+    correlates replies as they arrive, which releases the operations waiting for room in their
+    window.
+
+    Use as "async with HostEngine(app) as engine: await engine.load(...)". Out-of-turn messages
+    are logged as they arrive, unless "listen" is set, in which case they are kept for listen().
+    While listening with a "console", printed characters go straight from the reader to it,
+    decoded in bulk, instead of one message at a time.
+
+    Operations take a "sliding_window_num_commands"; None sizes the window adaptively with the
+    app's WindowController, which is fed every reply's round trip time, reply violations, stalls
+    and the error bits of periodic CTRL_READs.
+    """
+    def __init__(self, app: HostApp, listen: bool = False, console: Optional[ConsoleSink] = None):
+        self.app = app
+        self.listening = listen
+        self.console = console
+        self.frames_received = 0
+        self.log_all_rx = False
+        self.log_read_mismatches = True
+
+        self.replies = ReplyTracker(app._nbf_correct_reply, app.reply_stats)
+        self.window = app.window
+        # set once an operation uses the adaptive window
+        self._adaptive = False
+        self._stalled = False
+        self._failure: Optional[BaseException] = None
+        self._tasks = []
+        # the window the last command that expects a reply was sent with
+        self._window_in_use = self.window.size
+
+    async def __aenter__(self) -> 'HostEngine':
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop(drain=exc_type is None)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._progress = asyncio.Event()
+        self._tx_queue = asyncio.Queue()
+        self._queued_tx_bytes = 0
+        self._unsolicited = asyncio.Queue()
+        self._stopping = False
+        self._last_activity = time.perf_counter()
+
+        self._rx_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="host-rx")
+        # reused by every read; the reader copies out of it before the next one
+        self._rx_buffer = bytearray(ENGINE_READ_BYTES)
+        self._tx_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="host-tx")
+
+        self._saved_port_timeout = self.app.port.timeout
+        self.app.port.timeout = ENGINE_POLL_SECONDS
+        self.app.transmit.sink = self._enqueue_transmit
+
+        self._tasks = [
+            asyncio.ensure_future(self._writer()),
+            asyncio.ensure_future(self._reader()),
+        ]
+        self._sampler_task = asyncio.ensure_future(self._sampler())
+
+    async def stop(self, drain: bool = True):
+        try:
+            if drain and self._failure is None:
+                await self.drain()
+        finally:
+            self._stopping = True
+            self._tx_queue.put_nowait(None)
+            self._sampler_task.cancel()
+            await asyncio.gather(*self._tasks, self._sampler_task, return_exceptions=True)
+            self.app.metrics.sample(time.perf_counter(), len(self.replies), self._window_in_use)
+            self.app.write_metrics()
+            self._rx_executor.shutdown()
+            self._tx_executor.shutdown()
+            self.app.transmit.sink = self.app.transmit.write
+            self.app.port.timeout = self._saved_port_timeout
+
+    def _fail(self, error: BaseException):
+        if self._failure is None:
+            self._failure = error
+        for entry in self.replies:
+            if entry.token is not None and not entry.token.done():
+                entry.token.set_exception(error)
+        self._progress.set()
+        self._unsolicited.put_nowait(None)
+
+    async def _wait_until(self, condition: Callable[[], bool]):
+        """
+        Waits until "condition" holds, re-checking whenever the reader or writer makes progress.
+        Raises the engine's failure, if any.
+        """
+        while True:
+            if self._failure is not None:
+                raise self._failure
+            if condition():
+                return
+            self._progress.clear()
+            await self._progress.wait()
+
+    ## Transmit
+
+    def _enqueue_transmit(self, buffer):
+        self._tx_queue.put_nowait(buffer)
+        self._queued_tx_bytes += len(buffer)
+
+    async def _writer(self):
+        try:
+            while True:
+                buffer = await self._tx_queue.get()
+                if buffer is None:
+                    return
+
+                await self._loop.run_in_executor(self._tx_executor, self.app.transmit.write, buffer)
+                self._queued_tx_bytes -= len(buffer)
+                self._last_activity = time.perf_counter()
+                self._progress.set()
+        except Exception as e:
+            self._fail(e)
+
+    async def _wait_for_writer(self):
+        if self._queued_tx_bytes > ENGINE_MAX_QUEUED_TX_BYTES:
+            wait_start = time.perf_counter()
+            queued = self._queued_tx_bytes
+            await self._wait_until(lambda: self._queued_tx_bytes <= ENGINE_MAX_QUEUED_TX_BYTES)
+            wait_end = time.perf_counter()
+            self.app.metrics.seconds['queue_wait'] += wait_end - wait_start
+            if self.app.trace is not None:
+                self.app.trace.span('queue wait', TRACK_SENDER, wait_start, wait_end, {'queued_bytes': queued})
+
+    async def send_raw(self, buffer, opcodes: np.ndarray):
+        """
+        Queues a buffer of wire-order commands that do not expect replies, given with their
+        opcodes.
+        """
+        self.app.transmit.send(buffer, expects_reply=False)
+        self.app.commands_sent += len(opcodes)
+        self.app.metrics.count_sent(opcodes)
+        await self._wait_for_writer()
 
-        for i in tqdm(range(int(words)), total=words, desc="writing memory"):
-            addr = DRAM_REGION_START + i*8
-            command = NbfCommand.with_values(OPCODE_WRITE_8, addr, i)
-            self._send_message(command)
-            if self._nbf_expects_reply(command):
-                outstanding_commands_expecting_replies.append(command)
-            if verbose:
-                _log(LogDomain.TRANSMIT, _debug_format_message(command))
+    def _window_limit(self, sliding_window_num_commands: Optional[int]) -> int:
+        if sliding_window_num_commands is None:
+            return self.window.size
+        return max(1, sliding_window_num_commands)
 
-        for i in tqdm(range(int(words)), total=words, desc="reading memory"):
-            addr = DRAM_REGION_START + i*8
-            command = NbfCommand.with_values(OPCODE_READ_8, addr, i)
-            self._send_message(command)
-            if self._nbf_expects_reply(command):
-                outstanding_commands_expecting_replies.append(command)
-            #reply = self._receive_until_opcode(OPCODE_READ_8)
-            #self._validate_reply(command, reply)
+    async def send(self, command: NbfCommand, sliding_window_num_commands: Optional[int] = 0, future: Optional[asyncio.Future] = None, checked: bool = True):
+        """
+        Queues a command. If it expects a reply, first waits until fewer than
+        "sliding_window_num_commands" (at least one) replies are outstanding, or fewer than the
+        adaptive window if it is None. Replies to commands that are not "checked" are accepted
+        whatever data they carry. The reply is passed to "future", which may also be any object
+        with the same done(), set_result() and set_exception(), such as a memtest.ReadBlock.
+        """
+        expects_reply = self.app._nbf_expects_reply(command)
+        if expects_reply:
+            if sliding_window_num_commands is None:
+                self._adaptive = True
+                if self.window.status_check_due():
+                    await self.send(NbfCommand.with_values(OPCODE_CTRL_READ, 0, 0), None)
+
+            self._window_in_use = self._window_limit(sliding_window_num_commands)
+            if len(self.replies) >= self._window_in_use:
+                if sliding_window_num_commands is None:
+                    self.window.on_limited()
+                self.app.transmit.flush()
+                wait_start = time.perf_counter()
+                await self._wait_until(lambda: len(self.replies) < self._window_limit(sliding_window_num_commands))
+                wait_end = time.perf_counter()
+                self.app.metrics.seconds['window_wait'] += wait_end - wait_start
+                if self.app.trace is not None:
+                    self.app.trace.span('window wait', TRACK_SENDER, wait_start, wait_end, {'window': self._window_in_use, 'blocked_on': str(self.replies.oldest().command) if len(self.replies) else None})
+            self.replies.add(command, future, time.perf_counter(), checked)
+        elif future is not None:
+            future.set_result(None)
+
+        self.app.transmit.send(command.to_bytes(), expects_reply)
+        self.app.commands_sent += 1
+        self.app.metrics.commands_sent[command.opcode] += 1
+        await self._wait_for_writer()
+
+    async def request(self, command: NbfCommand, checked: bool = True) -> Optional[NbfCommand]:
+        """
+        Sends a command and waits for its reply. Returns None for commands without replies.
+        Unless "checked", the reply is accepted whatever data it carries.
+        """
+        future = self._loop.create_future()
+        await self.send(command, future=future, checked=checked)
+        self.app.transmit.flush()
+        return await future
 
-            self._validate_outstanding_replies(outstanding_commands_expecting_replies, sliding_window_num_commands, log_all_rx=verbose)
+    async def wait_for_replies(self):
+        """
+        Waits until every outstanding reply has been received.
+        """
+        self.app.transmit.flush()
+        self._last_activity = time.perf_counter()
+        await self._wait_until(lambda: len(self.replies) == 0)
 
-        self._validate_outstanding_replies(outstanding_commands_expecting_replies, 0, log_all_rx=verbose)
+    async def drain(self):
+        """
+        Waits until everything queued has been written and transmitted by the port.
+        """
+        self.app.transmit.flush()
+        await self._wait_until(lambda: self._queued_tx_bytes == 0)
+        await self._loop.run_in_executor(self._tx_executor, self.app.transmit.drain)
+
+    ## Receive
+
+    def _read_available(self) -> memoryview:
+        start = time.perf_counter()
+        count = self.app.port.read_into(self._rx_buffer)
+        metrics = self.app.metrics
+        metrics.rx_bytes += count
+        if len(self.replies) > 0:
+            metrics.seconds['reply_wait'] += time.perf_counter() - start
+        if count and self.app.trace is not None:
+            self.app.trace.span('read', TRACK_READER, start, time.perf_counter(), {'bytes': count})
+        return memoryview(self._rx_buffer)[:count]
+
+    async def _reader(self):
+        buffer = bytearray()
+        try:
+            while not self._stopping:
+                data = await self._loop.run_in_executor(self._rx_executor, self._read_available)
+                now = time.perf_counter()
+                if self.console is not None:
+                    self.console.poll(now)
+                if not data:
+                    idle_seconds = now - self._last_activity
+                    if len(self.replies) > 0 and self._queued_tx_bytes == 0:
+                        if idle_seconds > self._saved_port_timeout:
+                            command = self.replies.oldest().command
+                            raise ValueError(f"timed out after {self._saved_port_timeout} seconds waiting for reply to {command}")
+                        if self._adaptive and not self._stalled and idle_seconds > self.window.stall_seconds():
+                            self._stalled = True
+                            self._back_off('timeout', now)
+                    continue
+
+                self._last_activity = now
+                self._stalled = False
+                buffer += data
+                complete_length = len(buffer) - len(buffer) % NBF_COMMAND_LENGTH_BYTES
+                if complete_length == 0:
+                    continue
+
+                self._receive_frames(bytes(buffer[:complete_length]), now)
+                del buffer[:complete_length]
+                parsed = time.perf_counter()
+                self.app.metrics.seconds['parse'] += parsed - now
+                if self.app.trace is not None:
+                    self.app.trace.span('parse', TRACK_PARSER, now, parsed, {'frames': complete_length // NBF_COMMAND_LENGTH_BYTES})
+                    self.app.trace.counter('outstanding replies', len(self.replies), parsed)
+                self._progress.set()
+        except Exception as e:
+            self._fail(e)
+
+    def _receive_frames(self, wire: bytes, now: float):
+        self.frames_received += len(wire) // NBF_COMMAND_LENGTH_BYTES
+        self.app.metrics.count_received(np.frombuffer(wire, dtype=np.uint8)[::NBF_COMMAND_LENGTH_BYTES])
+        if self.console is None or not self.listening:
+            for message in NbfCommand.from_buffer(wire):
+                self._dispatch(message)
+            return
+
+        # runs of putch messages go to the console in one write each
+        frames = NbfArray.from_bytes(wire)
+        putch = frames.opcodes == OPCODE_PUTCH
+        characters = frames.data.astype(np.uint8)
+        self.app.commands_received += int(np.count_nonzero(putch))
+        start = 0
+        for index in np.flatnonzero(~putch).tolist():
+            self.console.write(characters[start:index].tobytes(), now)
+            offset = index * NBF_COMMAND_LENGTH_BYTES
+            self._dispatch(NbfCommand.from_bytes(wire[offset:offset + NBF_COMMAND_LENGTH_BYTES]))
+            start = index + 1
+        self.console.write(characters[start:].tobytes(), now)
+
+    def _dispatch(self, message: NbfCommand):
+        self.app.commands_received += 1
+
+        if message.opcode in UNSOLICITED_OPCODES:
+            if self.listening:
+                self._unsolicited.put_nowait(message)
+            else:
+                log(LogDomain.RECEIVE, _debug_format_message(message))
+            return
+
+        status, entry = self.replies.match(message)
+        if self.log_all_rx:
+            log(LogDomain.REPLY, _debug_format_message(message))
+
+        now = time.perf_counter()
+        if status is not ReplyStatus.MATCHED:
+            # TODO: consider aborting on invalid reply
+            self.app.reply_violations += 1
+            # reads that return unexpected data point at memory contents, not at the link
+            read_mismatch = entry is not None and entry.command.opcode in (OPCODE_READ_4, OPCODE_READ_8)
+            if entry is None:
+                log(LogDomain.REPLY, f'Orphaned reply: {message}')
+            elif not read_mismatch or self.log_read_mismatches:
+                log(LogDomain.REPLY, f'Unexpected reply: {entry.command} -> {message}')
+            if not read_mismatch:
+                self._back_off('violation', now)
+        else:
+            latency = now - entry.sent_time
+            self.app.reply_latencies.append(latency)
+            self.app.metrics.latency(entry.command.opcode).add(latency)
+            if self.window.on_reply(latency, now) and self._adaptive:
+                log(LogDomain.COMMAND, f"Window: {self.window}")
+
+        if status is ReplyStatus.MATCHED and message.opcode == OPCODE_CTRL_READ:
+            # reading the control register clears its error bits, so each one is seen once
+            self.app.metrics.ctrl_reads += 1
+            if message.data_int & (1 << CTRL_BIT_READ_ERROR):
+                self.app.metrics.ctrl_errors['rd_error'] += 1
+                self._back_off('rd_error', now)
+            if message.data_int & (1 << CTRL_BIT_WRITE_ERROR):
+                self.app.metrics.ctrl_errors['wr_error'] += 1
+                self._back_off('wr_error', now)
+
+        if entry is not None and entry.token is not None and not entry.token.done():
+            entry.token.set_result(message)
+
+    async def _sampler(self):
+        """
+        Samples window occupancy and byte rates into the app's metrics, and rewrites its metrics
+        file every "metrics_export_seconds".
+        """
+        next_export = time.perf_counter() + self.app.metrics_export_seconds
+        while True:
+            await asyncio.sleep(DEFAULT_METRICS_SAMPLE_SECONDS)
+            now = time.perf_counter()
+            self.app.metrics.sample(now, len(self.replies), self._window_in_use)
+            if self.app.trace is not None:
+                self.app.trace.counter('window', self._window_in_use, now)
+                self.app.trace.counter('queued tx bytes', self._queued_tx_bytes, now)
+            if now >= next_export:
+                next_export = now + self.app.metrics_export_seconds
+                try:
+                    self.app.write_metrics()
+                except OSError as e:
+                    log(LogDomain.COMMAND, f"Could not write metrics to {self.app.metrics_path}: {e}")
+                    self.app.metrics_path = None
+
+    def _back_off(self, reason: str, now: float):
+        self.window.back_off(reason, now)
+        if self.app.trace is not None:
+            self.app.trace.instant('back off', TRACK_SENDER, now, {'reason': reason, 'window': self.window.size})
+        if self._adaptive:
+            log(LogDomain.COMMAND, f"Window: backing off after {reason}, {self.window}")
+
+    async def receive_unsolicited(self) -> NbfCommand:
+        """
+        Waits for the next out-of-turn message (putch, core done, errors) while listening.
+        """
+        self.listening = True
+        if self._failure is not None:
+            raise self._failure
+
+        message = await self._unsolicited.get()
+        if message is None:
+            # woken up by a failure of the reader or writer
+            raise self._failure
+        return message
 
+    ## Operations
 
-    def load_file(self, source_file: str, ignore_unfreezes: bool = False, sliding_window_num_commands: int = 0, log_all_messages: bool = False, write_responses: bool = False):
+    async def probe_burst_writes(self) -> bool:
+        """
+        Asks the FPGA host whether it accepts burst writes, through the capability bits of a
+        control register read, the first time it is needed. The read clears the register's
+        error bits, so any it returns are reported here rather than lost.
+        """
+        if self.app.burst_writes is None:
+            reply = await self.request(NbfCommand.with_values(OPCODE_CTRL_READ, 0, 0))
+            self.app.burst_writes = reply is not None and bool(reply.data_int & (1 << CTRL_BIT_BURST_WRITE))
+            errors = [name for bit, name in ((CTRL_BIT_READ_ERROR, 'rd_error'), (CTRL_BIT_WRITE_ERROR, 'wr_error')) if reply is not None and reply.data_int & (1 << bit)]
+            if errors:
+                log(LogDomain.COMMAND, f"FPGA host reported {' and '.join(errors)} before the load: an earlier UART frame, parity or overflow error")
+            log(LogDomain.COMMAND, "FPGA host supports burst writes" if self.app.burst_writes else "FPGA host does not support burst writes, sending single writes")
+        return self.app.burst_writes
+
+    async def enable_write_responses(self):
+        self.app.opcodes_expecting_replies.extend([OPCODE_WRITE_4, OPCODE_WRITE_8])
+        await self.send(NbfCommand.with_values(OPCODE_CTRL_SET, 1 << CTRL_BIT_WRITE_RESP, 1))
+
+    @_traced('load')
+    async def load(self, source, ignore_unfreezes: bool = False, sliding_window_num_commands: Optional[int] = None, log_all_messages: bool = False, write_responses: bool = False, optimize: bool = False, dram_zeroed: bool = False, manifest: Optional[BoardManifest] = None, incremental: bool = False, spot_check_blocks: int = 0, bursts: bool = True, checkpoint: Optional[LoadCheckpoint] = None, resume: bool = False, checkpoint_commands: int = DEFAULT_CHECKPOINT_COMMANDS, resume_verify_words: int = DEFAULT_RESUME_VERIFY_WORDS):
+        """
+        Loads a program, given as an nbf file path, a binary image path or an NbfArray.
+
+        With "optimize", the program is first rewritten by optimize_nbf, which also skips zero
+        writes to DRAM if "dram_zeroed" asserts that DRAM is already zero.
+
+        A "manifest" of the board's DRAM is updated with what the program stores. With
+        "incremental", DRAM writes to blocks the manifest says already hold the same contents
+        are skipped, after reading back "spot_check_blocks" of those blocks to confirm it; if any
+        of them was changed, by the core since it was unfrozen for example, everything is sent.
+        The manifest is not saved if any reply was unexpected.
+
+        With "bursts", runs of writes to consecutive addresses are sent as burst writes if the
+        FPGA host supports them. Bursts are not used while writes are answered, since the
+        FPGA host answers every word of a burst.
+
+        With a "checkpoint", the load records how far the board is known to have got: at each
+        fence of the program, and at a fence added after every "checkpoint_commands" commands.
+        With "resume", the commands before the checkpoint of an interrupted load of the same
+        program are not sent again, once the last "resume_verify_words" DRAM words they store
+        have been read back to confirm the board still holds them.
+        """
         if write_responses:
-          self.opcodes_expecting_replies.extend([OPCODE_WRITE_4, OPCODE_WRITE_8])
-          self._send_message(NbfCommand.with_values(OPCODE_CTRL_SET, CTRL_BIT_WRITE_RESP, 1))
+            await self.enable_write_responses()
+        bursts = bursts and not log_all_messages and OPCODE_WRITE_8 not in self.app.opcodes_expecting_replies and await self.probe_burst_writes()
+
+        loaded_blocks = None
+        violations = self.app.reply_violations
+
+        async def send_program(program: NbfArray):
+            nonlocal loaded_blocks
+            if optimize or dram_zeroed:
+                program, stats = optimize_nbf(program, dram_zeroed=dram_zeroed)
+                log(LogDomain.COMMAND, f"Optimized: {stats}")
+
+            if manifest is not None:
+                command_blocks, block_ids, hashes = dram_blocks(program, manifest.block_words)
+                if incremental:
+                    program = await self._delta_program(program, manifest, command_blocks, block_ids, hashes, spot_check_blocks, sliding_window_num_commands)
+                manifest.invalidate()
+                loaded_blocks = (block_ids, hashes)
+
+            start = 0
+            if checkpoint is not None:
+                digest = program_digest(program)
+                if resume:
+                    start = await self._resume_position(program, checkpoint.resume_position(digest, len(program)), resume_verify_words, sliding_window_num_commands)
+                checkpoint.start(digest, len(program), start)
+
+            await self._stream_program(program, ignore_unfreezes, sliding_window_num_commands, log_all_messages, bursts, start, checkpoint, checkpoint_commands)
+
+        if isinstance(source, NbfArray):
+            await send_program(source)
+        elif NbfBinaryFile.is_binary(source):
+            with NbfBinaryFile(source) as image:
+                if not image.verify_digest():
+                    raise ValueError(f"binary nbf image \"{source}\" does not match its content hash")
+                await send_program(NbfArray.from_bytes(image.records))
+                # the records must be written out before the image is unmapped
+                await self.drain()
+        else:
+            await send_program(NbfArray.from_file(source))
+
+        await self.wait_for_replies()
+        await self.drain()
+        if loaded_blocks is not None and self.app.reply_violations == violations:
+            manifest.update(*loaded_blocks)
+            manifest.save()
+        if checkpoint is not None:
+            checkpoint.clear()
+        log(LogDomain.COMMAND, "Load complete")
+
+    async def _resume_position(self, program: NbfArray, position: int, verify_words: int, sliding_window_num_commands: Optional[int]) -> int:
+        """
+        Returns where a resumed load of "program" starts: "position", from the board's
+        checkpoint, if the last "verify_words" DRAM words stored before it read back as stored,
+        and the start of the program otherwise.
+        """
+        if position == 0:
+            log(LogDomain.COMMAND, "Resume: no checkpoint of this program for the board, loading everything")
+            return 0
 
-        file = NbfFile(source_file)
+        done = program[:position]
+        writes = np.flatnonzero(done.opcode_mask(OPCODE_WRITE_8) & done.dram_mask())
+        if verify_words > 0 and len(writes) > 0:
+            if not await self._reads_match(done[writes[-verify_words:]], sliding_window_num_commands, "Resume check"):
+                log(LogDomain.COMMAND, "Resume: board memory does not match the checkpoint, loading everything")
+                return 0
 
-        outstanding_commands_expecting_replies = []
+        log(LogDomain.COMMAND, f"Resume: skipping {position} of {len(program)} commands confirmed by the last load")
+        return position
 
-        command: NbfCommand
-        for command in tqdm(file, total=file.peek_length(), desc="loading nbf"):
-            if ignore_unfreezes and command.matches(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0):
-                continue
+    async def _delta_program(self, program: NbfArray, manifest: BoardManifest, command_blocks: np.ndarray, block_ids: np.ndarray, hashes: np.ndarray, spot_check_blocks: int, sliding_window_num_commands: Optional[int]) -> NbfArray:
+        """
+        Drops the DRAM writes of blocks the manifest says the board already holds. All other
+        commands (CSR writes, fences, finish) are kept.
+        """
+        unchanged = manifest.unchanged_mask(block_ids, hashes)
+        if not unchanged.any():
+            log(LogDomain.COMMAND, "Incremental: no matching blocks in the board manifest, loading everything")
+            return program
+
+        unchanged_blocks = block_ids[unchanged].astype(np.int64)
+        if spot_check_blocks > 0:
+            rng = np.random.default_rng()
+            checked = rng.choice(unchanged_blocks, size=min(spot_check_blocks, len(unchanged_blocks)), replace=False)
+            if not await self._spot_check(program, command_blocks, checked, sliding_window_num_commands):
+                log(LogDomain.COMMAND, "Incremental: board memory does not match its manifest, loading everything")
+                return program
+
+        delta = program[~np.isin(command_blocks, unchanged_blocks)]
+        log(LogDomain.COMMAND, f"Incremental: {len(block_ids) - len(unchanged_blocks)} of {len(block_ids)} blocks changed, sending {len(delta)} of {len(program)} commands")
+        return delta
+
+    @_traced('spot check')
+    async def _spot_check(self, program: NbfArray, command_blocks: np.ndarray, blocks: np.ndarray, sliding_window_num_commands: Optional[int]) -> bool:
+        """
+        Reads back the 8-byte words the program stores in the given blocks, and returns True if
+        they all hold the stored values.
+        """
+        selected = program[np.isin(command_blocks, blocks) & program.opcode_mask(OPCODE_WRITE_8)]
+        return await self._reads_match(selected, sliding_window_num_commands, "Spot check")
 
-            if log_all_messages:
-                _log(LogDomain.TRANSMIT, _debug_format_message(command))
+    async def _reads_match(self, writes: NbfArray, sliding_window_num_commands: Optional[int], label: str) -> bool:
+        """
+        Reads back the addresses of 8-byte "writes", and returns True if memory holds what they
+        stored.
+        """
+        # the last store to each address is what memory should hold
+        expected = {command.address_int: command for command in writes}
+
+        # mismatches are summarized below rather than logged one by one
+        self.log_read_mismatches = False
+        pending = []
+        mismatches = 0
+        try:
+            for command in expected.values():
+                future = self._loop.create_future()
+                await self.send(NbfCommand.with_values(OPCODE_READ_8, command.address_int, command.data_int), sliding_window_num_commands, future)
+                pending.append((command, future))
+            self.app.transmit.flush()
+
+            for command, future in pending:
+                reply = await future
+                if reply.data != command.data:
+                    if mismatches == 0:
+                        log(LogDomain.COMMAND, f"{label} mismatch at address 0x{command.address_hex_str}: expected 0x{command.data_hex_str}, read 0x{reply.data_hex_str}")
+                    mismatches += 1
+        finally:
+            self.log_read_mismatches = True
+        if mismatches > 1:
+            log(LogDomain.COMMAND, f"{label} found {mismatches} of {len(pending)} words changed")
+        return mismatches == 0
+
+    @_traced('stream')
+    async def _stream_program(self, program: NbfArray, ignore_unfreezes: bool, sliding_window_num_commands: Optional[int], log_all_messages: bool, bursts: bool = False, start: int = 0, checkpoint: Optional[LoadCheckpoint] = None, checkpoint_commands: int = DEFAULT_CHECKPOINT_COMMANDS):
+        """
+        Streams a program to the target, from command "start", in chunks of raw wire records,
+        packed into burst writes with "bursts". Only commands that expect a reply, or that must
+        be filtered out or logged, are decoded individually.
 
-            self._send_message(command)
-            if self._nbf_expects_reply(command):
-                outstanding_commands_expecting_replies.append(command)
+        With a "checkpoint", the reply to each fence moves it past the commands sent before the
+        fence, unless a reply violation was seen during the stream. A fence is added whenever
+        "checkpoint_commands" commands have been sent since the last one.
+        """
+        self.log_all_rx = log_all_messages
+        unfreeze_command = NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0)
+        if log_all_messages:
+            stop_mask = np.ones(len(program), dtype=bool)
+        else:
+            stop_mask = program.opcode_mask(*self.app.opcodes_expecting_replies)
+            if ignore_unfreezes:
+                stop_mask |= program.command_mask(unfreeze_command)
+        stop_indices = (np.flatnonzero(stop_mask[start:]) + start).tolist()
+        wire = program.wire
+
+        violations = self.app.reply_violations
+        def confirm(confirmed_position: int) -> asyncio.Future:
+            future = self._loop.create_future()
+            def done(future: asyncio.Future):
+                if not future.cancelled() and future.exception() is None and self.app.reply_violations == violations:
+                    checkpoint.advance(confirmed_position)
+            future.add_done_callback(done)
+            return future
+
+        checkpointing = checkpoint is not None and checkpoint_commands > 0
+        next_checkpoint = start + checkpoint_commands if checkpointing else len(program)
+
+        async def fence_if_due():
+            nonlocal next_checkpoint
+            if position >= next_checkpoint and position < len(program):
+                await self.send(NbfCommand.with_values(OPCODE_FENCE, 0, 0), sliding_window_num_commands, confirm(position))
+                next_checkpoint = position + checkpoint_commands
+
+        position = start
+        with tqdm(total=len(program), initial=start, desc="loading nbf", disable=not self.app.show_progress) as progress:
+            for stop_index in stop_indices + [len(program)]:
+                while position < stop_index:
+                    chunk_end = min(stop_index, position + STREAM_CHUNK_COMMANDS, next_checkpoint)
+                    if bursts:
+                        chunk = encode_bursts(program[position:chunk_end])
+                    else:
+                        chunk = wire[position*NBF_COMMAND_LENGTH_BYTES:chunk_end*NBF_COMMAND_LENGTH_BYTES]
+                    await self.send_raw(chunk.data, program.opcodes[position:chunk_end])
+                    progress.update(chunk_end - position)
+                    position = chunk_end
+                    await fence_if_due()
+
+                if stop_index == len(program):
+                    break
+
+                command = program[stop_index]
+                position = stop_index + 1
+                progress.update(1)
+                if ignore_unfreezes and command.matches(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0):
+                    continue
+
+                if log_all_messages:
+                    log(LogDomain.TRANSMIT, _debug_format_message(command))
+
+                future = None
+                if checkpoint is not None and command.opcode == OPCODE_FENCE:
+                    future = confirm(position)
+                    if checkpointing:
+                        next_checkpoint = position + checkpoint_commands
+                await self.send(command, sliding_window_num_commands, future)
+                await fence_if_due()
+
+    @_traced('test memory')
+    async def test_memory(self, verbose: bool = False, sliding_window_num_commands: Optional[int] = None, write_responses: bool = False, words: int = 1, configure: bool = True, ranges: Optional[Sequence[MemoryRange]] = None, patterns: Sequence[str] = DEFAULT_MEMTEST_PATTERNS, seed: int = 0, region_bytes: int = DEFAULT_MEMTEST_REGION_BYTES) -> MemoryTestReport:
+        """
+        Writes each of "patterns" to DRAM and reads it back: "words" words from the start of
+        DRAM, or the given "ranges". Unless "configure" is cleared, because the caller knows the
+        core is already frozen with its caches in normal mode, the core is set up that way first.
+
+        Patterns are generated, written and checked a block of MEMTEST_BLOCK_WORDS words at a
+        time, and the reads of each block follow the writes of the next, so that memory use does
+        not grow with the size of the test. Writes are streamed, in bursts if the FPGA host
+        supports them, unless they expect replies or are logged.
+        """
+        self.log_all_rx = verbose
+        self._dram_changed()
 
-            self._validate_outstanding_replies(outstanding_commands_expecting_replies, sliding_window_num_commands, log_all_rx=log_all_messages)
+        # configure the system/processor
+        if configure:
+            await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1))
+            await self.request(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
+            await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_ICACHE_MODE, 1))
+            await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_DCACHE_MODE, 1))
+            await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_CCE_MODE, 1))
+            await self.request(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
 
-        self._validate_outstanding_replies(outstanding_commands_expecting_replies, 0, log_all_rx=log_all_messages)
-        _log(LogDomain.COMMAND, "Load complete")
+        if write_responses:
+            await self.enable_write_responses()
+        stream = not verbose and not self.app._nbf_expects_reply(NbfCommand.with_values(OPCODE_WRITE_8, 0, 0))
+        bursts = stream and await self.probe_burst_writes()
+
+        ranges = ranges or [MemoryRange(DRAM_REGION_START, int(words))]
+        report = MemoryTestReport(region_bytes)
+        pending: Deque[ReadBlock] = deque()
+        total = len(patterns) * sum(memory_range.words for memory_range in ranges)
+        with tqdm(total=total, desc="testing memory", unit="word", unit_scale=True, disable=not self.app.show_progress) as progress:
+            def check_completed():
+                while pending and pending[0].remaining == 0:
+                    block = pending.popleft()
+                    report.check(block)
+                    progress.update(len(block.addresses))
+
+            for pattern in patterns:
+                for memory_range in ranges:
+                    previous: Optional[ReadBlock] = None
+                    for addresses, indices in iter_blocks(memory_range):
+                        data = pattern_block(pattern, addresses, indices, seed)
+                        block = ReadBlock(pattern, addresses, data, time.perf_counter())
+                        await self._write_block(addresses, data, sliding_window_num_commands, verbose, stream, bursts)
+                        if previous is not None:
+                            await self._read_block(previous, sliding_window_num_commands)
+                            pending.append(previous)
+                        previous = block
+                        check_completed()
+                    # read the last block before anything can overwrite it
+                    await self._read_block(previous, sliding_window_num_commands)
+                    pending.append(previous)
+
+            await self.wait_for_replies()
+            check_completed()
+
+        await self.drain()
+        report.finish()
+        return report
+
+    async def _write_block(self, addresses: np.ndarray, data: np.ndarray, sliding_window_num_commands: Optional[int], verbose: bool, stream: bool, bursts: bool):
+        writes = NbfArray.from_values(OPCODE_WRITE_8, addresses, data)
+        if stream:
+            wire = encode_bursts(writes) if bursts else writes.wire
+            await self.send_raw(wire.data, writes.opcodes)
+            return
+
+        for command in writes:
+            if verbose:
+                log(LogDomain.TRANSMIT, _debug_format_message(command))
+            await self.send(command, sliding_window_num_commands)
 
-    def unfreeze(self):
-        unfreeze_command = NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0)
-        self._send_message(unfreeze_command)
+    async def _read_block(self, block: ReadBlock, sliding_window_num_commands: Optional[int]):
+        for address in block.addresses.tolist():
+            await self.send(NbfCommand.with_values(OPCODE_READ_8, address, 0), sliding_window_num_commands, block, checked=False)
+        self.app.transmit.flush()
 
-        reply = self._receive_until_opcode(unfreeze_command.opcode)
-        self._validate_reply(unfreeze_command, reply)
+    def _dram_changed(self, writes: Optional[NbfArray] = None):
+        """
+        Forgets the blocks of the board manifest that "writes" store to, or all of them, once
+        something other than a load has changed DRAM. What the core itself changes once it is
+        unfrozen is left to the spot checks of the next incremental load.
+        """
+        manifest = self.app.manifest
+        if manifest is None:
+            return
+        if writes is None:
+            manifest.clear()
+            return
+        manifest.forget(dram_blocks(writes, manifest.block_words)[1])
+        if len(manifest) > 0:
+            manifest.save()
+        else:
+            manifest.invalidate()
 
-    def listen_perpetually(self, verbose: bool):
-        _log(LogDomain.COMMAND, "Listening for incoming messages...")
-        while message := self._receive_message():
-            # in "verbose" mode, we'll always print the full message, even for putchar
-            if not verbose and message.opcode == OPCODE_PUTCH:
-                print(chr(message.data[0]), end = '')
-                continue
+    async def unfreeze(self):
+        await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0))
+        await self.wait_for_replies()
+        await self.drain()
 
-            _log(LogDomain.RECEIVE, _debug_format_message(message))
+    @_traced('listen')
+    async def listen(self, verbose: bool = False, report_seconds: float = 0.0):
+        """
+        Prints incoming messages until a core reports that it is done, and returns the status
+        it reported. With "report_seconds", also logs the receive rate that often.
+        """
+        log(LogDomain.COMMAND, "Listening for incoming messages...")
+        start = time.perf_counter()
+        start_frames = self.frames_received
+        last_report = (start, start_frames)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(self.receive_unsolicited(), report_seconds if report_seconds > 0 else None)
+                except asyncio.TimeoutError:
+                    now = time.perf_counter()
+                    rate = (self.frames_received - last_report[1]) / (now - last_report[0])
+                    log(LogDomain.RECEIVE, f"{rate:.0f} frames/s")
+                    last_report = (now, self.frames_received)
+                    continue
+
+                # in "verbose" mode, we'll always print the full message, even for putchar
+                if not verbose and message.opcode == OPCODE_PUTCH:
+                    print(chr(message.data[0]), end = '')
+                    continue
+
+                if self.console is not None:
+                    self.console.flush()
+                log(LogDomain.RECEIVE, _debug_format_message(message))
+
+                if message.opcode == OPCODE_CORE_DONE:
+                    status = f"FAIL, code {message.data_int}" if message.data_int else "PASS"
+                    _write_line(_tagged(f"FINISH: core {message.address_int} {status}"))
+                    # TODO: this assumes unicore
+                    return message.data_int
+        finally:
+            if self.console is not None:
+                self.console.flush()
+            elapsed = time.perf_counter() - start
+            frames = self.frames_received - start_frames
+            if elapsed > 0:
+                log(LogDomain.COMMAND, f" Listened: {frames} frames in {elapsed:.2f} s, {frames / elapsed:.0f} frames/s")
+
+    @_traced('read back')
+    async def _read_back(self, addresses: List[int], expected_data: List[int], sliding_window_num_commands: Optional[int], description: str) -> List[Tuple[int, int, int]]:
+        """
+        Reads the given DRAM words through the window, returning (address, expected, actual) for
+        every word that does not hold its expected value.
+        """
+        corrupted: List[Tuple[int, int, int]] = []
+
+        def check(address: int, expected: int, reply: NbfCommand):
+            if reply.data_int != expected:
+                corrupted.append((address, expected, reply.data_int))
+
+        # the reads carry the expected data, so that reply validation counts mismatches, but
+        # they are reported by the caller rather than logged one by one
+        self.log_read_mismatches = False
+        pending: Deque[Tuple[int, int, asyncio.Future]] = deque()
+        try:
+            for address, expected in tqdm(zip(addresses, expected_data), total=len(addresses), desc=description, disable=not self.app.show_progress):
+                future = self._loop.create_future()
+                await self.send(NbfCommand.with_values(OPCODE_READ_8, address, expected), sliding_window_num_commands, future)
+                pending.append((address, expected, future))
+                while pending and pending[0][2].done():
+                    address, expected, future = pending.popleft()
+                    check(address, expected, future.result())
+
+            self.app.transmit.flush()
+            for address, expected, future in pending:
+                check(address, expected, await future)
+        finally:
+            self.log_read_mismatches = True
+        return corrupted
+
+    @_traced('dump')
+    async def dump(self, address: int, words: int, sliding_window_num_commands: Optional[int] = None) -> List[int]:
+        """
+        Reads "words" consecutive 8-byte words of memory starting at "address", pipelined
+        through the window.
+        """
+        pending: List[asyncio.Future] = []
+        for i in tqdm(range(words), desc="dumping memory", disable=not self.app.show_progress):
+            future = self._loop.create_future()
+            await self.send(NbfCommand.with_values(OPCODE_READ_8, address + 8 * i, 0), sliding_window_num_commands, future, checked=False)
+            pending.append(future)
+        self.app.transmit.flush()
+        return [(await future).data_int for future in pending]
+
+    @_traced('verify')
+    async def verify(self, reference, sliding_window_num_commands: Optional[int] = None) -> int:
+        """
+        Reads back the DRAM contents a program leaves behind, given as an nbf file path, a
+        binary image path or an NbfArray, and reports any words that do not match. Reads are
+        pipelined through the window. Returns the number of corrupt words.
+        """
+        program = reference if isinstance(reference, NbfArray) else NbfArray.from_file(reference)
+        # only the last value written to each address is expected to remain
+        addresses, expected_data = program.final_dram_words()
+        corrupted = await self._read_back(addresses.tolist(), expected_data.tolist(), sliding_window_num_commands, "verifying nbf")
 
-            if message.opcode == OPCODE_CORE_DONE:
-                status = f"FAIL, code {message.data_int}" if message.data_int else "PASS"
-                print(f"FINISH: core {message.address_int} {status}")
-                # TODO: this assumes unicore
-                return
+        log(LogDomain.COMMAND, "Verify complete")
+        log(LogDomain.COMMAND, f" Writes checked:       {len(addresses)}")
+        return _report_corruption(corrupted)
 
-    def verify(self, reference_file: str):
-        file = NbfFile(reference_file)
+    @_traced('verify checksums')
+    async def verify_checksums(self, reference, sliding_window_num_commands: Optional[int] = None, scratch_address: int = DEFAULT_CHECKSUM_SCRATCH_ADDRESS, block_words: int = DEFAULT_CHECKSUM_BLOCK_WORDS) -> int:
+        """
+        Verifies like verify(), but has the target checksum its own memory, so that only a digest
+        per block of "block_words" words crosses the link. Words in blocks whose digest differs,
+        and words too scattered to checksum, are read back individually. Falls back to verify()
+        if the program overlaps the scratch region or the helper does not finish.
+
+        The board must be frozen with the program loaded. The helper is placed in the scratch
+        region, and the word at the boot PC is replaced by a jump to it while it runs; afterwards
+        the core is frozen again and the word restored, so that the next unfreeze restarts the
+        program from the boot PC.
+        """
+        program = reference if isinstance(reference, NbfArray) else NbfArray.from_file(reference)
+        try:
+            plan = plan_checksums(program, scratch_address, block_words)
+        except ValueError as e:
+            log(LogDomain.COMMAND, f"Cannot checksum on the target ({e}), reading back every word")
+            return await self.verify(program, sliding_window_num_commands)
+
+        # save the word the trampoline displaces, which is normally the program's first; it is
+        # checked with the rest of the program, as one of the plan's loose words
+        addresses, expected_data = program.final_dram_words()
+        boot_word = (await self.request(NbfCommand.with_values(OPCODE_READ_8, ADDRESS_BOOT_PC, 0), checked=False)).data_int
+        # the helper and its digests overwrite the scratch region
+        helper = helper_program(plan)
+        self._dram_changed(helper)
+        for command in helper:
+            await self.send(command, sliding_window_num_commands)
+        await self.request(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
+
+        words = int(plan.block_lengths.sum())
+        finished = await self._run_helper(self._saved_port_timeout + words / CHECKSUM_MIN_WORDS_PER_SECOND)
+
+        await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1))
+        await self.send(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_BOOT_PC, boot_word))
+        await self.request(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
+        if not finished:
+            log(LogDomain.COMMAND, "Checksum helper did not finish, reading back every word")
+            return await self.verify(program, sliding_window_num_commands)
+
+        block_count = len(plan.expected_digests)
+        digest_addresses = plan.digest_address + 8 * np.arange(block_count, dtype=np.uint64)
+        bad_digests = await self._read_back(digest_addresses.tolist(), plan.expected_digests.tolist(), sliding_window_num_commands, "reading checksums")
+
+        # read back the words of mismatched blocks, and those that were not checksummed
+        selected = [np.searchsorted(addresses, plan.loose_addresses)]
+        for digest_address, _, _ in bad_digests:
+            block = (digest_address - plan.digest_address) // 8
+            start = np.searchsorted(addresses, plan.block_addresses[block])
+            selected.append(start + np.arange(plan.block_lengths[block]))
+        selected = np.concatenate(selected)
+        corrupted = await self._read_back(addresses[selected].tolist(), expected_data[selected].tolist(), sliding_window_num_commands, "reading back words")
+
+        log(LogDomain.COMMAND, "Verify complete")
+        log(LogDomain.COMMAND, f" Writes checked:       {len(addresses)}")
+        log(LogDomain.COMMAND, f" Checksummed:          {words} words in {block_count} blocks, {len(bad_digests)} mismatched")
+        log(LogDomain.COMMAND, f" Read back:            {len(selected)} words")
+        return _report_corruption(corrupted)
+
+    @_traced('checksum helper')
+    async def _run_helper(self, timeout: float) -> bool:
+        """
+        Unfreezes the core and waits up to "timeout" seconds for it to report done.
+        """
+        listening = self.listening
+        self.listening = True
+        try:
+            await self.unfreeze()
+            deadline = time.perf_counter() + timeout
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                try:
+                    message = await asyncio.wait_for(self.receive_unsolicited(), remaining)
+                except asyncio.TimeoutError:
+                    return False
+                if message.opcode == OPCODE_CORE_DONE:
+                    return True
+                if message.opcode == OPCODE_ERROR:
+                    log(LogDomain.RECEIVE, _debug_format_message(message))
+        finally:
+            self.listening = listening
+
+# corrupt words and ranges listed individually by verify before it summarizes
+VERIFY_REPORT_WORDS = 8
+VERIFY_REPORT_RANGES = 32
+
+def _report_corruption(corrupted: List[Tuple[int, int, int]]) -> int:
+    """
+    Logs corrupt words, given as (address, expected, actual), as ranges of contiguous words.
+    Returns the number of corrupt words.
+    """
+    log(LogDomain.COMMAND, f" Corrupt writes found: {len(corrupted)}")
+    if not corrupted:
+        return 0
+
+    corrupted = sorted(corrupted)
+    for address, expected, actual in corrupted[:VERIFY_REPORT_WORDS]:
+        log(LogDomain.COMMAND, f" 0x{address:010x}: expected 0x{expected:016x}, actual 0x{actual:016x}")
+    if len(corrupted) > VERIFY_REPORT_WORDS:
+        log(LogDomain.COMMAND, f" ... and {len(corrupted) - VERIFY_REPORT_WORDS} more words")
+
+    ranges: List[Tuple[int, int]] = []
+    for address, _, _ in corrupted:
+        if ranges and address == ranges[-1][1] + 8:
+            ranges[-1] = (ranges[-1][0], address)
+        else:
+            ranges.append((address, address))
 
-        writes_checked = 0
-        writes_corrupted = 0
+    log(LogDomain.COMMAND, f" Corrupt ranges: {len(ranges)}")
+    for start, end in ranges[:VERIFY_REPORT_RANGES]:
+        log(LogDomain.COMMAND, f"  0x{start:010x}-0x{end + 7:010x} ({(end - start) // 8 + 1} words)")
+    if len(ranges) > VERIFY_REPORT_RANGES:
+        log(LogDomain.COMMAND, f"  ... and {len(ranges) - VERIFY_REPORT_RANGES} more ranges")
+    log(LogDomain.COMMAND, "== CORRUPTION DETECTED ==")
+    return len(corrupted)
 
-        command: NbfCommand
-        for command in tqdm(file, total=file.peek_length(), desc="verifying nbf"):
-            if command.opcode != OPCODE_WRITE_8:
-                continue
+def _load_command(app: HostApp, args):
+    async def operation(engine: HostEngine):
+        # with --verify, the program is parsed once for both the load and the verify
+        program = _open_program(args)
+        if args.verify and not isinstance(program, NbfArray):
+            program = NbfArray.from_file(program)
+        await engine.load(
+            program,
+            ignore_unfreezes=args.no_unfreeze or args.verify,
+            sliding_window_num_commands=args.window_size,
+            log_all_messages=args.verbose,
+            write_responses=args.write_responses,
+            optimize=args.optimize,
+            dram_zeroed=args.dram_zeroed,
+            manifest=app.manifest,
+            incremental=args.incremental,
+            spot_check_blocks=args.spot_checks,
+            bursts=not args.no_bursts,
+            checkpoint=LoadCheckpoint.for_board(args.board_id or args.port, args.checkpoint_dir),
+            resume=args.resume,
+            checkpoint_commands=args.checkpoint_commands,
+            resume_verify_words=args.resume_verify_words
+        )
 
-            if command.address_int < DRAM_REGION_START or command.address_int > DRAM_REGION_END - 8:
-                continue
+        if args.verify:
+            corrupted = await _verify(engine, program, args)
+            if corrupted > 0:
+                app.print_summary_statistics()
+                log(LogDomain.COMMAND, "Not unfreezing a corrupted program")
+                return
+            unfreeze_command = NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0)
+            if not args.no_unfreeze and program.command_mask(unfreeze_command).any():
+                await engine.unfreeze()
 
-            read_message = NbfCommand.with_values(OPCODE_READ_8, command.address_int, 0)
-            self._send_message(read_message)
-            reply = self._receive_until_opcode(OPCODE_READ_8)
-            self._validate_reply(read_message, reply)
+        app.print_summary_statistics()
 
-            writes_checked += 1
+        if args.listen:
+            await engine.listen(verbose=args.verbose, report_seconds=args.report_seconds)
 
-            if reply.data != command.data:
-                writes_corrupted += 1
-                _log(LogDomain.COMMAND, f"Corruption detected at address 0x{command.address_hex_str}")
-                _log(LogDomain.COMMAND, f" Expected: 0x{command.data_hex_str}")
-                _log(LogDomain.COMMAND, f" Actual:   0x{reply.data_hex_str}")
+    _run_listening(app, operation, args)
 
-        _log(LogDomain.COMMAND, "Verify complete")
-        _log(LogDomain.COMMAND, f" Writes checked:       {writes_checked}")
-        _log(LogDomain.COMMAND, f" Corrupt writes found: {writes_corrupted}")
-        if writes_corrupted > 0:
-            _log(LogDomain.COMMAND, "== CORRUPTION DETECTED ==")
+def _run_listening(app: HostApp, operation: Callable[[HostEngine], Awaitable[Any]], args):
+    if not args.listen:
+        app.run_engine(operation)
+        return
 
-def _load_command(app: HostApp, args):
-    app.load_file(
-        args.file,
-        ignore_unfreezes=args.no_unfreeze,
-        sliding_window_num_commands=args.window_size,
-        log_all_messages=args.verbose,
-        write_responses=args.write_responses
-    )
-    app.print_summary_statistics()
+    console = None if getattr(args, 'verbose', False) else ConsoleSink.open(args.output, args.flush_seconds)
+    try:
+        app.run_engine(operation, listen=True, console=console)
+    finally:
+        if console is not None:
+            console.close()
 
-    if args.listen:
-        app.listen_perpetually(verbose=args.verbose)
+def _add_listen_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--output', type=str, default=None, dest='output', help='Append the characters the program prints to this file instead of standard output')
+    parser.add_argument('--flush-seconds', type=float, default=DEFAULT_CONSOLE_FLUSH_SECONDS, dest='flush_seconds', help='Longest time printed characters are buffered before being written out')
+    parser.add_argument('--report-seconds', type=float, default=0.0, dest='report_seconds', help='Log the receive rate in frames per second this often while listening')
 
 def _unfreeze_command(app: HostApp, args):
-    app.unfreeze()
+    async def operation(engine: HostEngine):
+        await engine.unfreeze()
+
+        if args.listen:
+            await engine.listen(verbose=False, report_seconds=args.report_seconds)
+
+    _run_listening(app, operation, args)
 
-    if args.listen:
-        app.listen_perpetually(verbose=False)
+def _verify(engine: HostEngine, program, args) -> Awaitable[int]:
+    if args.checksum:
+        return engine.verify_checksums(program, args.window_size, args.checksum_scratch, args.checksum_block_words)
+    return engine.verify(program, args.window_size)
 
 def _verify_command(app: HostApp, args):
-    app.verify(args.file)
+    app.run_engine(lambda engine: _verify(engine, _open_program(args), args))
     app.print_summary_statistics()
 
+def _open_program(args):
+    return open_program(args.file, args.mem_base, args.skip_bss)
+
+def _add_manifest_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--board-id', type=str, default=None, dest='board_id', help='Identifies the board in the manifest cache (defaults to the port name)')
+    parser.add_argument('--manifest-dir', type=str, default=None, dest='manifest_dir', help='Directory of board manifests (defaults to ~/.cache/arty-parrot/manifests)')
+
+def add_image_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--mem-base', type=lambda v: int(v, 0), default=DRAM_REGION_START, dest='mem_base', help='Address that the offsets of a .mem file are relative to')
+    parser.add_argument('--skip-bss', action='store_true', dest='skip_bss', help='Do not write the zero-filled bss of ELF segments, for boards whose DRAM is known to be zero')
+
+def _add_checksum_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--checksum', action='store_true', dest='checksum', help='Have the target checksum its memory and only read back blocks whose checksum differs (runs a helper program on the core, which must be frozen with the program loaded)')
+    parser.add_argument('--checksum-scratch', type=lambda v: int(v, 0), default=DEFAULT_CHECKSUM_SCRATCH_ADDRESS, dest='checksum_scratch', help='Address of the 1 MiB of DRAM, unused by the program, that holds the checksum helper')
+    parser.add_argument('--checksum-block-words', type=int, default=DEFAULT_CHECKSUM_BLOCK_WORDS, dest='checksum_block_words', help='Words of memory summarized by each checksum')
+
 def _listen_command(app: HostApp, args):
-    app.listen_perpetually(verbose=False)
+    console = ConsoleSink.open(args.output, args.flush_seconds)
+    try:
+        app.listen_perpetually(verbose=False, console=console, report_seconds=args.report_seconds)
+    finally:
+        console.close()
+
+def _compile_command(app: Optional[HostApp], args):
+    program = _open_program(args)
+    if args.optimize or args.dram_zeroed:
+        program, stats = optimize_nbf(NbfArray.from_file(program) if isinstance(program, str) else program, dram_zeroed=args.dram_zeroed)
+        log(LogDomain.COMMAND, f"Optimized: {stats}")
+        count = save_nbf_binary(program, args.output)
+    elif isinstance(program, NbfArray):
+        count = save_nbf_binary(program, args.output)
+    else:
+        count = compile_nbf(args.file, args.output)
+    log(LogDomain.COMMAND, f"Compiled {count} commands into {args.output}")
 
 def _test_command(app: HostApp, args):
-    app.test_memory(
+    report = app.test_memory(
             verbose=args.verbose,
             sliding_window_num_commands=args.window_size,
             write_responses=args.write_responses,
-            words=args.words
+            words=args.words,
+            ranges=args.ranges,
+            patterns=args.patterns,
+            seed=args.seed,
+            region_bytes=args.region_bytes
     )
     app.print_summary_statistics()
+    for line in report.format_lines():
+        log(LogDomain.COMMAND, line)
+    if args.fault_map:
+        with open(args.fault_map, 'w') as f:
+            json.dump(report.to_json(), f, indent=2)
+
+def parse_memtest_patterns(value: str) -> List[str]:
+    patterns = value.split(',')
+    for pattern in patterns:
+        if pattern not in MEMTEST_PATTERNS:
+            raise argparse.ArgumentTypeError(f"unknown pattern \"{pattern}\"; expected some of {', '.join(MEMTEST_PATTERNS)}")
+    return patterns
+
+def parse_memtest_range(value: str) -> MemoryRange:
+    try:
+        return parse_range(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def add_image_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--image-cache-dir', type=str, default=None, dest='image_cache_dir', help='Directory of parsed nbf files (defaults to ~/.cache/arty-parrot/images)')
+    parser.add_argument('--image-cache-size', type=int, default=DEFAULT_IMAGE_CACHE_BYTES >> 20, dest='image_cache_mb', help='Megabytes of parsed nbf files to keep before evicting the least recently used')
+    parser.add_argument('--no-image-cache', action='store_true', dest='no_image_cache', help='Parse nbf files from scratch, without reading or updating the image cache')
+
+def configure_image_cache(args):
+    if args.no_image_cache:
+        set_default_image_cache(None)
+    else:
+        set_default_image_cache(ImageCache(args.image_cache_dir, args.image_cache_mb << 20))
+
+def parse_window_size(value: str) -> Optional[int]:
+    if value == 'auto':
+        return None
+    return int(value)
 
 if __name__ == "__main__":
     root_parser = argparse.ArgumentParser()
-    root_parser.add_argument('-p', '--port', dest='port', type=str, default='COM4', help='Serial port (full path or name)')
+    root_parser.add_argument('-p', '--port', dest='port', type=str, default='COM4', help='Serial port (full path or name), tcp://host:port for a serial port server, or memory://name')
     root_parser.add_argument('-b', '--baud', dest='baud_rate', type=int, default=1000000, help='Serial port baud rate')
     root_parser.add_argument('-t', '--timeout', dest='timeout', type=float, default=3.0, help='Timeout in seconds')
+    root_parser.add_argument('--window-log', type=str, default=None, dest='window_log', help='Write the adaptive window size and throughput over time to this CSV file')
+    root_parser.add_argument('--tx-buffer-size', type=int, default=DEFAULT_TX_BUFFER_BYTES, dest='tx_buffer_bytes', help='Coalesce outgoing commands into writes of up to this many bytes (0 writes and drains each command individually)')
+    root_parser.add_argument('--metrics', type=str, default=None, dest='metrics', help='Keep counters, latency histograms and time breakdowns in this file while running: Prometheus text for .prom, JSON otherwise')
+    root_parser.add_argument('--trace', type=str, default=None, dest='trace', help='Write a timeline of port I/O, parsing and stalls to this Chrome trace file (open in ui.perfetto.dev)')
+    root_parser.add_argument('--trace-events', type=int, default=DEFAULT_TRACE_EVENTS, dest='trace_events', help='Keep at most this many of the most recent trace events')
+    root_parser.add_argument('--profile', type=str, default=None, dest='profile', help='Profile the command and write a report of the hottest functions to this file (.pstats or .prof for raw profiler data)')
+    root_parser.add_argument('--metrics-interval', type=float, default=DEFAULT_METRICS_EXPORT_SECONDS, dest='metrics_interval', help='Seconds between rewrites of the metrics file')
+    add_image_cache_arguments(root_parser)
 
     command_parsers = root_parser.add_subparsers(dest="command")
     command_parsers.required = True
 
     load_parser = command_parsers.add_parser("load", help="Stream a file of NBF commands to the target")
-    load_parser.add_argument('file', help="NBF-formatted file to load")
+    load_parser.add_argument('file', help="NBF-formatted file, binary NBF image, .mem file or RISC-V ELF file to load")
     load_parser.add_argument('--no-unfreeze', action='store_true', dest='no_unfreeze', help='Suppress any "unfreeze" commands in the input file')
     load_parser.add_argument('--listen', action='store_true', dest='listen', help='Continue listening for incoming messages until program is aborted')
-    load_parser.add_argument('--window-size', type=int, default=256, dest='window_size', help='Specifies the maximum number of outstanding replies to allow before blocking')
+    load_parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Specifies the maximum number of outstanding replies to allow before blocking, or "auto" to size it from measured round trip times')
     load_parser.add_argument('--verbose', action='store_true', dest='verbose', help='Log all send and received commands, even if valid')
     load_parser.add_argument('--write-responses', action='store_true', dest='write_responses', help='Enable write responses in FPGA Host')
-    # TODO: add --verify which automatically implies --no-unfreeze then manually unfreezes after
+    load_parser.add_argument('--no-bursts', action='store_true', dest='no_bursts', help='Send single writes even if the FPGA host supports burst writes')
+    load_parser.add_argument('--optimize', action='store_true', dest='optimize', help='Drop dead stores and repeated commands before sending')
+    load_parser.add_argument('--incremental', action='store_true', dest='incremental', help='Only send DRAM blocks that differ from what the board was last loaded with')
+    load_parser.add_argument('--spot-checks', type=int, default=4, dest='spot_checks', help='Number of unchanged blocks to read back before an incremental load trusts the board manifest')
+    load_parser.add_argument('--resume', action='store_true', dest='resume', help='Only send the commands after the checkpoint of an interrupted load of the same program')
+    load_parser.add_argument('--resume-verify', type=int, default=DEFAULT_RESUME_VERIFY_WORDS, dest='resume_verify_words', help='Number of DRAM words stored before the checkpoint to read back before resuming (0 to trust it)')
+    load_parser.add_argument('--checkpoint-interval', type=int, default=DEFAULT_CHECKPOINT_COMMANDS, dest='checkpoint_commands', help='Add a fence to confirm a checkpoint after this many commands (0 for only the fences of the program)')
+    load_parser.add_argument('--checkpoint-dir', type=str, default=None, dest='checkpoint_dir', help='Directory of load checkpoints (defaults to ~/.cache/arty-parrot/checkpoints)')
+    load_parser.add_argument('--dram-zeroed', action='store_true', dest='dram_zeroed', help='Assert that DRAM is already zero, so zero writes to it can be skipped (implies --optimize)')
+    load_parser.add_argument('--verify', action='store_true', dest='verify', help='Verify memory after loading, and only then unfreeze the program')
+    _add_manifest_arguments(load_parser)
+    add_image_arguments(load_parser)
+    _add_checksum_arguments(load_parser)
+    _add_listen_arguments(load_parser)
     # TODO: add --verbose which prints all sent and received commands
     load_parser.set_defaults(handler=_load_command)
 
     unfreeze_parser = command_parsers.add_parser("unfreeze", help="Send an \"unfreeze\" command to the target")
     unfreeze_parser.add_argument('--listen', action='store_true', dest='listen', help='Continue listening for incoming messages until program is aborted')
+    _add_listen_arguments(unfreeze_parser)
     unfreeze_parser.set_defaults(handler=_unfreeze_command)
 
     verify_parser = command_parsers.add_parser("verify", help="Read back the results of an NBF file's memory writes and confirm that their values match the original file")
-    verify_parser.add_argument('file', help="NBF-formatted file to load")
+    verify_parser.add_argument('file', help="NBF-formatted file, .mem file or RISC-V ELF file to verify against")
+    verify_parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Specifies the maximum number of outstanding replies to allow before blocking, or "auto" to size it from measured round trip times')
+    add_image_arguments(verify_parser)
+    _add_checksum_arguments(verify_parser)
+    _add_manifest_arguments(verify_parser)
     verify_parser.set_defaults(handler=_verify_command)
 
     listen_parser = command_parsers.add_parser("listen", help="Watch for incoming messages and print the received data")
+    _add_listen_arguments(listen_parser)
     listen_parser.set_defaults(handler=_listen_command)
 
     test_parser = command_parsers.add_parser("test", help="full memory test")
-    test_parser.add_argument('--window-size', type=int, default=256, dest='window_size', help='Specifies the maximum number of outstanding replies to allow before blocking')
+    test_parser.add_argument('--window-size', type=parse_window_size, default='auto', dest='window_size', help='Specifies the maximum number of outstanding replies to allow before blocking, or "auto" to size it from measured round trip times')
     test_parser.add_argument('--verbose', action='store_true', dest='verbose', help='Log all send and received commands, even if valid')
     test_parser.add_argument('--write-responses', action='store_true', dest='write_responses', help='Enable write responses in FPGA Host')
-    test_parser.add_argument('--words', type=int, default=8192, dest='words', help='Number of words to write and read from memory')
+    test_parser.add_argument('--words', type=int, default=8192, dest='words', help='Number of words to write and read from memory, from the start of DRAM')
+    test_parser.add_argument('--range', type=parse_memtest_range, action='append', default=None, dest='ranges', help='Test START:SIZE (e.g. 0x80000000:64M) instead, or "all" of DRAM; may be repeated')
+    test_parser.add_argument('--patterns', type=parse_memtest_patterns, default=list(DEFAULT_MEMTEST_PATTERNS), dest='patterns', help=f"Comma-separated patterns to write and check, of {', '.join(MEMTEST_PATTERNS)}")
+    test_parser.add_argument('--seed', type=int, default=0, dest='seed', help='Seed of the random pattern')
+    test_parser.add_argument('--region-size', type=parse_size, default=DEFAULT_MEMTEST_REGION_BYTES, dest='region_bytes', help='Report bandwidth and faults per region of this size')
+    test_parser.add_argument('--fault-map', type=str, default=None, dest='fault_map', help='Write per-region results, flipped bits and faulty words to this JSON file')
+    _add_manifest_arguments(test_parser)
     test_parser.set_defaults(handler=_test_command)
 
-    args = root_parser.parse_args()
+    compile_parser = command_parsers.add_parser("compile", help="Convert an NBF file into a binary NBF image, which loads without parsing")
+    compile_parser.add_argument('file', help="NBF-formatted file, .mem file or RISC-V ELF file to convert")
+    compile_parser.add_argument('output', help="Path of the binary NBF image to write")
+    compile_parser.add_argument('--optimize', action='store_true', dest='optimize', help='Drop dead stores and repeated commands from the image')
+    compile_parser.add_argument('--dram-zeroed', action='store_true', dest='dram_zeroed', help='Also drop zero writes to DRAM, for boards whose DRAM is known to be zero (implies --optimize)')
+    add_image_arguments(compile_parser)
+    compile_parser.set_defaults(handler=_compile_command, requires_port=False)
 
-    app = HostApp(serial_port_name=args.port, serial_port_baud=args.baud_rate, timeout=args.timeout)
+    args = root_parser.parse_args()
+    configure_image_cache(args)
+
+    if not getattr(args, 'requires_port', True):
+        args.handler(None, args)
+        sys.exit(0)
+
+    app = HostApp(serial_port_name=args.port, serial_port_baud=args.baud_rate, timeout=args.timeout, tx_buffer_bytes=args.tx_buffer_bytes)
+    app.metrics_path = args.metrics
+    if hasattr(args, 'manifest_dir'):
+        # commands that can change DRAM keep the board manifest from going stale
+        app.manifest = BoardManifest.for_board(args.board_id or args.port, args.manifest_dir)
+    app.metrics_export_seconds = args.metrics_interval
+    if args.trace:
+        app.start_trace(args.trace_events)
     try:
-        args.handler(app, args)
+        if args.profile:
+            run_profiled(lambda: args.handler(app, args), args.profile)
+        else:
+            args.handler(app, args)
         app.close_port()
     except KeyboardInterrupt:
         app.close_port()
         print("Aborted")
         sys.exit(1)
+    finally:
+        if args.window_log:
+            app.window.write_history(args.window_log)
+        app.write_metrics()
+        if app.trace is not None:
+            app.trace.write(args.trace)
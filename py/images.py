@@ -0,0 +1,247 @@
+import os
+import re
+import struct
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from nbf import NbfArray, NbfParseError, DRAM_REGION_START
+from nbf import ADDRESS_CSR_FREEZE, ADDRESS_CSR_ICACHE_MODE, ADDRESS_CSR_DCACHE_MODE, ADDRESS_CSR_CCE_MODE
+from nbf import OPCODE_FENCE, OPCODE_READ_4, OPCODE_WRITE_4, OPCODE_WRITE_8
+
+# the mode every cache is put in before a program is loaded, as nbf files generated for the
+# board do
+CACHE_MODE_NORMAL = 1
+CACHE_MODE_CSRS = (ADDRESS_CSR_ICACHE_MODE, ADDRESS_CSR_DCACHE_MODE, ADDRESS_CSR_CCE_MODE)
+
+ELF_MAGIC = b'\x7fELF'
+_ELF_CLASS_64 = 2
+_ELF_DATA_LITTLE = 1
+_ELF_MACHINE_RISCV = 243
+_ELF_PT_LOAD = 1
+# e_phoff, e_phentsize and e_phnum of an ELF64 header
+_ELF64_HEADER = struct.Struct('<16sHHIQQQIHHHHHH')
+# p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align
+_ELF64_PROGRAM_HEADER = struct.Struct('<IIQQQQQQ')
+
+_MEM_COMMENT = re.compile(rb'//[^\n]*|/\*.*?\*/', re.DOTALL)
+_MEM_WIDE_WORD = re.compile(rb'[0-9A-Fa-f]{3}')
+
+class Segment(NamedTuple):
+    # physical address of the first byte
+    address: int
+    data: bytes
+    # zero bytes that follow the data, such as an ELF segment's bss
+    zero_fill: int = 0
+
+def csr_preamble() -> NbfArray:
+    """
+    Freezes the core and puts every cache in its normal mode, reading the modes back to check
+    them, as the nbf files generated for the board begin.
+    """
+    opcodes = [OPCODE_WRITE_8, OPCODE_FENCE] + [OPCODE_WRITE_8] * len(CACHE_MODE_CSRS) + [OPCODE_READ_4] * len(CACHE_MODE_CSRS) + [OPCODE_FENCE]
+    addresses = [ADDRESS_CSR_FREEZE, 0] + list(CACHE_MODE_CSRS) * 2 + [0]
+    data = [1, 0] + [CACHE_MODE_NORMAL] * (2 * len(CACHE_MODE_CSRS)) + [0]
+    return NbfArray.from_values(opcodes, addresses, data)
+
+def csr_postamble() -> NbfArray:
+    """
+    Fences the program's writes and unfreezes the core, as the nbf files generated for the
+    board end.
+    """
+    return NbfArray.from_values([OPCODE_FENCE, OPCODE_FENCE, OPCODE_WRITE_8], [0, 0, ADDRESS_CSR_FREEZE], [0, 0, 0])
+
+def parse_mem(text: bytes, base: int = DRAM_REGION_START) -> List[Segment]:
+    """
+    Parses a $readmemh-style file of "@offset" lines, each followed by the hex bytes stored from
+    base + offset onwards.
+    """
+    text = _MEM_COMMENT.sub(b'', text)
+    sections = text.split(b'@')
+    if sections[0].strip():
+        raise NbfParseError("mem file has data before its first @address")
+
+    segments = []
+    for section in sections[1:]:
+        fields = section.split(None, 1)
+        offset = fields[0] if fields else b''
+        body = fields[1] if len(fields) > 1 else b''
+        if _MEM_WIDE_WORD.search(body):
+            raise NbfParseError(f"mem file section @{offset.decode('ascii', errors='replace')} is not a list of bytes")
+        try:
+            segments.append(Segment(base + int(offset, 16), bytes.fromhex(body.decode('ascii'))))
+        except (ValueError, UnicodeDecodeError) as e:
+            raise NbfParseError(f"mem file section @{offset.decode('ascii', errors='replace')} is malformed: {e}")
+    return segments
+
+def parse_elf(image: bytes) -> List[Segment]:
+    """
+    Extracts the loadable segments of a little-endian RV64 ELF file, at their physical
+    addresses. Their bss is returned as zero fill.
+    """
+    if len(image) < _ELF64_HEADER.size or image[:4] != ELF_MAGIC:
+        raise NbfParseError("not an ELF file")
+    ident, _, machine, _, _, phoff, _, _, _, phentsize, phnum, _, _, _ = _ELF64_HEADER.unpack_from(image)
+    if ident[4] != _ELF_CLASS_64 or ident[5] != _ELF_DATA_LITTLE:
+        raise NbfParseError("only little-endian 64-bit ELF files are supported")
+    if machine != _ELF_MACHINE_RISCV:
+        raise NbfParseError(f"ELF file is for machine {machine}, not RISC-V")
+
+    segments = []
+    for i in range(phnum):
+        header = phoff + i * phentsize
+        if header + _ELF64_PROGRAM_HEADER.size > len(image):
+            raise NbfParseError("ELF program headers are truncated")
+        kind, _, offset, _, paddr, filesz, memsz, _ = _ELF64_PROGRAM_HEADER.unpack_from(image, header)
+        if kind != _ELF_PT_LOAD or memsz == 0:
+            continue
+        if offset + filesz > len(image):
+            raise NbfParseError(f"ELF segment at 0x{paddr:x} is truncated")
+        segments.append(Segment(paddr, image[offset:offset + filesz], memsz - filesz))
+    return segments
+
+def segments_to_nbf(segments: List[Segment], skip_zero_fill: bool = False) -> NbfArray:
+    """
+    Packs segments into stores: OPCODE_WRITE_8 for every 8-byte word they cover and
+    OPCODE_WRITE_4 for a lone 4-byte half at either end. Bytes that share a 4-byte half with a
+    segment but lie outside it are written as zero, and later segments win where segments
+    overlap. With "skip_zero_fill", the zero fill after each segment is not written.
+    """
+    half_indices = []
+    half_values = []
+    for segment in segments:
+        data = segment.data if skip_zero_fill else segment.data + bytes(segment.zero_fill)
+        if not data:
+            continue
+        lead = segment.address % 4
+        padded = bytes(lead) + data + bytes(-(lead + len(data)) % 4)
+        half_values.append(np.frombuffer(padded, dtype='<u4'))
+        half_indices.append((segment.address - lead) // 4 + np.arange(len(padded) // 4, dtype=np.uint64))
+    if not half_indices:
+        return NbfArray.from_values(OPCODE_WRITE_8, np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64))
+
+    # the last segment to cover each half decides its value
+    indices = np.concatenate(half_indices)[::-1]
+    values = np.concatenate(half_values)[::-1]
+    indices, last = np.unique(indices, return_index=True)
+    values = values[last].astype(np.uint64)
+
+    # pair the halves of fully covered words
+    low = (indices % np.uint64(2)) == 0
+    paired = np.zeros(len(indices), dtype=bool)
+    paired[:-1] = low[:-1] & (indices[1:] == indices[:-1] + np.uint64(1))
+    high_of_pair = np.zeros(len(indices), dtype=bool)
+    high_of_pair[1:] = paired[:-1]
+    single = ~paired & ~high_of_pair
+
+    pair_positions = np.flatnonzero(paired)
+    single_positions = np.flatnonzero(single)
+    addresses = np.concatenate([indices[pair_positions] * np.uint64(4), indices[single_positions] * np.uint64(4)])
+    data = np.concatenate([values[pair_positions] | (values[pair_positions + 1] << np.uint64(32)), values[single_positions]])
+    opcodes = np.concatenate([np.full(len(pair_positions), OPCODE_WRITE_8, dtype=np.uint8), np.full(len(single_positions), OPCODE_WRITE_4, dtype=np.uint8)])
+    order = np.argsort(addresses, kind='stable')
+    return NbfArray.from_values(opcodes[order], addresses[order], data[order])
+
+def is_image(path: str) -> bool:
+    """
+    Checks whether a file is a .mem or ELF image rather than an nbf file.
+    """
+    if path.lower().endswith('.mem'):
+        return True
+    with open(path, mode='rb') as f:
+        return f.read(len(ELF_MAGIC)) == ELF_MAGIC
+
+def program_from_image(path: str, mem_base: int = DRAM_REGION_START, skip_zero_fill: bool = False) -> NbfArray:
+    """
+    Converts a .mem or ELF image into a program that freezes the core, sets up its caches,
+    stores the image and unfreezes the core, like the nbf files generated for the board.
+    """
+    with open(path, mode='rb') as f:
+        image = f.read()
+    if image[:len(ELF_MAGIC)] == ELF_MAGIC:
+        segments = parse_elf(image)
+    else:
+        segments = parse_mem(image, mem_base)
+    stores = segments_to_nbf(segments, skip_zero_fill)
+    return NbfArray(np.concatenate([csr_preamble().records, stores.records, csr_postamble().records]))
+
+def open_program(path: str, mem_base: int = DRAM_REGION_START, skip_zero_fill: bool = False):
+    """
+    Returns images converted into an NbfArray, and nbf files as their path, to be loaded as usual.
+    """
+    if is_image(path):
+        return program_from_image(path, mem_base, skip_zero_fill)
+    return path
+
+if __name__ == '__main__':
+    import tempfile
+    import unittest
+    from nbf import NbfCommand
+    from nbf_cache import set_default_image_cache
+
+    set_default_image_cache(None)
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def _elf(segments: List[Tuple[int, bytes, int]]) -> bytes:
+        phoff = _ELF64_HEADER.size
+        data_offset = phoff + _ELF64_PROGRAM_HEADER.size * len(segments)
+        headers = b''
+        body = b''
+        for address, data, memsz in segments:
+            headers += _ELF64_PROGRAM_HEADER.pack(_ELF_PT_LOAD, 5, data_offset + len(body), address, address, len(data), memsz, 8)
+            body += data
+        ident = ELF_MAGIC + bytes([_ELF_CLASS_64, _ELF_DATA_LITTLE, 1]) + bytes(9)
+        header = _ELF64_HEADER.pack(ident, 2, _ELF_MACHINE_RISCV, 1, DRAM_REGION_START, phoff, 0, 0, _ELF64_HEADER.size, _ELF64_PROGRAM_HEADER.size, len(segments), 0, 0, 0)
+        return header + headers + body
+
+    def _commands(program: NbfArray):
+        return [(command.opcode, command.address_int, command.data_int) for command in program]
+
+    class TestImages(unittest.TestCase):
+        def test_mem_matches_nbf(self):
+            program = program_from_image(os.path.join(repository, 'nbf', 'hello_world.mem'))
+            reference = NbfArray.from_file(os.path.join(repository, 'nbf', 'hello_world.nbf'))
+            # the generated nbf file pads the 4-byte section at 0x7900 to a full word
+            padded = NbfCommand.with_values(OPCODE_WRITE_8, 0x80007900, 0).to_bytes()
+            reference = reference[reference.records != np.frombuffer(padded, dtype=reference.records.dtype)[0]]
+            self.assertEqual(_commands(program[program.opcodes != OPCODE_WRITE_4]), _commands(reference))
+            self.assertEqual(_commands(program[program.opcodes == OPCODE_WRITE_4]), [(OPCODE_WRITE_4, 0x80007900, 0)])
+
+        def test_packing(self):
+            segments = [Segment(0x80000002, bytes(range(1, 15))), Segment(0x80000010, b'\xaa' * 4), Segment(0x80000004, b'\xbb' * 4)]
+            self.assertEqual(_commands(segments_to_nbf(segments)), [
+                (OPCODE_WRITE_8, 0x80000000, 0xbbbbbbbb02010000),
+                (OPCODE_WRITE_8, 0x80000008, 0x0e0d0c0b0a090807),
+                (OPCODE_WRITE_4, 0x80000010, 0xaaaaaaaa),
+            ])
+
+        def test_elf(self):
+            image = _elf([(0x80000000, bytes(range(16)), 32), (0x80001004, b'\x01\x02\x03\x04', 4)])
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'program.elf')
+                with open(path, 'wb') as f:
+                    f.write(image)
+                self.assertTrue(is_image(path))
+                program = program_from_image(path)
+                stores = _commands(program[len(csr_preamble()):-len(csr_postamble())])
+                self.assertEqual(stores, [
+                    (OPCODE_WRITE_8, 0x80000000, 0x0706050403020100),
+                    (OPCODE_WRITE_8, 0x80000008, 0x0f0e0d0c0b0a0908),
+                    (OPCODE_WRITE_8, 0x80000010, 0),
+                    (OPCODE_WRITE_8, 0x80000018, 0),
+                    (OPCODE_WRITE_4, 0x80001004, 0x04030201),
+                ])
+                skipped = program_from_image(path, skip_zero_fill=True)
+                self.assertEqual(len(skipped), len(program) - 2)
+
+            with self.assertRaises(NbfParseError):
+                parse_elf(image[:8])
+
+        def test_mem_errors(self):
+            with self.assertRaises(NbfParseError):
+                parse_mem(b'00 11\n@0\n22\n')
+            with self.assertRaises(NbfParseError):
+                parse_mem(b'@0\n0011 2233\n')
+            self.assertEqual(parse_mem(b'@10 // comment\n01 02\n@20\n'), [Segment(DRAM_REGION_START + 0x10, b'\x01\x02'), Segment(DRAM_REGION_START + 0x20, b'')])
+
+    unittest.main()
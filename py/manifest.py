@@ -0,0 +1,207 @@
+import os
+import re
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from nbf import NbfArray, OPCODE_WRITE_4, OPCODE_WRITE_8
+
+# DRAM is tracked in blocks of this many 8-byte words
+DEFAULT_BLOCK_WORDS = 8
+
+MANIFEST_VERSION = 1
+
+def default_manifest_directory() -> str:
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'arty-parrot', 'manifests')
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """
+    splitmix64 finalizer, applied elementwise.
+    """
+    with np.errstate(over='ignore'):
+        values = values.astype(np.uint64)
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return values ^ (values >> np.uint64(31))
+
+def dram_blocks(program: NbfArray, block_words: int = DEFAULT_BLOCK_WORDS) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Summarizes what a program stores to DRAM as one hash per block of "block_words" words.
+
+    Returns the block of every command (-1 for commands that are not DRAM writes), and the
+    sorted ids of the blocks the program writes along with their hashes. A block's hash covers
+    the last value the program writes to each of its addresses, so it only depends on the
+    memory contents the program leaves behind.
+    """
+    writes = program.opcode_mask(OPCODE_WRITE_4, OPCODE_WRITE_8) & program.dram_mask()
+    addresses = program.addresses
+    block_shift = np.uint64(3 + int(block_words).bit_length() - 1)
+    command_blocks = np.where(writes, (addresses >> block_shift).astype(np.int64), -1)
+
+    index = np.flatnonzero(writes)
+    if len(index) == 0:
+        return command_blocks, np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+
+    # the last write to each (address, size) decides the contents
+    opcodes = program.opcodes[index].astype(np.uint64)
+    keys = addresses[index] ^ (opcodes << np.uint64(56))
+    _, last_from_end = np.unique(keys[::-1], return_index=True)
+    final = index[len(index) - 1 - last_from_end]
+
+    with np.errstate(over='ignore'):
+        word_hashes = _mix(addresses[final] ^ (program.opcodes[final].astype(np.uint64) << np.uint64(56))) ^ _mix(program.data[final] + np.uint64(0x9e3779b97f4a7c15))
+    blocks = command_blocks[final].astype(np.uint64)
+    order = np.argsort(blocks, kind='stable')
+    blocks = blocks[order]
+    word_hashes = word_hashes[order]
+
+    starts = np.flatnonzero(np.concatenate(([True], blocks[1:] != blocks[:-1])))
+    with np.errstate(over='ignore'):
+        hashes = np.add.reduceat(word_hashes, starts).astype(np.uint64)
+    return command_blocks, blocks[starts], _mix(hashes)
+
+class BoardManifest:
+    """
+    What a board's DRAM was last loaded with, as block hashes from dram_blocks(), kept on disk
+    per board so that later loads only need to send the blocks that changed.
+
+    The manifest is removed before a load starts and saved once it completes, so that an
+    interrupted load never leaves a manifest that claims more than the board holds.
+    """
+    def __init__(self, path: str, block_words: int = DEFAULT_BLOCK_WORDS):
+        if block_words <= 0 or block_words & (block_words - 1):
+            raise ValueError("block_words must be a power of two")
+
+        self.path = path
+        self.block_words = block_words
+        self.block_ids = np.empty(0, dtype=np.uint64)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.loaded_time: Optional[float] = None
+
+        if os.path.exists(path):
+            with np.load(path) as stored:
+                if int(stored['version']) == MANIFEST_VERSION and int(stored['block_words']) == block_words:
+                    self.block_ids = stored['block_ids']
+                    self.hashes = stored['hashes']
+                    self.loaded_time = float(stored['loaded_time'])
+
+    @staticmethod
+    def for_board(board_id: str, directory: Optional[str] = None, block_words: int = DEFAULT_BLOCK_WORDS) -> 'BoardManifest':
+        """
+        Opens the manifest of a board, identified by its port name or another stable id.
+        """
+        directory = directory or default_manifest_directory()
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', board_id).strip('_') or 'board'
+        return BoardManifest(os.path.join(directory, name + '.npz'), block_words)
+
+    def __len__(self) -> int:
+        return len(self.block_ids)
+
+    def unchanged_mask(self, block_ids: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        """
+        Selects the given blocks whose hash matches the manifest.
+        """
+        if len(self.block_ids) == 0:
+            return np.zeros(len(block_ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.block_ids, block_ids), len(self.block_ids) - 1)
+        return (self.block_ids[positions] == block_ids) & (self.hashes[positions] == hashes)
+
+    def update(self, block_ids: np.ndarray, hashes: np.ndarray):
+        """
+        Records newly loaded blocks; blocks the load did not touch keep their old contents.
+        """
+        kept = ~np.isin(self.block_ids, block_ids)
+        block_ids = np.concatenate([self.block_ids[kept], block_ids])
+        hashes = np.concatenate([self.hashes[kept], hashes])
+        order = np.argsort(block_ids, kind='stable')
+        self.block_ids = block_ids[order]
+        self.hashes = hashes[order]
+        self.loaded_time = time.time()
+
+    def forget(self, block_ids: np.ndarray):
+        """
+        Forgets the given blocks, for when something other than a load changed them.
+        """
+        kept = ~np.isin(self.block_ids, block_ids)
+        self.block_ids = self.block_ids[kept]
+        self.hashes = self.hashes[kept]
+
+    def invalidate(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def clear(self):
+        """
+        Forgets every block, for when DRAM was changed by something other than a load.
+        """
+        self.block_ids = np.empty(0, dtype=np.uint64)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.loaded_time = None
+        self.invalidate()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = self.path + '.tmp.npz'
+        np.savez(
+            temporary,
+            version=MANIFEST_VERSION,
+            block_words=self.block_words,
+            block_ids=self.block_ids,
+            hashes=self.hashes,
+            loaded_time=self.loaded_time or time.time(),
+        )
+        os.replace(temporary, self.path)
+
+if __name__ == '__main__':
+    import tempfile
+    import unittest
+    from nbf import ADDRESS_CSR_FREEZE, DRAM_REGION_START
+
+    freeze = NbfArray.from_rows([(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1)])
+
+    class TestManifest(unittest.TestCase):
+        def test_block_hashes(self):
+            words = list(range(1, 33))
+            command_blocks, blocks, hashes = dram_blocks(NbfArray.concatenate(freeze, NbfArray.dram_writes(words)))
+            self.assertEqual(len(blocks), 4)
+            self.assertEqual(command_blocks[0], -1)
+            self.assertEqual(command_blocks[1], DRAM_REGION_START >> 6)
+
+            words[9] = 100
+            _, changed_blocks, changed_hashes = dram_blocks(NbfArray.dram_writes(words))
+            self.assertTrue(np.array_equal(blocks, changed_blocks))
+            self.assertEqual(list(hashes == changed_hashes), [True, False, True, True])
+
+            # only the final value of each address counts
+            overwritten = NbfArray.concatenate(NbfArray.dram_writes(range(1, 33)), NbfArray.dram_writes([100], DRAM_REGION_START + 72))
+            _, _, overwritten_hashes = dram_blocks(overwritten)
+            self.assertTrue(np.array_equal(changed_hashes, overwritten_hashes))
+
+        def test_round_trip(self):
+            _, blocks, hashes = dram_blocks(NbfArray.dram_writes(range(64)))
+            with tempfile.TemporaryDirectory() as directory:
+                manifest = BoardManifest.for_board('/dev/ttyUSB1', directory)
+                self.assertEqual(len(manifest), 0)
+                manifest.update(blocks, hashes)
+                manifest.save()
+
+                reopened = BoardManifest.for_board('/dev/ttyUSB1', directory)
+                self.assertTrue(reopened.unchanged_mask(blocks, hashes).all())
+                self.assertFalse(reopened.unchanged_mask(blocks, hashes + np.uint64(1)).any())
+
+                reopened.update(blocks[:2], hashes[:2] + np.uint64(1))
+                self.assertEqual(len(reopened), len(blocks))
+                self.assertEqual(list(reopened.unchanged_mask(blocks, hashes)), [False, False] + [True] * (len(blocks) - 2))
+
+                reopened.forget(blocks[:1])
+                self.assertEqual(list(reopened.unchanged_mask(blocks, hashes)), [False] * 2 + [True] * (len(blocks) - 2))
+                self.assertEqual(len(reopened), len(blocks) - 1)
+
+                reopened.invalidate()
+                self.assertEqual(len(BoardManifest.for_board('/dev/ttyUSB1', directory)), 0)
+                reopened.clear()
+                self.assertFalse(reopened.unchanged_mask(blocks, hashes).any())
+
+    unittest.main()
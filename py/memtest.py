@@ -0,0 +1,271 @@
+import re
+import time
+
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from nbf import DATA_LENGTH_BYTES, DRAM_REGION_START
+
+# the DDR3 behind the MIG on an Arty A7-100T
+DRAM_BYTES = 256 << 20
+
+# words generated, written and read back as a unit; memory use is bounded by a few blocks
+MEMTEST_BLOCK_WORDS = 4096
+# bandwidth and faults are reported per region of this many bytes
+DEFAULT_MEMTEST_REGION_BYTES = 16 << 20
+# faulty words listed individually; beyond these, faults are only counted
+MEMTEST_LISTED_FAULTS = 64
+
+# "index" writes the index of each word within its range, as the original test did
+MEMTEST_PATTERNS = ('index', 'address', 'inverted-address', 'walking-ones', 'walking-zeros', 'random')
+DEFAULT_MEMTEST_PATTERNS = ('index',)
+
+_SIZE_SUFFIXES = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+_ONE = np.uint64(1)
+
+class MemoryRange(NamedTuple):
+    start: int
+    words: int
+
+    @property
+    def end(self) -> int:
+        return self.start + self.words * DATA_LENGTH_BYTES
+
+def parse_size(value: str) -> int:
+    match = re.fullmatch(r'(0x[0-9a-f]+|\d+)([kmg]?)(?:i?b)?', value.strip().lower())
+    if match is None:
+        raise ValueError(f"expected a size like 4096, 64K or 16M, got \"{value}\"")
+    return int(match.group(1), 0) * _SIZE_SUFFIXES[match.group(2)]
+
+def parse_range(spec: str) -> MemoryRange:
+    """
+    Parses "START:SIZE", with sizes like 64M, or "all" for the whole of DRAM. Ranges must be
+    word aligned and lie within DRAM.
+    """
+    if spec == 'all':
+        start, size = DRAM_REGION_START, DRAM_BYTES
+    else:
+        start_text, _, size_text = spec.partition(':')
+        if not size_text:
+            raise ValueError(f"expected START:SIZE or \"all\", got \"{spec}\"")
+        start, size = int(start_text, 0), parse_size(size_text)
+    if start % DATA_LENGTH_BYTES or size % DATA_LENGTH_BYTES or size <= 0:
+        raise ValueError(f"range \"{spec}\" is not a whole number of words")
+    if start < DRAM_REGION_START or start + size > DRAM_REGION_START + DRAM_BYTES:
+        raise ValueError(f"range \"{spec}\" is not within the {DRAM_BYTES >> 20} MiB of DRAM at {DRAM_REGION_START:#x}")
+    return MemoryRange(start, size // DATA_LENGTH_BYTES)
+
+def _splitmix64(values: np.ndarray) -> np.ndarray:
+    with np.errstate(over='ignore'):
+        z = values + np.uint64(0x9e3779b97f4a7c15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+def pattern_block(pattern: str, addresses: np.ndarray, indices: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    The words "pattern" stores at "addresses", the "indices"-th words of their range. Every
+    pattern is a function of the address and index alone, so any block can be generated on its
+    own, for writing or for checking.
+    """
+    if pattern == 'index':
+        return indices.astype(np.uint64)
+    if pattern == 'address':
+        return addresses.copy()
+    if pattern == 'inverted-address':
+        return ~addresses
+    if pattern == 'walking-ones':
+        return _ONE << (indices.astype(np.uint64) % np.uint64(64))
+    if pattern == 'walking-zeros':
+        return ~(_ONE << (indices.astype(np.uint64) % np.uint64(64)))
+    if pattern == 'random':
+        return _splitmix64(addresses ^ _splitmix64(np.full(1, seed, dtype=np.uint64)))
+    raise ValueError(f"unknown pattern \"{pattern}\"; expected one of {', '.join(MEMTEST_PATTERNS)}")
+
+def iter_blocks(memory_range: MemoryRange, block_words: int = MEMTEST_BLOCK_WORDS):
+    """
+    Yields (addresses, indices) for successive blocks of a range.
+    """
+    for first in range(0, memory_range.words, block_words):
+        indices = np.arange(first, min(memory_range.words, first + block_words), dtype=np.uint64)
+        yield np.uint64(memory_range.start) + indices * np.uint64(DATA_LENGTH_BYTES), indices
+
+class ReadBlock:
+    """
+    Collects the replies to a block of reads. It stands in for the future of each of its reads
+    in HostEngine.send, so that a whole block needs one object rather than one per word.
+    """
+    def __init__(self, pattern: str, addresses: np.ndarray, expected: np.ndarray, written_time: float):
+        self.pattern = pattern
+        self.start = int(addresses[0])
+        self.addresses = addresses
+        self.expected = expected
+        self.actual = np.zeros(len(addresses), dtype=np.uint64)
+        self.remaining = len(addresses)
+        self.written_time = written_time
+        self.completed_time: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+    def done(self) -> bool:
+        return self.error is not None
+
+    def set_result(self, reply):
+        self.actual[(reply.address_int - self.start) // DATA_LENGTH_BYTES] = reply.data_int
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.completed_time = time.perf_counter()
+
+    def set_exception(self, error: BaseException):
+        self.error = error
+
+class RegionStats:
+    __slots__ = ('words', 'faults', 'first_time', 'last_time')
+
+    def __init__(self):
+        self.words = 0
+        self.faults = 0
+        self.first_time: Optional[float] = None
+        self.last_time: Optional[float] = None
+
+class MemoryTestReport:
+    """
+    Results of a memory test: per region of "region_bytes", the words checked, faults found
+    and the bandwidth of writing and reading them back, and overall, which data bits were seen
+    to flip and the first MEMTEST_LISTED_FAULTS faulty words.
+    """
+    def __init__(self, region_bytes: int = DEFAULT_MEMTEST_REGION_BYTES):
+        self.region_bytes = region_bytes
+        self.regions: Dict[int, RegionStats] = {}
+        self.bit_faults = np.zeros(64, dtype=np.int64)
+        self.faults: List[Tuple[str, int, int, int]] = []
+        self.fault_count = 0
+        self.words = 0
+        self.start_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+
+    def check(self, block: ReadBlock):
+        """
+        Compares a completed block with what was written, and accounts for it.
+        """
+        wrong = np.flatnonzero(block.actual != block.expected)
+        flipped = block.actual[wrong] ^ block.expected[wrong]
+        if len(wrong):
+            self.bit_faults += np.unpackbits(flipped.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little').sum(axis=0, dtype=np.int64)
+            for index in wrong[:max(0, MEMTEST_LISTED_FAULTS - len(self.faults))].tolist():
+                self.faults.append((block.pattern, int(block.addresses[index]), int(block.expected[index]), int(block.actual[index])))
+        self.fault_count += len(wrong)
+        self.words += len(block.addresses)
+
+        region_ids = (block.addresses - np.uint64(DRAM_REGION_START)) // np.uint64(self.region_bytes)
+        ids, words = np.unique(region_ids, return_counts=True)
+        faulty_ids, faults = np.unique(region_ids[wrong], return_counts=True)
+        fault_counts = dict(zip(faulty_ids.tolist(), faults.tolist()))
+        for region_id, count in zip(ids.tolist(), words.tolist()):
+            region = self.regions.get(region_id)
+            if region is None:
+                region = self.regions[region_id] = RegionStats()
+            region.words += count
+            region.faults += fault_counts.get(region_id, 0)
+            region.first_time = block.written_time if region.first_time is None else min(region.first_time, block.written_time)
+            region.last_time = block.completed_time if region.last_time is None else max(region.last_time, block.completed_time)
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def region_address(self, region_id: int) -> int:
+        return DRAM_REGION_START + region_id * self.region_bytes
+
+    def region_bandwidth(self, region: RegionStats) -> Optional[float]:
+        """
+        Bytes written and read back per second over the time the region was being tested.
+        """
+        if region.first_time is None or region.last_time <= region.first_time:
+            return None
+        return 2 * DATA_LENGTH_BYTES * region.words / (region.last_time - region.first_time)
+
+    def to_json(self) -> Dict[str, Any]:
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        return {
+            'words': self.words,
+            'faults': self.fault_count,
+            'elapsed_seconds': elapsed,
+            'bytes_per_second': 2 * DATA_LENGTH_BYTES * self.words / elapsed if elapsed > 0 else None,
+            'region_bytes': self.region_bytes,
+            'regions': [
+                {
+                    'address': self.region_address(region_id),
+                    'words': region.words,
+                    'faults': region.faults,
+                    'bytes_per_second': self.region_bandwidth(region),
+                }
+                for region_id, region in sorted(self.regions.items())
+            ],
+            'bit_faults': self.bit_faults.tolist(),
+            'listed_faults': [
+                {'pattern': pattern, 'address': address, 'expected': expected, 'actual': actual}
+                for pattern, address, expected, actual in self.faults
+            ],
+        }
+
+    def format_lines(self) -> List[str]:
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        lines = [f"Memory test: {self.words} words checked in {elapsed:.2f} s, {self.fault_count} faulty"]
+        for region_id, region in sorted(self.regions.items()):
+            bandwidth = self.region_bandwidth(region)
+            rate = "n/a" if bandwidth is None else f"{bandwidth / 1024:.1f} KiB/s"
+            lines.append(f" {self.region_address(region_id):#012x} {region.words:>9} words {region.faults:>7} faults {rate:>14}")
+        if self.fault_count:
+            bits = [str(bit) for bit in np.flatnonzero(self.bit_faults).tolist()]
+            lines.append(f" Flipped data bits: {', '.join(bits)}")
+            for pattern, address, expected, actual in self.faults:
+                lines.append(f" {pattern:<16} {address:#012x}: expected {expected:016x}, read {actual:016x}")
+            if self.fault_count > len(self.faults):
+                lines.append(f" ... and {self.fault_count - len(self.faults)} more")
+        return lines
+
+if __name__ == '__main__':
+    import unittest
+
+    class _Reply(NamedTuple):
+        address_int: int
+        data_int: int
+
+    class TestMemoryTest(unittest.TestCase):
+        def test_parse_range(self):
+            self.assertEqual(parse_range('0x80000000:64K'), MemoryRange(0x80000000, 8192))
+            self.assertEqual(parse_range('all').end, DRAM_REGION_START + DRAM_BYTES)
+            for spec in ('0x80000004:64', '0x0:64', '0x8ff00000:2M', '0x80000000'):
+                with self.assertRaises(ValueError):
+                    parse_range(spec)
+
+        def test_patterns(self):
+            addresses, indices = next(iter_blocks(MemoryRange(DRAM_REGION_START, 100), block_words=66))
+            self.assertEqual(len(addresses), 66)
+            self.assertEqual(pattern_block('walking-ones', addresses, indices)[[0, 1, 63, 64]].tolist(), [1, 2, 1 << 63, 1])
+            self.assertEqual(int(pattern_block('walking-zeros', addresses, indices)[0]), (1 << 64) - 2)
+            self.assertEqual(int(pattern_block('inverted-address', addresses, indices)[1]), ~(DRAM_REGION_START + 8) & ((1 << 64) - 1))
+            random = pattern_block('random', addresses, indices, seed=1)
+            # generated blocks agree with each other, whatever their extent
+            self.assertEqual(pattern_block('random', addresses[10:], indices[10:], seed=1).tolist(), random[10:].tolist())
+            self.assertNotEqual(pattern_block('random', addresses, indices, seed=2).tolist(), random.tolist())
+            self.assertEqual(len(set(random.tolist())), len(random))
+
+        def test_report(self):
+            report = MemoryTestReport(region_bytes=64)
+            addresses = np.uint64(DRAM_REGION_START) + np.arange(16, dtype=np.uint64) * np.uint64(8)
+            expected = pattern_block('address', addresses, np.arange(16, dtype=np.uint64))
+            block = ReadBlock('address', addresses, expected, time.perf_counter())
+            for address, value in zip(addresses.tolist(), expected.tolist()):
+                block.set_result(_Reply(address, value ^ (0b101 if address == DRAM_REGION_START + 72 else 0)))
+            self.assertEqual(block.remaining, 0)
+            report.check(block)
+            report.finish()
+
+            result = report.to_json()
+            self.assertEqual((result['words'], result['faults']), (16, 1))
+            self.assertEqual([region['faults'] for region in result['regions']], [0, 1])
+            self.assertEqual(np.flatnonzero(result['bit_faults']).tolist(), [0, 2])
+            self.assertEqual(result['listed_faults'][0]['address'], DRAM_REGION_START + 72)
+
+    unittest.main()
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+from nbf import opcode_name
+
+# latency bucket b counts round trips of [2^(b-1), 2^b) microseconds; bucket 0 those under 1 us
+LATENCY_BUCKETS = 32
+
+# the engine samples the window and byte rates this often
+DEFAULT_METRICS_SAMPLE_SECONDS = 0.1
+# and rewrites the metrics file, if any, this often
+DEFAULT_METRICS_EXPORT_SECONDS = 1.0
+# samples kept for the timeline; older ones are dropped
+METRICS_TIMELINE_SAMPLES = 3600
+
+# where time goes, from the point of view of the operation sending commands:
+# window_wait  - waiting for replies before a command fits in the window (the target is slow)
+# queue_wait   - waiting for the writer to catch up with the queued bytes (the link is slow)
+# port_write   - the writer thread inside port writes (the link or the driver is slow)
+# reply_wait   - the reader thread waiting for bytes while replies are outstanding
+# parse        - decoding and correlating what was received (Python is slow)
+METRICS_PHASES = ('window_wait', 'queue_wait', 'port_write', 'reply_wait', 'parse')
+
+PROMETHEUS_PREFIX = 'arty_host'
+
+def _add_counts(counts: List[int], opcodes: np.ndarray):
+    histogram = np.bincount(opcodes, minlength=256)
+    for opcode in np.flatnonzero(histogram).tolist():
+        counts[opcode] += int(histogram[opcode])
+
+class LatencyHistogram:
+    """
+    Reply round trip times in power-of-two buckets of microseconds, cheap enough to update for
+    every reply.
+    """
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * LATENCY_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds: float):
+        self.counts[min(LATENCY_BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+        self.count += 1
+        self.sum += seconds
+
+    @staticmethod
+    def bucket_bound(bucket: int) -> float:
+        """
+        Upper bound of a bucket, in seconds.
+        """
+        return (1 << bucket) / 1e6
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Upper bound of the bucket holding the q-th percentile, in seconds.
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bucket_bound(bucket)
+        return self.bucket_bound(LATENCY_BUCKETS - 1)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum_seconds': self.sum,
+            'buckets': {f"{self.bucket_bound(bucket):.6g}": count for bucket, count in enumerate(self.counts) if count},
+        }
+
+class MetricsSample(NamedTuple):
+    time: float
+    outstanding: int
+    window: int
+    # over the interval ending at "time"
+    tx_bytes_per_second: float
+    rx_bytes_per_second: float
+
+class HostMetrics:
+    """
+    Counters for one HostApp, kept on the hot paths of HostEngine, so each update is a plain
+    increment: commands sent and received by opcode, bytes in each direction, reply latency
+    histograms by opcode, control register error bits and time spent in each of
+    METRICS_PHASES. Opcode counters are lists indexed by opcode; streamed chunks are counted
+    with one bincount each.
+
+    HostEngine calls sample() periodically, which adds to a timeline of window occupancy and
+    byte rates.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.commands_sent = [0] * 256
+        self.commands_received = [0] * 256
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.reply_latency: Dict[int, LatencyHistogram] = {}
+        self.seconds = dict.fromkeys(METRICS_PHASES, 0.0)
+        self.ctrl_reads = 0
+        self.ctrl_errors = {'rd_error': 0, 'wr_error': 0}
+        self.timeline: Deque[MetricsSample] = deque(maxlen=METRICS_TIMELINE_SAMPLES)
+        self._last_sample = (self.start_time, 0, 0)
+
+    def count_sent(self, opcodes: np.ndarray):
+        _add_counts(self.commands_sent, opcodes)
+
+    def count_received(self, opcodes: np.ndarray):
+        _add_counts(self.commands_received, opcodes)
+
+    def latency(self, opcode: int) -> LatencyHistogram:
+        histogram = self.reply_latency.get(opcode)
+        if histogram is None:
+            histogram = self.reply_latency[opcode] = LatencyHistogram()
+        return histogram
+
+    def sample(self, now: float, outstanding: int, window: int):
+        last_time, last_tx, last_rx = self._last_sample
+        interval = now - last_time
+        if interval <= 0:
+            return
+        self.timeline.append(MetricsSample(now - self.start_time, outstanding, window, (self.tx_bytes - last_tx) / interval, (self.rx_bytes - last_rx) / interval))
+        self._last_sample = (now, self.tx_bytes, self.rx_bytes)
+
+    def _by_opcode(self, counts: List[int]) -> Dict[str, int]:
+        return {opcode_name(opcode): count for opcode, count in enumerate(counts) if count}
+
+    def to_json(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'elapsed_seconds': elapsed,
+            'cpu_seconds': time.process_time() - self.start_cpu,
+            'commands_sent': self._by_opcode(self.commands_sent),
+            'commands_received': self._by_opcode(self.commands_received),
+            'bytes': {'tx': self.tx_bytes, 'rx': self.rx_bytes},
+            'bytes_per_second': {'tx': self.tx_bytes / elapsed, 'rx': self.rx_bytes / elapsed},
+            'reply_latency': {opcode_name(opcode): histogram.to_json() for opcode, histogram in sorted(self.reply_latency.items())},
+            'seconds': dict(self.seconds),
+            'ctrl_reads': self.ctrl_reads,
+            'ctrl_errors': dict(self.ctrl_errors),
+            'timeline': [sample._asdict() for sample in self.timeline],
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format, for node_exporter's textfile
+        collector or anything else that scrapes it.
+        """
+        p = PROMETHEUS_PREFIX
+        lines = [f"# TYPE {p}_commands_total counter"]
+        for direction, counts in (('tx', self.commands_sent), ('rx', self.commands_received)):
+            for name, count in self._by_opcode(counts).items():
+                lines.append(f'{p}_commands_total{{direction="{direction}",opcode="{name}"}} {count}')
+        lines.append(f"# TYPE {p}_bytes_total counter")
+        lines.append(f'{p}_bytes_total{{direction="tx"}} {self.tx_bytes}')
+        lines.append(f'{p}_bytes_total{{direction="rx"}} {self.rx_bytes}')
+        if self.timeline:
+            latest = self.timeline[-1]
+            lines.append(f"# TYPE {p}_bytes_per_second gauge")
+            lines.append(f'{p}_bytes_per_second{{direction="tx"}} {latest.tx_bytes_per_second}')
+            lines.append(f'{p}_bytes_per_second{{direction="rx"}} {latest.rx_bytes_per_second}')
+            lines.append(f"# TYPE {p}_outstanding_replies gauge")
+            lines.append(f"{p}_outstanding_replies {latest.outstanding}")
+            lines.append(f"# TYPE {p}_window_size gauge")
+            lines.append(f"{p}_window_size {latest.window}")
+        lines.append(f"# TYPE {p}_reply_latency_seconds histogram")
+        for opcode, histogram in sorted(self.reply_latency.items()):
+            label = f'opcode="{opcode_name(opcode)}"'
+            cumulative = 0
+            for bucket, count in enumerate(histogram.counts):
+                cumulative += count
+                lines.append(f'{p}_reply_latency_seconds_bucket{{{label},le="{histogram.bucket_bound(bucket):.6g}"}} {cumulative}')
+            lines.append(f'{p}_reply_latency_seconds_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f"{p}_reply_latency_seconds_sum{{{label}}} {histogram.sum}")
+            lines.append(f"{p}_reply_latency_seconds_count{{{label}}} {histogram.count}")
+        lines.append(f"# TYPE {p}_seconds_total counter")
+        for phase, seconds in self.seconds.items():
+            lines.append(f'{p}_seconds_total{{phase="{phase}"}} {seconds}')
+        lines.append(f"# TYPE {p}_ctrl_reads_total counter")
+        lines.append(f"{p}_ctrl_reads_total {self.ctrl_reads}")
+        lines.append(f"# TYPE {p}_ctrl_errors_total counter")
+        for bit, count in self.ctrl_errors.items():
+            lines.append(f'{p}_ctrl_errors_total{{bit="{bit}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """
+        Replaces "path" with the current metrics: Prometheus text for .prom files, JSON otherwise.
+        Readers never see a partly written file.
+        """
+        if path.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_json(), indent=2) + "\n"
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(text)
+        os.replace(temporary, path)
+
+    def summary_lines(self) -> Iterator[str]:
+        elapsed = time.perf_counter() - self.start_time
+        cpu = time.process_time() - self.start_cpu
+        yield f"Link: {self.tx_bytes / elapsed:.0f} B/s out, {self.rx_bytes / elapsed:.0f} B/s in over {elapsed:.2f} s, {cpu:.2f} s of CPU"
+        yield "Time: " + ", ".join(f"{phase.replace('_', ' ')} {seconds:.2f} s" for phase, seconds in self.seconds.items())
+        for opcode, histogram in sorted(self.reply_latency.items()):
+            yield f"Latency {opcode_name(opcode):<10} {histogram.count} replies, p50 < {histogram.percentile(50) * 1e3:.3g} ms, p99 < {histogram.percentile(99) * 1e3:.3g} ms"
+        if self.ctrl_reads:
+            yield f"Control register: {self.ctrl_reads} reads, {self.ctrl_errors['rd_error']} rd_error, {self.ctrl_errors['wr_error']} wr_error"
+        occupancy = [sample.outstanding / sample.window for sample in self.timeline if sample.window]
+        if occupancy:
+            yield f"Window occupancy: mean {np.mean(occupancy):.0%}, full {np.mean(np.array(occupancy) >= 1):.0%} of the time"
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    from nbf import OPCODE_READ_8, OPCODE_WRITE_8
+
+    class TestHostMetrics(unittest.TestCase):
+        def test_histogram(self):
+            histogram = LatencyHistogram()
+            for microseconds in [0.5, 3, 3, 100, 5000]:
+                histogram.add(microseconds / 1e6)
+            self.assertEqual(histogram.count, 5)
+            self.assertEqual(histogram.counts[0], 1)
+            self.assertEqual(histogram.counts[2], 2)
+            # 3 us falls in [2, 4)
+            self.assertEqual(histogram.percentile(50), 4e-6)
+            self.assertEqual(histogram.percentile(100), 8192e-6)
+
+        def test_export(self):
+            metrics = HostMetrics()
+            metrics.count_sent(np.array([OPCODE_WRITE_8] * 3 + [OPCODE_READ_8], dtype=np.uint8))
+            metrics.count_received(np.array([OPCODE_READ_8], dtype=np.uint8))
+            metrics.latency(OPCODE_READ_8).add(0.001)
+            metrics.tx_bytes = 56
+            metrics.sample(metrics.start_time + 1.0, 1, 4)
+
+            report = metrics.to_json()
+            self.assertEqual(report['commands_sent'], {opcode_name(OPCODE_WRITE_8): 3, opcode_name(OPCODE_READ_8): 1})
+            self.assertEqual(report['timeline'][0]['tx_bytes_per_second'], 56.0)
+
+            text = metrics.to_prometheus()
+            self.assertIn(f'arty_host_commands_total{{direction="tx",opcode="{opcode_name(OPCODE_WRITE_8)}"}} 3', text)
+            self.assertIn(f'arty_host_reply_latency_seconds_count{{opcode="{opcode_name(OPCODE_READ_8)}"}} 1', text)
+
+            with tempfile.TemporaryDirectory() as directory:
+                for name in ('metrics.json', 'metrics.prom'):
+                    path = os.path.join(directory, name)
+                    metrics.write(path)
+                    metrics.write(path)
+                    self.assertEqual(os.listdir(directory).count(name), 1)
+                with open(os.path.join(directory, 'metrics.json')) as f:
+                    self.assertEqual(json.load(f)['bytes']['tx'], 56)
+                self.assertEqual(sorted(os.listdir(directory)), ['metrics.json', 'metrics.prom'])
+
+    unittest.main()
@@ -1,9 +1,16 @@
-from typing import Optional
+import hashlib
+import mmap
+import struct
+from typing import Iterable, List, Optional, Tuple, Union
+
+import numpy as np
 
 # host -> device
 # TODO: 4-byte versions omitted
 OPCODE_WRITE_4 = 0x02
 OPCODE_WRITE_8 = 0x03
+# followed by "data" 8-byte words instead of further commands, see encode_bursts
+OPCODE_BURST_WRITE_8 = 0x0b
 OPCODE_READ_4 = 0x12
 OPCODE_READ_8 = 0x13
 OPCODE_FENCE = 0xfe
@@ -16,24 +23,91 @@ OPCODE_CTRL_READ = 0x43
 CTRL_BIT_READ_ERROR = 0x0
 CTRL_BIT_WRITE_ERROR = 0x1
 CTRL_BIT_WRITE_RESP = 0x2
+# read-only capability bits, reported above the control register by OPCODE_CTRL_READ
+CTRL_BIT_BURST_WRITE = 0x3
 
 # device -> host
 OPCODE_CORE_DONE = 0x80
 OPCODE_ERROR = 0x81
 OPCODE_PUTCH = 0x82
 
+OPCODE_NAMES = {
+    OPCODE_WRITE_4: 'write_4',
+    OPCODE_WRITE_8: 'write_8',
+    OPCODE_BURST_WRITE_8: 'burst_write_8',
+    OPCODE_READ_4: 'read_4',
+    OPCODE_READ_8: 'read_8',
+    OPCODE_FENCE: 'fence',
+    OPCODE_FINISH: 'finish',
+    OPCODE_CTRL_SET: 'ctrl_set',
+    OPCODE_CTRL_CLEAR: 'ctrl_clear',
+    OPCODE_CTRL_WRITE: 'ctrl_write',
+    OPCODE_CTRL_READ: 'ctrl_read',
+    OPCODE_CORE_DONE: 'core_done',
+    OPCODE_ERROR: 'error',
+    OPCODE_PUTCH: 'putch',
+}
+
+def opcode_name(opcode: int) -> str:
+    return OPCODE_NAMES.get(opcode, f"{opcode:02x}")
+
 # CSR addresses
 ADDRESS_CSR_FREEZE = 0x0000200008
 ADDRESS_CSR_ICACHE_MODE = 0x0000200204
 ADDRESS_CSR_DCACHE_MODE = 0x0000200404
 ADDRESS_CSR_CCE_MODE = 0x0000200604
 
+# physical address range backed by DRAM
+DRAM_REGION_START = 0x00_8000_0000
+DRAM_REGION_END = 0x10_0000_0000
+
+# where a core starts fetching once unfrozen
+ADDRESS_BOOT_PC = DRAM_REGION_START
+# IO addresses that bp_fpga_host_io_out turns into OPCODE_PUTCH and OPCODE_CORE_DONE messages
+ADDRESS_PUTCH = 0x00_0010_1000
+ADDRESS_FINISH = 0x00_0010_2000
+
 # addresses are 40-bit by default
 ADDRESS_LENGTH_BYTES = 5
 DATA_LENGTH_BYTES = 8
 
 NBF_COMMAND_LENGTH_BYTES = 1 + ADDRESS_LENGTH_BYTES + DATA_LENGTH_BYTES
 
+# binary images are a fixed header followed by commands in wire order
+# header: magic, format version, record length, record count, sha256 of the records
+NBF_BINARY_MAGIC = b'NBFB'
+NBF_BINARY_VERSION = 1
+_NBF_BINARY_HEADER = struct.Struct('<4sHHQ32s')
+NBF_BINARY_HEADER_LENGTH_BYTES = _NBF_BINARY_HEADER.size
+
+# one NBF command per record, laid out exactly as on the wire
+NBF_DTYPE = np.dtype([
+    ('opcode', np.uint8),
+    ('address', np.uint8, (ADDRESS_LENGTH_BYTES,)),
+    ('data', np.uint8, (DATA_LENGTH_BYTES,)),
+])
+
+# textual commands are "oo_aaaaaaaaaa_dddddddddddddddd"
+_NBF_TEXT_LINE_LENGTH = 2 + 1 + 2 * ADDRESS_LENGTH_BYTES + 1 + 2 * DATA_LENGTH_BYTES
+_NBF_TEXT_ADDRESS_COLUMN = 3
+_NBF_TEXT_DATA_COLUMN = _NBF_TEXT_ADDRESS_COLUMN + 2 * ADDRESS_LENGTH_BYTES + 1
+
+_HEX_NIBBLES = np.full(256, 0xff, dtype=np.uint8)
+_HEX_NIBBLES[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+_HEX_NIBBLES[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+_HEX_NIBBLES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+# commands are decoded in batches of this many bytes when iterating over a buffer
+STREAM_DECODE_BYTES = 4096 * NBF_COMMAND_LENGTH_BYTES
+
+# fpga_host_burst_max_words_gp: the most words one burst write carries
+BURST_MAX_WORDS = 256
+# shorter runs of writes take fewer bytes as individual commands
+BURST_MIN_WORDS = 3
+_BURST_COUNT_MASK = (1 << BURST_MAX_WORDS.bit_length()) - 1
+
+_ADDRESS_BYTE_WEIGHTS = np.array([1 << (8 * i) for i in range(ADDRESS_LENGTH_BYTES)], dtype=np.uint64)
+
 class NbfParseError(RuntimeError):
     def __init__(self, message: str):
         super(NbfParseError, self).__init__(message)
@@ -41,10 +115,22 @@ class NbfParseError(RuntimeError):
 def reverse_bytes(b: bytes) -> bytes:
     return bytes(reversed(b))
 
+# wire layout of a command: opcode, low 32 bits of address, high 8 bits of address, data
+_NBF_WIRE = struct.Struct('<BIBQ')
+_ADDRESS_HEX_FORMAT = f"0{2 * ADDRESS_LENGTH_BYTES}x"
+_DATA_HEX_FORMAT = f"0{2 * DATA_LENGTH_BYTES}x"
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
 class NbfCommand:
+    """
+    A single NBF command. Address and data are held as decoded integers and the wire encoding
+    is computed once at construction, so commands should be treated as immutable.
+    """
+    __slots__ = ('opcode', 'address_int', 'data_int', '_wire')
+
     opcode: int
-    address: bytes
-    data: bytes
+    address_int: int
+    data_int: int
 
     def __init__(self, opcode, address, data):
         if len(address) != ADDRESS_LENGTH_BYTES:
@@ -54,110 +140,593 @@ class NbfCommand:
             raise ValueError(f"invalid data length, must be exactly {DATA_LENGTH_BYTES} bytes")
 
         self.opcode = opcode
-        self.address = address
-        self.data = data
+        self.address_int = int.from_bytes(address, 'little')
+        self.data_int = int.from_bytes(data, 'little')
+        self._wire = bytes((opcode,)) + bytes(address) + bytes(data)
+
+    @classmethod
+    def _from_fields(cls, opcode: int, address_int: int, data_int: int, wire: bytes) -> 'NbfCommand':
+        command = cls.__new__(cls)
+        command.opcode = opcode
+        command.address_int = address_int
+        command.data_int = data_int
+        command._wire = wire
+        return command
 
     @staticmethod
     def with_values(opcode: int, address_int: int, data_int: int) -> 'NbfCommand':
         """
         Creates an NbfCommand from integer values of address and data, rather than byte buffers.
         """
-        return NbfCommand(
-            opcode,
-            address_int.to_bytes(ADDRESS_LENGTH_BYTES, 'little'),
-            data_int.to_bytes(DATA_LENGTH_BYTES, 'little')
-        )
+        if not 0 <= address_int < (1 << (8 * ADDRESS_LENGTH_BYTES)):
+            raise OverflowError(f"address {address_int:#x} does not fit in {ADDRESS_LENGTH_BYTES} bytes")
+
+        if not 0 <= data_int < (1 << (8 * DATA_LENGTH_BYTES)):
+            raise OverflowError(f"data {data_int:#x} does not fit in {DATA_LENGTH_BYTES} bytes")
+
+        wire = _NBF_WIRE.pack(opcode, address_int & 0xffff_ffff, address_int >> 32, data_int)
+        return NbfCommand._from_fields(opcode, address_int, data_int, wire)
 
     @staticmethod
     def parse(string: str) -> 'NbfCommand':
         """
         Parses a textual nbf command, of the form "03_0080000008_ff81011301000117"
         """
-        part_strs = string.split('_')
+        part_strs = string.strip().split('_')
         if len(part_strs) != 3:
             raise NbfParseError(f"nbf command \"{string}\" malformed, should have exactly three parts")
 
         opcode_str, addr_str, data_str = part_strs
-        try:
-            opcode = int(opcode_str, 16)
-            addr = reverse_bytes(bytes.fromhex(addr_str))
-            data = reverse_bytes(bytes.fromhex(data_str))
-        except ValueError:
+        if not (opcode_str and _HEX_DIGITS.issuperset(opcode_str) and _HEX_DIGITS.issuperset(addr_str) and _HEX_DIGITS.issuperset(data_str)) \
+                or len(addr_str) % 2 != 0 or len(data_str) % 2 != 0:
             raise NbfParseError(f"nbf command \"{string}\" malformed, contains invalid hex bytes")
 
-        if len(addr) != ADDRESS_LENGTH_BYTES:
+        if len(addr_str) != 2 * ADDRESS_LENGTH_BYTES:
             raise NbfParseError(f"nbf command \"{string}\" malformed, address must be exactly {ADDRESS_LENGTH_BYTES} bytes")
 
-        if len(data) != DATA_LENGTH_BYTES:
+        if len(data_str) != 2 * DATA_LENGTH_BYTES:
             raise NbfParseError(f"nbf command \"{string}\" malformed, data must be exactly {DATA_LENGTH_BYTES} bytes")
 
-        return NbfCommand(opcode, addr, data)
+        opcode = int(opcode_str, 16)
+        if opcode > 0xff:
+            raise NbfParseError(f"nbf command \"{string}\" malformed, opcode must be a single byte")
+
+        return NbfCommand.with_values(opcode, int(addr_str, 16), int(data_str, 16))
 
-    def matches(self, opcode: int, address_int: int, data_int: Optional[int]) -> bool:
+    def matches(self, opcode: int, address_int: Optional[int], data_int: Optional[int] = None) -> bool:
         """
         Checks whether the current command has the given opcode, address and data.
-        If "data" is None, checks only opcode and address.
+        If "address_int" or "data_int" is None, that field is not checked.
         """
         return self.opcode == opcode \
-            and self.address_int == address_int \
+            and (address_int is None or self.address_int == address_int) \
             and (data_int is None or self.data_int == data_int)
 
     def __str__(self):
         """
         Stringifies to textual nbf format.
         """
-        return f"{self.opcode:02x}_{self.address_hex_str}_{reverse_bytes(self.data).hex()}"
+        return f"{self.opcode:02x}_{self.address_int:{_ADDRESS_HEX_FORMAT}}_{self.data_int:{_DATA_HEX_FORMAT}}"
+
+    def __eq__(self, other):
+        if not isinstance(other, NbfCommand):
+            return NotImplemented
+        return self._wire == other._wire
+
+    def __hash__(self):
+        return hash(self._wire)
 
     @property
-    def address_hex_str(self) -> str:
-        return reverse_bytes(self.address).hex()
+    def address(self) -> bytes:
+        return self._wire[1:1+ADDRESS_LENGTH_BYTES]
 
     @property
-    def address_int(self) -> int:
-        return int.from_bytes(self.address, 'little')
+    def data(self) -> bytes:
+        return self._wire[1+ADDRESS_LENGTH_BYTES:]
 
     @property
-    def data_hex_str(self) -> str:
-        return reverse_bytes(self.data).hex()
+    def address_hex_str(self) -> str:
+        return format(self.address_int, _ADDRESS_HEX_FORMAT)
 
     @property
-    def data_int(self) -> int:
-        return int.from_bytes(self.data, 'little')
+    def data_hex_str(self) -> str:
+        return format(self.data_int, _DATA_HEX_FORMAT)
 
     def to_bytes(self) -> bytes:
-        return self.opcode.to_bytes(1, 'little') + self.address + self.data
+        return self._wire
 
     @staticmethod
     def from_bytes(b: bytes) -> 'NbfCommand':
-        return NbfCommand(
-            int.from_bytes(b[0:1], 'little'),
-            b[1:1+ADDRESS_LENGTH_BYTES],
-            b[1+ADDRESS_LENGTH_BYTES:1+ADDRESS_LENGTH_BYTES+DATA_LENGTH_BYTES],
-        )
+        wire = bytes(b[0:NBF_COMMAND_LENGTH_BYTES])
+        opcode, address_low, address_high, data = _NBF_WIRE.unpack(wire)
+        return NbfCommand._from_fields(opcode, address_low | (address_high << 32), data, wire)
+
+    @staticmethod
+    def from_buffer(buffer) -> List['NbfCommand']:
+        """
+        Decodes a buffer of consecutive wire-order commands in bulk.
+        """
+        wire = bytes(buffer)
+        if len(wire) % NBF_COMMAND_LENGTH_BYTES != 0:
+            raise NbfParseError(f"buffer length must be a multiple of {NBF_COMMAND_LENGTH_BYTES} bytes")
+
+        make = NbfCommand._from_fields
+        return [
+            make(opcode, address_low | (address_high << 32), data, wire[offset:offset+NBF_COMMAND_LENGTH_BYTES])
+            for offset, (opcode, address_low, address_high, data)
+            in zip(range(0, len(wire), NBF_COMMAND_LENGTH_BYTES), _NBF_WIRE.iter_unpack(wire))
+        ]
 
 class NbfFile:
+    """
+    A textual nbf file, parsed through the image cache (see nbf_cache) on first use.
+    """
     def __init__(self, path: str):
         self.path = path
+        self._program: Optional['NbfArray'] = None
+
+    def _parsed(self) -> 'NbfArray':
+        if self._program is None:
+            self._program = NbfArray.from_file(self.path)
+        return self._program
 
     def __iter__(self):
-        with open(self.path, mode='r') as f:
-            for cmd in map(NbfCommand.parse, f):
-                yield cmd
+        return iter(self._parsed())
 
     def peek_length(self) -> Optional[int]:
         """
-        Reads the file to compute the total expected number of entries.
+        The total expected number of entries.
         """
-        LINE_CUTOFF = 10_000
-        count = 0
-        with open(self.path, mode='r') as f:
-            for _ in f:
-                count += 1
+        return len(self._parsed())
+
+class NbfBinaryFile:
+    """
+    A precompiled NBF image, as written by compile_nbf. The records are memory-mapped and
+    already in wire order, so they can be streamed to the target without being decoded.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, mode='rb')
+        try:
+            header = self._file.read(NBF_BINARY_HEADER_LENGTH_BYTES)
+            if len(header) != NBF_BINARY_HEADER_LENGTH_BYTES:
+                raise NbfParseError(f"binary nbf image \"{path}\" is truncated, header is incomplete")
+
+            magic, version, record_length, self.count, self.digest = _NBF_BINARY_HEADER.unpack(header)
+            if magic != NBF_BINARY_MAGIC:
+                raise NbfParseError(f"\"{path}\" is not a binary nbf image")
+            if version != NBF_BINARY_VERSION or record_length != NBF_COMMAND_LENGTH_BYTES:
+                raise NbfParseError(f"binary nbf image \"{path}\" has unsupported version {version}")
+
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+        if len(self._map) != NBF_BINARY_HEADER_LENGTH_BYTES + self.count * NBF_COMMAND_LENGTH_BYTES:
+            self.close()
+            raise NbfParseError(f"binary nbf image \"{path}\" is truncated, expected {self.count} commands")
 
-        return count
+        self.records = memoryview(self._map)[NBF_BINARY_HEADER_LENGTH_BYTES:]
+
+    @staticmethod
+    def is_binary(path: str) -> bool:
+        """
+        Checks whether the file at the given path starts with the binary image magic.
+        """
+        with open(path, mode='rb') as f:
+            return f.read(len(NBF_BINARY_MAGIC)) == NBF_BINARY_MAGIC
+
+    def close(self):
+        try:
+            if hasattr(self, 'records'):
+                self.records.release()
+            self._map.close()
+        except BufferError:
+            # arrays viewing the records are still alive; the map is released along with them
+            pass
+        self._file.close()
+
+    def __enter__(self) -> 'NbfBinaryFile':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        for offset in range(0, len(self.records), STREAM_DECODE_BYTES):
+            yield from NbfCommand.from_buffer(self.records[offset:offset+STREAM_DECODE_BYTES])
+
+    def peek_length(self) -> Optional[int]:
+        return self.count
+
+    def record(self, index: int) -> memoryview:
+        """
+        Returns the wire bytes of the command at the given index.
+        """
+        offset = index * NBF_COMMAND_LENGTH_BYTES
+        return self.records[offset:offset+NBF_COMMAND_LENGTH_BYTES]
+
+    def verify_digest(self) -> bool:
+        """
+        Checks the records against the content hash recorded in the header.
+        """
+        return hashlib.sha256(self.records).digest() == self.digest
+
+class NbfArray:
+    """
+    A columnar batch of NBF commands, backed by a NumPy structured array (NBF_DTYPE) whose
+    records are laid out exactly as on the wire. Whole programs are parsed, filtered and
+    encoded in bulk rather than one NbfCommand at a time.
+    """
+    def __init__(self, records: np.ndarray):
+        if records.dtype != NBF_DTYPE or records.ndim != 1:
+            raise ValueError("records must be a one-dimensional array of NBF_DTYPE")
+
+        self.records = records
+        self._final_dram_words: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @staticmethod
+    def from_bytes(buffer) -> 'NbfArray':
+        """
+        Views a buffer of wire-order commands without copying it.
+        """
+        if len(buffer) % NBF_COMMAND_LENGTH_BYTES != 0:
+            raise NbfParseError(f"buffer length must be a multiple of {NBF_COMMAND_LENGTH_BYTES} bytes")
+
+        return NbfArray(np.frombuffer(buffer, dtype=NBF_DTYPE))
+
+    @staticmethod
+    def from_values(opcodes, addresses, data) -> 'NbfArray':
+        """
+        Builds commands from integer columns (scalars are broadcast).
+        """
+        opcodes, addresses, data = np.broadcast_arrays(
+            np.asarray(opcodes, dtype=np.uint8),
+            np.asarray(addresses, dtype=np.uint64),
+            np.asarray(data, dtype=np.uint64),
+        )
+        records = np.empty(opcodes.size, dtype=NBF_DTYPE)
+        records['opcode'] = opcodes.ravel()
+        records['address'] = addresses.ravel().astype('<u8').view(np.uint8).reshape(-1, 8)[:, :ADDRESS_LENGTH_BYTES]
+        records['data'] = data.ravel().astype('<u8').view(np.uint8).reshape(-1, DATA_LENGTH_BYTES)
+        return NbfArray(records)
+
+    @staticmethod
+    def from_commands(commands: Iterable['NbfCommand']) -> 'NbfArray':
+        return NbfArray.from_bytes(b''.join(command.to_bytes() for command in commands))
+
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple[int, int, int]]) -> 'NbfArray':
+        """
+        Builds commands from (opcode, address, data) tuples.
+        """
+        rows = list(rows)
+        return NbfArray.from_values(*zip(*rows)) if rows else NbfArray.from_values([], [], [])
+
+    @staticmethod
+    def dram_writes(words, address: int = DRAM_REGION_START) -> 'NbfArray':
+        """
+        Builds 8-byte writes of "words" to consecutive addresses from "address".
+        """
+        words = np.asarray(words, dtype=np.uint64)
+        return NbfArray.from_values(OPCODE_WRITE_8, np.uint64(address) + np.uint64(8) * np.arange(len(words), dtype=np.uint64), words)
+
+    @staticmethod
+    def concatenate(*parts: 'NbfArray') -> 'NbfArray':
+        return NbfArray(np.concatenate([part.records for part in parts]))
+
+    @staticmethod
+    def parse(text: Union[str, bytes]) -> 'NbfArray':
+        """
+        Parses a whole textual nbf file in one pass. Files whose lines are not all in the
+        canonical fixed-width form fall back to parsing line by line.
+        """
+        if isinstance(text, str):
+            text = text.encode('ascii', errors='replace')
+        text = text.replace(b'\r', b'')
+        if text and not text.endswith(b'\n'):
+            text += b'\n'
+
+        row_length = _NBF_TEXT_LINE_LENGTH + 1
+        if len(text) % row_length != 0:
+            return NbfArray._parse_lines(text)
+
+        rows = np.frombuffer(text, dtype=np.uint8).reshape(-1, row_length)
+        well_formed = (rows[:, _NBF_TEXT_ADDRESS_COLUMN - 1] == ord('_')) \
+            & (rows[:, _NBF_TEXT_DATA_COLUMN - 1] == ord('_')) \
+            & (rows[:, -1] == ord('\n'))
+        if not well_formed.all():
+            return NbfArray._parse_lines(text)
+
+        hex_columns = np.r_[0:2, _NBF_TEXT_ADDRESS_COLUMN:_NBF_TEXT_DATA_COLUMN - 1, _NBF_TEXT_DATA_COLUMN:_NBF_TEXT_LINE_LENGTH]
+        nibbles = _HEX_NIBBLES[rows[:, hex_columns]]
+        invalid_rows = np.flatnonzero((nibbles == 0xff).any(axis=1))
+        if invalid_rows.size > 0:
+            # reports the error exactly as the per-command parser would
+            NbfCommand.parse(rows[invalid_rows[0], :-1].tobytes().decode('ascii', errors='replace'))
+
+        # each text field is big-endian; the wire order is little-endian
+        field_bytes = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+        records = np.empty(len(rows), dtype=NBF_DTYPE)
+        records['opcode'] = field_bytes[:, 0]
+        records['address'] = field_bytes[:, ADDRESS_LENGTH_BYTES:0:-1]
+        records['data'] = field_bytes[:, :ADDRESS_LENGTH_BYTES:-1]
+        return NbfArray(records)
+
+    @staticmethod
+    def _parse_lines(text: bytes) -> 'NbfArray':
+        lines = text.decode('ascii', errors='replace').splitlines()
+        return NbfArray.from_commands(NbfCommand.parse(line) for line in lines if line.strip())
+
+    @staticmethod
+    def from_file(path: str, use_cache: bool = True) -> 'NbfArray':
+        """
+        Reads a textual nbf file or a binary nbf image into memory. Textual files go through
+        the default image cache unless "use_cache" is False or caching is disabled.
+        """
+        if NbfBinaryFile.is_binary(path):
+            with NbfBinaryFile(path) as image:
+                if not image.verify_digest():
+                    raise NbfParseError(f"binary nbf image \"{path}\" does not match its content hash")
+                records = np.frombuffer(image.records, dtype=NBF_DTYPE).copy()
+            return NbfArray(records)
+
+        if use_cache:
+            from nbf_cache import default_image_cache
+            cache = default_image_cache()
+            if cache is not None:
+                return cache.load(path)
+
+        with open(path, mode='rb') as f:
+            return NbfArray.parse(f.read())
+
+    def to_text(self) -> str:
+        """
+        Formats the commands as a textual nbf file, one per line.
+        """
+        return "".join(f"{command}\n" for command in self)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, index) -> Union['NbfCommand', 'NbfArray']:
+        """
+        Integer indices return a single NbfCommand; slices, masks and index arrays return
+        a new NbfArray.
+        """
+        if isinstance(index, (int, np.integer)):
+            return NbfCommand.from_bytes(self.records[index].tobytes())
+        return NbfArray(self.records[index])
+
+    def __iter__(self):
+        wire = self.wire
+        for offset in range(0, len(wire), STREAM_DECODE_BYTES):
+            yield from NbfCommand.from_buffer(wire[offset:offset+STREAM_DECODE_BYTES])
+
+    @property
+    def opcodes(self) -> np.ndarray:
+        return self.records['opcode']
+
+    @property
+    def addresses(self) -> np.ndarray:
+        return self.records['address'].astype(np.uint64) @ _ADDRESS_BYTE_WEIGHTS
+
+    @property
+    def data(self) -> np.ndarray:
+        return np.ascontiguousarray(self.records['data']).view('<u8').reshape(-1)
+
+    @property
+    def wire(self) -> np.ndarray:
+        """
+        The records as a flat uint8 array in wire order.
+        """
+        return np.ascontiguousarray(self.records).view(np.uint8)
+
+    def opcode_mask(self, *opcodes: int) -> np.ndarray:
+        return np.isin(self.opcodes, np.array(opcodes, dtype=np.uint8))
+
+    def address_range_mask(self, start: int, end: int) -> np.ndarray:
+        """
+        Selects commands whose address lies in [start, end).
+        """
+        addresses = self.addresses
+        return (addresses >= np.uint64(start)) & (addresses < np.uint64(end))
+
+    def dram_mask(self) -> np.ndarray:
+        """
+        Selects commands whose full 8-byte word lies within DRAM.
+        """
+        return self.address_range_mask(DRAM_REGION_START, DRAM_REGION_END - DATA_LENGTH_BYTES + 1)
+
+    def command_mask(self, command: 'NbfCommand') -> np.ndarray:
+        """
+        Selects commands identical to the given command.
+        """
+        return self.records == np.frombuffer(command.to_bytes(), dtype=NBF_DTYPE)[0]
+
+    def final_dram_words(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The sorted addresses of the 8-byte words the program stores to DRAM, with the last
+        value stored to each. Computed once per array.
+        """
+        if self._final_dram_words is None:
+            dram_writes = self[self.opcode_mask(OPCODE_WRITE_8) & self.dram_mask()]
+            addresses, last_from_end = np.unique(dram_writes.addresses[::-1], return_index=True)
+            self._final_dram_words = (addresses, dram_writes.data[::-1][last_from_end])
+        return self._final_dram_words
+
+    def remember_final_dram_words(self, addresses: np.ndarray, data: np.ndarray):
+        """
+        Supplies final_dram_words() from an earlier computation, such as a cached one.
+        """
+        self._final_dram_words = (addresses, data)
+
+    def without_unfreezes(self) -> 'NbfArray':
+        return self[~self.command_mask(NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0))]
+
+    def to_bytes(self) -> bytes:
+        return self.records.tobytes()
+
+def encode_bursts(program: NbfArray, max_words: int = BURST_MAX_WORDS, min_words: int = BURST_MIN_WORDS) -> np.ndarray:
+    """
+    Encodes a program for the wire, replacing runs of at least "min_words" OPCODE_WRITE_8
+    commands to consecutive addresses with OPCODE_BURST_WRITE_8 commands of up to "max_words"
+    words each. Returns the encoded bytes as a uint8 array.
+    """
+    count = len(program)
+    if count == 0:
+        return np.empty(0, dtype=np.uint8)
+
+    opcodes = program.opcodes
+    addresses = program.addresses
+    writes = opcodes == OPCODE_WRITE_8
+    follows = np.zeros(count, dtype=bool)
+    follows[1:] = writes[1:] & writes[:-1] & (addresses[1:] == addresses[:-1] + np.uint64(DATA_LENGTH_BYTES))
+
+    # cut runs of consecutive writes into bursts of at most max_words
+    run_starts = np.flatnonzero(~follows)
+    position = np.arange(count) - run_starts[np.cumsum(~follows) - 1]
+    chunk_first = position % max_words == 0
+    chunk_starts = np.flatnonzero(chunk_first)
+    chunk_lengths = np.diff(np.append(chunk_starts, count))
+    burst_chunks = (chunk_lengths >= min_words) & writes[chunk_starts]
+    in_burst = burst_chunks[np.cumsum(chunk_first) - 1]
+    starts_burst = in_burst & chunk_first
+
+    sizes = np.where(in_burst, DATA_LENGTH_BYTES, NBF_COMMAND_LENGTH_BYTES) + np.where(starts_burst, NBF_COMMAND_LENGTH_BYTES, 0)
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    encoded = np.empty(int(sizes.sum()), dtype=np.uint8)
+    records = program.wire.reshape(count, NBF_COMMAND_LENGTH_BYTES)
+    command_bytes = np.arange(NBF_COMMAND_LENGTH_BYTES)
+
+    single = ~in_burst
+    encoded[offsets[single][:, None] + command_bytes] = records[single]
+    headers = NbfArray.from_values(OPCODE_BURST_WRITE_8, addresses[starts_burst], chunk_lengths[burst_chunks].astype(np.uint64))
+    encoded[offsets[starts_burst][:, None] + command_bytes] = headers.wire.reshape(-1, NBF_COMMAND_LENGTH_BYTES)
+    data_offsets = offsets[in_burst] + np.where(starts_burst[in_burst], NBF_COMMAND_LENGTH_BYTES, 0)
+    encoded[data_offsets[:, None] + np.arange(DATA_LENGTH_BYTES)] = records[in_burst][:, 1 + ADDRESS_LENGTH_BYTES:]
+    return encoded
+
+class NbfStreamDecoder:
+    """
+    Reference model of how bp_fpga_host_io_in frames the bytes it receives: 14-byte commands,
+    except that an OPCODE_BURST_WRITE_8 command is followed by its data words, which it
+    expands into OPCODE_WRITE_8 commands to consecutive addresses. Without "bursts", burst
+    write commands are passed on like any other, as an FPGA host without the capability would.
+    """
+    def __init__(self, bursts: bool = True):
+        self.bursts = bursts
+        self._partial = bytearray()
+        self._burst_address = 0
+        self._burst_words = 0
+        # bytes of burst headers not yet attributed to a command
+        self._header_bytes = 0
+
+    def feed(self, data: bytes) -> List[Tuple[NbfCommand, int]]:
+        """
+        Decodes the commands completed by "data", each with the number of bytes it took on the
+        wire; a burst's header is counted towards its first word.
+        """
+        self._partial += data
+        buffer = self._partial
+        decoded: List[Tuple[NbfCommand, int]] = []
+        position = 0
+        while True:
+            available = len(buffer) - position
+            if self._burst_words > 0:
+                words = min(self._burst_words, available // DATA_LENGTH_BYTES)
+                if words == 0:
+                    break
+                end = position + words * DATA_LENGTH_BYTES
+                addresses = self._burst_address + DATA_LENGTH_BYTES * np.arange(words, dtype=np.uint64)
+                values = np.frombuffer(bytes(buffer[position:end]), dtype='<u8')
+                commands = NbfArray.from_values(OPCODE_WRITE_8, addresses, values)
+                lengths = [DATA_LENGTH_BYTES] * words
+                lengths[0] += self._header_bytes
+                self._header_bytes = 0
+                decoded += zip(commands, lengths)
+                self._burst_address += words * DATA_LENGTH_BYTES
+                self._burst_words -= words
+                position = end
+                continue
+
+            frames = available // NBF_COMMAND_LENGTH_BYTES
+            if frames == 0:
+                break
+            end = position + frames * NBF_COMMAND_LENGTH_BYTES
+            if self.bursts:
+                opcodes = np.frombuffer(bytes(buffer[position:end:NBF_COMMAND_LENGTH_BYTES]), dtype=np.uint8)
+                headers = np.flatnonzero(opcodes == OPCODE_BURST_WRITE_8)
+                if len(headers) > 0:
+                    end = position + int(headers[0]) * NBF_COMMAND_LENGTH_BYTES
+            decoded += ((command, NBF_COMMAND_LENGTH_BYTES) for command in NbfCommand.from_buffer(buffer[position:end]))
+            position = end
+            if self.bursts and len(buffer) - position >= NBF_COMMAND_LENGTH_BYTES and buffer[position] == OPCODE_BURST_WRITE_8:
+                header = NbfCommand.from_bytes(buffer[position:position + NBF_COMMAND_LENGTH_BYTES])
+                self._burst_address = header.address_int
+                self._burst_words = header.data_int & _BURST_COUNT_MASK
+                self._header_bytes = NBF_COMMAND_LENGTH_BYTES if self._burst_words else 0
+                position += NBF_COMMAND_LENGTH_BYTES
+
+        del buffer[:position]
+        return decoded
+
+def compile_nbf(source_path: str, dest_path: str) -> int:
+    """
+    Converts a textual nbf file into a binary image that can be loaded without parsing.
+    Returns the number of commands written.
+    """
+    digest = hashlib.sha256()
+    count = 0
+    with open(dest_path, mode='wb') as f:
+        f.write(bytes(NBF_BINARY_HEADER_LENGTH_BYTES))
+        for command in NbfFile(source_path):
+            record = command.to_bytes()
+            f.write(record)
+            digest.update(record)
+            count += 1
+
+        f.seek(0)
+        f.write(_NBF_BINARY_HEADER.pack(
+            NBF_BINARY_MAGIC, NBF_BINARY_VERSION, NBF_COMMAND_LENGTH_BYTES, count, digest.digest()
+        ))
+
+    return count
+
+def save_nbf_binary(program: 'NbfArray', dest_path: str) -> int:
+    """
+    Writes an NbfArray as a binary image. Returns the number of commands written.
+    """
+    with open(dest_path, mode='wb') as f:
+        f.write(_NBF_BINARY_HEADER.pack(
+            NBF_BINARY_MAGIC, NBF_BINARY_VERSION, NBF_COMMAND_LENGTH_BYTES, len(program),
+            hashlib.sha256(program.records).digest()
+        ))
+        f.write(program.records)
+
+    return len(program)
+
+def open_nbf(path: str) -> Union[NbfFile, NbfBinaryFile]:
+    """
+    Opens either a textual nbf file or a binary nbf image, depending on the file contents.
+    """
+    if NbfBinaryFile.is_binary(path):
+        return NbfBinaryFile(path)
+    return NbfFile(path)
 
 if __name__ == '__main__':
+    import os
+    import tempfile
     import unittest
+    from nbf_cache import set_default_image_cache
+
+    # keep the tests out of the user's image cache
+    set_default_image_cache(None)
+
     class TestNbf(unittest.TestCase):
         def test_parse(self):
             command = NbfCommand.parse("03_00800009e0_0000000080000790")
@@ -217,4 +786,140 @@ if __name__ == '__main__':
             self.assertEqual(command.address, bytes([0xe0, 0x09, 0x00, 0x80, 0x00]))
             self.assertEqual(command.data, bytes([0x90, 0x07, 0x00, 0x80, 0x00, 0x00, 0x00, 0x00]))
 
+        def test_with_values(self):
+            command = NbfCommand.with_values(0x03, 0x800009e0, 0x80000790)
+            self.assertEqual(command.to_bytes(), NbfCommand.parse("03_00800009e0_0000000080000790").to_bytes())
+            self.assertEqual(command, NbfCommand.from_bytes(command.to_bytes()))
+            self.assertEqual(len({command, NbfCommand.parse("03_00800009e0_0000000080000790")}), 1)
+            self.assertTrue(command.matches(0x03, 0x800009e0))
+            self.assertTrue(command.matches(0x03, None, 0x80000790))
+            self.assertFalse(command.matches(0x03, 0x800009e0, 0))
+            with self.assertRaises(OverflowError):
+                NbfCommand.with_values(0x03, 1 << 40, 0)
+
+        def test_parse_malformed(self):
+            for string in ["03_00800009e0", "03_00800009e0_00000000800007zz", "03_800009e0_0000000080000790", "03_00800009e0_000080000790", "+3_00800009e0_0000000080000790"]:
+                with self.assertRaises(NbfParseError):
+                    NbfCommand.parse(string)
+
+        def test_from_buffer(self):
+            lines = ["03_00800009e0_0000000080000790", "fe_0000000000_0000000000000000", "82_ffffffffff_0000000000000041"]
+            commands = NbfCommand.from_buffer(b''.join(NbfCommand.parse(line).to_bytes() for line in lines))
+            self.assertEqual([str(command) for command in commands], lines)
+            self.assertEqual(commands[2].address_int, 0xff_ffff_ffff)
+            with self.assertRaises(NbfParseError):
+                NbfCommand.from_buffer(bytes(NBF_COMMAND_LENGTH_BYTES + 1))
+
+        def test_binary_round_trip(self):
+            lines = [
+                "03_0000200008_0000000000000001",
+                "fe_0000000000_0000000000000000",
+                "03_00800009e0_0000000080000790",
+                "03_0000200008_0000000000000000",
+            ]
+            with tempfile.TemporaryDirectory() as directory:
+                text_path = os.path.join(directory, "test.nbf")
+                binary_path = os.path.join(directory, "test.nbfb")
+                with open(text_path, mode='w') as f:
+                    f.write("\n".join(lines) + "\n")
+
+                self.assertEqual(compile_nbf(text_path, binary_path), len(lines))
+                self.assertFalse(NbfBinaryFile.is_binary(text_path))
+                self.assertTrue(NbfBinaryFile.is_binary(binary_path))
+
+                with NbfBinaryFile(binary_path) as image:
+                    self.assertEqual(len(image), len(lines))
+                    self.assertTrue(image.verify_digest())
+                    self.assertEqual([str(command) for command in image], lines)
+                    self.assertEqual(bytes(image.record(2)), NbfCommand.parse(lines[2]).to_bytes())
+
+        def test_save_binary(self):
+            program = NbfArray.parse("03_0080000000_0000000000000001\nfe_0000000000_0000000000000000\n")
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'program.nbfb')
+                self.assertEqual(save_nbf_binary(program, path), 2)
+                with NbfBinaryFile(path) as image:
+                    self.assertTrue(image.verify_digest())
+                    self.assertEqual(bytes(image.records), program.to_bytes())
+
+        def test_array_parse(self):
+            lines = [
+                "03_0000200008_0000000000000001",
+                "fe_0000000000_0000000000000000",
+                "03_00800009e0_0000000080000790",
+                "13_00800009E8_0000000000000000",
+                "03_0000200008_0000000000000000",
+            ]
+            commands = [NbfCommand.parse(line) for line in lines]
+            expected_wire = b''.join(command.to_bytes() for command in commands)
+
+            program = NbfArray.parse("\n".join(lines) + "\n")
+            self.assertEqual(len(program), len(lines))
+            self.assertEqual(program.to_bytes(), expected_wire)
+            self.assertEqual([str(command) for command in program], [str(command) for command in commands])
+
+            # irregular files take the per-line path but produce the same records
+            irregular = NbfArray.parse("\r\n".join(lines) + "\r\n\n")
+            self.assertEqual(irregular.to_bytes(), expected_wire)
+            self.assertEqual(NbfArray.parse(" " + lines[0]).to_bytes(), commands[0].to_bytes())
+
+            with self.assertRaises(NbfParseError):
+                NbfArray.parse("03_00800009e0_00000000800007zz\n")
+
+        def test_array_fields_and_masks(self):
+            program = NbfArray.from_values(
+                [OPCODE_WRITE_8, OPCODE_FENCE, OPCODE_WRITE_8, OPCODE_READ_8, OPCODE_WRITE_8],
+                [ADDRESS_CSR_FREEZE, 0, DRAM_REGION_START, DRAM_REGION_END - 8, ADDRESS_CSR_FREEZE],
+                [1, 0, 0x80000790, 0, 0],
+            )
+            self.assertEqual(program.addresses.tolist(), [ADDRESS_CSR_FREEZE, 0, DRAM_REGION_START, DRAM_REGION_END - 8, ADDRESS_CSR_FREEZE])
+            self.assertEqual(program.data.tolist(), [1, 0, 0x80000790, 0, 0])
+            self.assertEqual(program[2].to_bytes(), NbfCommand.with_values(OPCODE_WRITE_8, DRAM_REGION_START, 0x80000790).to_bytes())
+            self.assertEqual(program[-1].to_bytes(), NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0).to_bytes())
+            self.assertEqual(program.opcode_mask(OPCODE_FENCE, OPCODE_READ_8).tolist(), [False, True, False, True, False])
+            self.assertEqual(program.dram_mask().tolist(), [False, False, True, True, False])
+            self.assertEqual(len(program.without_unfreezes()), 4)
+            self.assertEqual(program.wire.tobytes(), b''.join(command.to_bytes() for command in program))
+
+            reparsed = NbfArray.from_bytes(program.to_bytes())
+            self.assertEqual(reparsed.to_bytes(), program.to_bytes())
+            self.assertEqual(NbfArray.parse(program.to_text()).to_bytes(), program.to_bytes())
+
+        def test_array_builders(self):
+            writes = NbfArray.dram_writes([5, 2 ** 64 - 1], DRAM_REGION_START + 8)
+            self.assertEqual(writes.addresses.tolist(), [DRAM_REGION_START + 8, DRAM_REGION_START + 16])
+            self.assertEqual(writes.data.tolist(), [5, 2 ** 64 - 1])
+            self.assertTrue(writes.opcode_mask(OPCODE_WRITE_8).all())
+
+            program = NbfArray.concatenate(NbfArray.from_rows([(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1)]), writes, NbfArray.from_rows([(OPCODE_FENCE, 0, 0)]))
+            self.assertEqual([command.opcode for command in program], [OPCODE_WRITE_8, OPCODE_WRITE_8, OPCODE_WRITE_8, OPCODE_FENCE])
+            self.assertEqual(program[0].address_int, ADDRESS_CSR_FREEZE)
+            self.assertEqual(len(NbfArray.from_rows([])), 0)
+
+        def test_bursts(self):
+            dram = DRAM_REGION_START
+            commands = [NbfCommand.with_values(OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1)]
+            commands += [NbfCommand.with_values(OPCODE_WRITE_8, dram + 8 * i, i) for i in range(10)]
+            # too short for a burst
+            commands += [NbfCommand.with_values(OPCODE_WRITE_8, dram + 0x1000 + 8 * i, i) for i in range(2)]
+            commands += [NbfCommand.with_values(OPCODE_FENCE, 0, 0)]
+            commands += [NbfCommand.with_values(OPCODE_WRITE_8, dram + 0x2000 + 8 * i, i) for i in range(3)]
+            program = NbfArray.from_commands(commands)
+
+            encoded = encode_bursts(program, max_words=4)
+            # bursts of 4, 4 and 3 words, and 6 single commands: the freeze, the fence, and
+            # two runs of 2 writes
+            self.assertEqual(len(encoded), NBF_COMMAND_LENGTH_BYTES * (3 + 6) + 11 * DATA_LENGTH_BYTES)
+
+            decoder = NbfStreamDecoder()
+            decoded = []
+            for offset in range(0, len(encoded), 5):
+                decoded += decoder.feed(encoded[offset:offset + 5].tobytes())
+            self.assertEqual([command.to_bytes() for command, _ in decoded], [command.to_bytes() for command in commands])
+            self.assertEqual(sum(length for _, length in decoded), len(encoded))
+
+            # an FPGA host without bursts sees the burst header as an unknown command
+            self.assertEqual(NbfStreamDecoder(bursts=False).feed(encoded[:2 * NBF_COMMAND_LENGTH_BYTES].tobytes())[1][0].opcode, OPCODE_BURST_WRITE_8)
+            self.assertEqual(encode_bursts(program, min_words=BURST_MAX_WORDS).tobytes(), program.to_bytes())
+
     unittest.main()
@@ -0,0 +1,217 @@
+import os
+import json
+import hashlib
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from nbf import NBF_DTYPE, NbfArray
+
+# the cache holds at most this many bytes of images, evicting the least recently used
+DEFAULT_IMAGE_CACHE_BYTES = 1 << 30
+
+IMAGE_CACHE_VERSION = 1
+_INDEX_NAME = 'index.json'
+_ENTRY_SUFFIX = '.npz'
+
+def default_image_cache_directory() -> str:
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'arty-parrot', 'images')
+
+class ImageCache:
+    """
+    Parsed nbf files, kept on disk by the SHA-256 of their text so that loading the same program
+    again skips parsing. Each entry holds the encoded commands along with the final DRAM words
+    they leave behind, which verify reads back.
+
+    Files are looked up by their size and modification time first, and only hashed when those
+    change. Entries are evicted least recently used first once they exceed "max_bytes".
+    """
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_IMAGE_CACHE_BYTES):
+        self.directory = directory or default_image_cache_directory()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + _ENTRY_SUFFIX)
+
+    def _read_index(self) -> Dict[str, list]:
+        try:
+            with open(os.path.join(self.directory, _INDEX_NAME)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return index if isinstance(index, dict) else {}
+
+    def _write_index(self, index: Dict[str, list]):
+        # concurrent writers may lose each other's updates, which only costs a rehash later
+        temporary = os.path.join(self.directory, f"{_INDEX_NAME}.{os.getpid()}.tmp")
+        with open(temporary, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary, os.path.join(self.directory, _INDEX_NAME))
+
+    def load(self, path: str) -> NbfArray:
+        """
+        Reads a textual nbf file, from the cache if its contents were parsed before.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        key = os.path.realpath(path)
+        stat = os.stat(path)
+        index = self._read_index()
+        known = index.get(key)
+
+        text = None
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            digest = known[2]
+        else:
+            with open(path, mode='rb') as f:
+                text = f.read()
+            digest = hashlib.sha256(text).hexdigest()
+            index[key] = [stat.st_size, stat.st_mtime_ns, digest]
+            self._write_index(index)
+
+        program = self._read_entry(digest)
+        if program is not None:
+            self.hits += 1
+            return program
+
+        self.misses += 1
+        if text is None:
+            with open(path, mode='rb') as f:
+                text = f.read()
+        program = NbfArray.parse(text)
+        self._write_entry(digest, program)
+        self.evict()
+        return program
+
+    def _read_entry(self, digest: str) -> Optional[NbfArray]:
+        entry = self._entry_path(digest)
+        try:
+            with np.load(entry) as stored:
+                if int(stored['version']) != IMAGE_CACHE_VERSION or stored['records'].dtype != NBF_DTYPE:
+                    return None
+                program = NbfArray(stored['records'])
+                program.remember_final_dram_words(stored['final_addresses'], stored['final_data'])
+        except (OSError, ValueError, KeyError):
+            return None
+        # the modification time orders entries for eviction
+        os.utime(entry)
+        return program
+
+    def _write_entry(self, digest: str, program: NbfArray):
+        addresses, data = program.final_dram_words()
+        temporary = os.path.join(self.directory, f"{digest}.{os.getpid()}.tmp{_ENTRY_SUFFIX}")
+        np.savez(
+            temporary,
+            version=IMAGE_CACHE_VERSION,
+            records=program.records,
+            final_addresses=addresses,
+            final_data=data,
+        )
+        os.replace(temporary, self._entry_path(digest))
+
+    def entries(self) -> Tuple[Tuple[str, int, float], ...]:
+        """
+        (path, size, last used) of every entry, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_ENTRY_SUFFIX) and '.tmp' not in name:
+                entry = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((entry, stat.st_size, stat.st_mtime))
+        return tuple(sorted(entries, key=lambda entry: entry[2]))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in "max_bytes", always
+        keeping the most recent one.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry, _, _ in self.entries():
+            os.remove(entry)
+        if os.path.exists(os.path.join(self.directory, _INDEX_NAME)):
+            os.remove(os.path.join(self.directory, _INDEX_NAME))
+
+_default_cache: Optional[ImageCache] = None
+_default_cache_disabled = os.environ.get('ARTY_PARROT_IMAGE_CACHE', '').lower() in ('0', 'off', 'no', 'false')
+
+def default_image_cache() -> Optional[ImageCache]:
+    """
+    The cache NbfArray.from_file reads textual nbf files through, or None if it is disabled.
+    Setting ARTY_PARROT_IMAGE_CACHE=off in the environment disables it.
+    """
+    global _default_cache
+    if _default_cache is None and not _default_cache_disabled:
+        _default_cache = ImageCache()
+    return _default_cache
+
+def set_default_image_cache(cache: Optional[ImageCache]):
+    """
+    Replaces the default cache; None disables caching.
+    """
+    global _default_cache, _default_cache_disabled
+    _default_cache = cache
+    _default_cache_disabled = cache is None
+
+if __name__ == '__main__':
+    import time
+    import tempfile
+    import unittest
+
+    class TestImageCache(unittest.TestCase):
+        def test_hits_and_changes(self):
+            with tempfile.TemporaryDirectory() as directory:
+                cache = ImageCache(os.path.join(directory, 'cache'))
+                path = os.path.join(directory, 'program.nbf')
+                with open(path, 'w') as f:
+                    f.write(NbfArray.dram_writes(range(64)).to_text())
+
+                first = cache.load(path)
+                second = cache.load(path)
+                self.assertEqual((cache.misses, cache.hits), (1, 1))
+                self.assertEqual(first.to_bytes(), second.to_bytes())
+                addresses, data = second.final_dram_words()
+                self.assertEqual(len(addresses), 64)
+                self.assertEqual(int(data[-1]), 63)
+
+                # a rewritten file is hashed again, and a copy with the same text shares the entry
+                with open(path, 'w') as f:
+                    f.write(NbfArray.dram_writes(range(1, 65)).to_text())
+                os.utime(path, ns=(time.time_ns(), time.time_ns() + 1000))
+                self.assertEqual(int(cache.load(path).final_dram_words()[1][-1]), 64)
+                copy = os.path.join(directory, 'copy.nbf')
+                with open(copy, 'w') as f:
+                    f.write(NbfArray.dram_writes(range(64)).to_text())
+                cache.load(copy)
+                self.assertEqual((cache.misses, cache.hits), (2, 2))
+
+        def test_eviction(self):
+            with tempfile.TemporaryDirectory() as directory:
+                cache = ImageCache(os.path.join(directory, 'cache'), max_bytes=1)
+                paths = []
+                for i in range(3):
+                    paths.append(os.path.join(directory, f'{i}.nbf'))
+                    with open(paths[-1], 'w') as f:
+                        f.write(NbfArray.dram_writes([i] * 16).to_text())
+                    cache.load(paths[-1])
+                self.assertEqual(len(cache.entries()), 1)
+                cache.load(paths[-1])
+                self.assertEqual(cache.hits, 1)
+
+    unittest.main()
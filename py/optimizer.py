@@ -0,0 +1,189 @@
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from nbf import NBF_COMMAND_LENGTH_BYTES, NbfArray
+from nbf import OPCODE_FENCE, OPCODE_READ_8, OPCODE_WRITE_4, OPCODE_WRITE_8
+
+# opcodes whose repetition has no further effect
+IDEMPOTENT_OPCODES = (OPCODE_WRITE_4, OPCODE_WRITE_8, OPCODE_FENCE)
+
+class OptimizeStats(NamedTuple):
+    commands_in: int
+    commands_out: int
+    # writes overwritten by a later write before the next barrier
+    dead_stores: int
+    # commands identical to the command before them
+    duplicates: int
+    # zero writes to DRAM that is already zero
+    zero_writes: int
+
+    @property
+    def commands_removed(self) -> int:
+        return self.commands_in - self.commands_out
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.commands_removed * NBF_COMMAND_LENGTH_BYTES
+
+    def __str__(self):
+        return (f"removed {self.commands_removed} of {self.commands_in} commands "
+                f"({self.dead_stores} dead stores, {self.duplicates} duplicates, {self.zero_writes} zero writes), "
+                f"saving {self.bytes_saved} bytes")
+
+def _group_max(keys: List[np.ndarray], values: np.ndarray, include: np.ndarray) -> np.ndarray:
+    """
+    For every row, the largest of "values" over the included rows with the same keys, or -1.
+    """
+    order = np.lexsort(keys[::-1])
+    sorted_keys = [key[order] for key in keys]
+    starts = np.ones(len(order), dtype=bool)
+    for key in sorted_keys:
+        starts[1:] &= key[1:] == key[:-1]
+    starts[1:] = ~starts[1:]
+    group = np.cumsum(starts) - 1
+
+    maxima = np.full(group[-1] + 1 if len(group) else 0, -1, dtype=np.int64)
+    np.maximum.at(maxima, group, np.where(include[order], values[order], -1))
+    result = np.empty(len(order), dtype=np.int64)
+    result[order] = maxima[group]
+    return result
+
+def optimize_nbf(program: NbfArray, dram_zeroed: bool = False) -> Tuple[NbfArray, OptimizeStats]:
+    """
+    Rewrites a program into one with the same effect on the target, in fewer commands.
+
+    Only writes to DRAM are ever removed or considered independent of each other; every other
+    command (fences, finish, reads, control and CSR writes) is a barrier. Within the stretch
+    between two barriers, a write is dropped if a later write covers all of its bytes. Commands
+    identical to the one before them are dropped if repeating them has no effect. If
+    "dram_zeroed" asserts that DRAM holds zeros before the program is loaded, zero writes to
+    DRAM are dropped unless an earlier write to the same word stored something else.
+    """
+    count = len(program)
+    if count == 0:
+        return program, OptimizeStats(0, 0, 0, 0, 0)
+
+    opcodes = program.opcodes
+    addresses = program.addresses
+    data = program.data
+    index = np.arange(count, dtype=np.int64)
+
+    writes = program.opcode_mask(OPCODE_WRITE_4, OPCODE_WRITE_8) & program.dram_mask()
+    segment = np.cumsum(~writes)
+    keep = np.ones(count, dtype=bool)
+
+    # dead stores: a later write to the same address with the same size, or a later 8-byte
+    # write to the word containing a 4-byte write, before the next barrier
+    last_same = _group_max([segment, addresses, opcodes.astype(np.uint64)], index, writes)
+    words = addresses & ~np.uint64(0x7)
+    last_word_write = _group_max([segment, words], index, writes & (opcodes == OPCODE_WRITE_8))
+    dead = writes & ((last_same > index) | ((opcodes == OPCODE_WRITE_4) & (last_word_write > index)))
+    keep &= ~dead
+
+    zero_writes = 0
+    if dram_zeroed:
+        # a zero write is redundant unless something else was stored to its word before it
+        nonzero_writes = writes & keep & (data != 0)
+        latest_from_end = _group_max([words], count - index, nonzero_writes)
+        first_nonzero = np.where(latest_from_end < 0, count, count - latest_from_end)
+        zero = writes & keep & (data == 0) & (index < first_nonzero)
+        zero_writes = int(np.count_nonzero(zero))
+        keep &= ~zero
+
+    # repeats of the command before them
+    kept = program[keep]
+    records = kept.records
+    repeated = np.zeros(len(kept), dtype=bool)
+    repeated[1:] = (records[1:] == records[:-1]) & kept.opcode_mask(*IDEMPOTENT_OPCODES)[1:]
+    result = kept[~repeated]
+
+    stats = OptimizeStats(
+        commands_in=count,
+        commands_out=len(result),
+        dead_stores=int(np.count_nonzero(dead)),
+        duplicates=int(np.count_nonzero(repeated)),
+        zero_writes=zero_writes,
+    )
+    return result, stats
+
+if __name__ == '__main__':
+    import unittest
+    from nbf import ADDRESS_CSR_FREEZE, DRAM_REGION_START
+
+    def _commands(program: NbfArray) -> List[Tuple[int, int, int]]:
+        return [(command.opcode, command.address_int, command.data_int) for command in program]
+
+    class TestOptimizer(unittest.TestCase):
+        def test_dead_stores(self):
+            dram = DRAM_REGION_START
+            program = NbfArray.from_rows([
+                (OPCODE_WRITE_8, dram, 1),
+                (OPCODE_WRITE_4, dram + 8, 2),
+                (OPCODE_WRITE_8, dram, 3),
+                (OPCODE_WRITE_8, dram + 8, 4),
+                (OPCODE_FENCE, 0, 0),
+                (OPCODE_WRITE_8, dram, 5),
+            ])
+            result, stats = optimize_nbf(program)
+            self.assertEqual(_commands(result), [
+                (OPCODE_WRITE_8, dram, 3),
+                (OPCODE_WRITE_8, dram + 8, 4),
+                (OPCODE_FENCE, 0, 0),
+                (OPCODE_WRITE_8, dram, 5),
+            ])
+            self.assertEqual((stats.dead_stores, stats.bytes_saved), (2, 2 * NBF_COMMAND_LENGTH_BYTES))
+
+        def test_barriers(self):
+            dram = DRAM_REGION_START
+            program = NbfArray.from_rows([
+                (OPCODE_WRITE_8, dram, 1),
+                (OPCODE_READ_8, dram, 1),
+                (OPCODE_WRITE_8, dram, 2),
+                (OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1),
+                (OPCODE_WRITE_8, dram, 3),
+                # 4-byte writes do not cover an 8-byte write
+                (OPCODE_WRITE_4, dram, 0),
+                (OPCODE_WRITE_4, dram + 4, 0),
+            ])
+            result, stats = optimize_nbf(program)
+            self.assertEqual(len(result), len(program))
+
+        def test_duplicates(self):
+            program = NbfArray.from_rows([
+                (OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1),
+                (OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 1),
+                (OPCODE_FENCE, 0, 0),
+                (OPCODE_FENCE, 0, 0),
+                (OPCODE_READ_8, DRAM_REGION_START, 0),
+                (OPCODE_READ_8, DRAM_REGION_START, 0),
+            ])
+            result, stats = optimize_nbf(program)
+            self.assertEqual(stats.duplicates, 2)
+            self.assertEqual([command.opcode for command in result], [OPCODE_WRITE_8, OPCODE_FENCE, OPCODE_READ_8, OPCODE_READ_8])
+
+        def test_zero_writes(self):
+            dram = DRAM_REGION_START
+            program = NbfArray.from_rows([
+                (OPCODE_WRITE_8, dram, 0),
+                (OPCODE_WRITE_8, dram + 8, 7),
+                (OPCODE_FENCE, 0, 0),
+                # must stay, it clears a word written earlier
+                (OPCODE_WRITE_8, dram + 8, 0),
+                (OPCODE_WRITE_8, dram + 16, 0),
+                (OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0),
+            ])
+            result, stats = optimize_nbf(program)
+            self.assertEqual(stats.zero_writes, 0)
+            self.assertEqual(len(result), len(program))
+
+            result, stats = optimize_nbf(program, dram_zeroed=True)
+            self.assertEqual(stats.zero_writes, 2)
+            self.assertEqual(_commands(result), [
+                (OPCODE_WRITE_8, dram + 8, 7),
+                (OPCODE_FENCE, 0, 0),
+                (OPCODE_WRITE_8, dram + 8, 0),
+                (OPCODE_WRITE_8, ADDRESS_CSR_FREEZE, 0),
+            ])
+
+    unittest.main()
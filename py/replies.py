@@ -0,0 +1,216 @@
+from collections import deque
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from nbf import NbfCommand, opcode_name
+from nbf import OPCODE_READ_4, OPCODE_READ_8, OPCODE_WRITE_4, OPCODE_WRITE_8
+
+# replies to these opcodes echo the address of their command; all others reply with address 0
+ADDRESSED_OPCODES = frozenset([OPCODE_WRITE_4, OPCODE_WRITE_8, OPCODE_READ_4, OPCODE_READ_8])
+
+class ReplyStatus(Enum):
+    # reply correlated with an outstanding command and was correct
+    MATCHED = 'matched'
+    # reply correlated with an outstanding command, but its contents were wrong
+    MISMATCHED = 'mismatched'
+    # reply did not correlate with any outstanding command
+    ORPHANED = 'orphaned'
+
+class OpcodeReplyStats:
+    """
+    Reply accounting for a single opcode.
+    """
+    __slots__ = ('outstanding', 'matched', 'mismatched', 'orphaned', 'reordered')
+
+    def __init__(self):
+        self.outstanding = 0
+        self.matched = 0
+        self.mismatched = 0
+        self.orphaned = 0
+        # replies that correlated with a command other than the oldest outstanding one
+        self.reordered = 0
+
+    def __str__(self):
+        return f"{self.matched} matched, {self.mismatched} mismatched, {self.orphaned} orphaned, {self.reordered} reordered, {self.outstanding} outstanding"
+
+class OutstandingReply:
+    """
+    A command waiting for its reply. "token" is opaque to the tracker and is returned along with
+    the command when the reply arrives. Replies to unchecked commands, such as reads of memory
+    whose contents are not known in advance, are accepted whatever they hold.
+    """
+    __slots__ = ('command', 'key', 'token', 'sent_time', 'checked', 'done')
+
+    def __init__(self, command: NbfCommand, key: Tuple[int, int], token: Any, sent_time: float, checked: bool = True):
+        self.command = command
+        self.key = key
+        self.token = token
+        self.sent_time = sent_time
+        self.checked = checked
+        self.done = False
+
+def reply_key(command: NbfCommand) -> Tuple[int, int]:
+    if command.opcode in ADDRESSED_OPCODES:
+        return (command.opcode, command.address_int)
+    return (command.opcode, 0)
+
+class ReplyTracker:
+    """
+    Correlates incoming replies with outstanding commands in constant time, independent of how
+    many replies are outstanding.
+
+    Commands are kept in send order in a deque, and in a hash index keyed by (opcode, address).
+    Replies are looked up in the index, so replies that come back interleaved (for example write
+    responses mixed with reads) still find their command; commands sharing a key are matched
+    oldest first. Matched commands are dropped from the front of the deque lazily.
+
+    "validate" decides whether a correlated reply is correct for its command.
+    """
+    def __init__(self, validate: Callable[[NbfCommand, NbfCommand], bool], stats: Optional[Dict[int, OpcodeReplyStats]] = None):
+        self.validate = validate
+        self.stats = stats if stats is not None else {}
+        self._in_order: Deque[OutstandingReply] = deque()
+        self._by_key: Dict[Tuple[int, int], Deque[OutstandingReply]] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[OutstandingReply]:
+        return (entry for entry in self._in_order if not entry.done)
+
+    def _stats_for(self, opcode: int) -> OpcodeReplyStats:
+        stats = self.stats.get(opcode)
+        if stats is None:
+            stats = self.stats[opcode] = OpcodeReplyStats()
+        return stats
+
+    def add(self, command: NbfCommand, token: Any = None, sent_time: float = 0.0, checked: bool = True) -> OutstandingReply:
+        key = reply_key(command)
+        entry = OutstandingReply(command, key, token, sent_time, checked)
+        self._in_order.append(entry)
+        bucket = self._by_key.get(key)
+        if bucket is None:
+            bucket = self._by_key[key] = deque()
+        bucket.append(entry)
+        self._count += 1
+        self._stats_for(command.opcode).outstanding += 1
+        return entry
+
+    def oldest(self) -> Optional[OutstandingReply]:
+        self._discard_done()
+        return self._in_order[0] if self._in_order else None
+
+    def _discard_done(self):
+        in_order = self._in_order
+        while in_order and in_order[0].done:
+            in_order.popleft()
+
+    def match(self, reply: NbfCommand) -> Tuple[ReplyStatus, Optional[OutstandingReply]]:
+        """
+        Correlates a reply with the oldest outstanding command having the same opcode and address,
+        and removes that command. Returns the outcome and the command's entry, if any.
+        """
+        key = reply_key(reply)
+        bucket = self._by_key.get(key)
+        if bucket is None:
+            self._stats_for(reply.opcode).orphaned += 1
+            return ReplyStatus.ORPHANED, None
+
+        entry = bucket.popleft()
+        if not bucket:
+            del self._by_key[key]
+
+        self._discard_done()
+        stats = self._stats_for(entry.command.opcode)
+        if self._in_order[0] is not entry:
+            stats.reordered += 1
+        entry.done = True
+        self._count -= 1
+        stats.outstanding -= 1
+        self._discard_done()
+
+        if not entry.checked or self.validate(entry.command, reply):
+            stats.matched += 1
+            return ReplyStatus.MATCHED, entry
+
+        stats.mismatched += 1
+        return ReplyStatus.MISMATCHED, entry
+
+    def clear(self):
+        """
+        Forgets all outstanding commands, e.g. after the link has failed.
+        """
+        for entry in self:
+            entry.done = True
+            self._stats_for(entry.command.opcode).outstanding -= 1
+        self._in_order.clear()
+        self._by_key.clear()
+        self._count = 0
+
+def format_reply_stats(stats: Dict[int, OpcodeReplyStats]) -> Iterator[str]:
+    for opcode in sorted(stats):
+        yield f"{opcode_name(opcode):<10} {stats[opcode]}"
+
+if __name__ == '__main__':
+    import unittest
+    from nbf import OPCODE_FENCE
+
+    def _validate(command: NbfCommand, reply: NbfCommand) -> bool:
+        expected_data = command.data_int if command.opcode in (OPCODE_READ_4, OPCODE_READ_8) else 0
+        return reply.data_int == expected_data
+
+    class TestReplyTracker(unittest.TestCase):
+        def test_in_order(self):
+            tracker = ReplyTracker(_validate)
+            tracker.add(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 1), token='a')
+            tracker.add(NbfCommand.with_values(OPCODE_FENCE, 0, 0), token='b')
+            self.assertEqual(len(tracker), 2)
+
+            status, entry = tracker.match(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 1))
+            self.assertEqual((status, entry.token), (ReplyStatus.MATCHED, 'a'))
+            status, entry = tracker.match(NbfCommand.with_values(OPCODE_FENCE, 0, 0))
+            self.assertEqual((status, entry.token), (ReplyStatus.MATCHED, 'b'))
+            self.assertEqual(len(tracker), 0)
+            self.assertIsNone(tracker.oldest())
+            self.assertEqual(tracker.stats[OPCODE_READ_8].reordered, 0)
+
+        def test_interleaved(self):
+            tracker = ReplyTracker(_validate)
+            tracker.add(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 5))
+            tracker.add(NbfCommand.with_values(OPCODE_READ_8, 0x80000008, 7), token='read')
+            tracker.add(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000010, 6))
+
+            status, entry = tracker.match(NbfCommand.with_values(OPCODE_READ_8, 0x80000008, 7))
+            self.assertEqual((status, entry.token), (ReplyStatus.MATCHED, 'read'))
+            self.assertEqual(tracker.oldest().command.address_int, 0x80000000)
+            self.assertEqual(tracker.stats[OPCODE_READ_8].reordered, 1)
+
+            tracker.match(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000010, 0))
+            tracker.match(NbfCommand.with_values(OPCODE_WRITE_8, 0x80000000, 0))
+            self.assertEqual(len(tracker), 0)
+            self.assertEqual(tracker.stats[OPCODE_WRITE_8].matched, 2)
+            self.assertEqual(tracker.stats[OPCODE_WRITE_8].outstanding, 0)
+
+        def test_mismatched_and_orphaned(self):
+            tracker = ReplyTracker(_validate)
+            tracker.add(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 1))
+            tracker.add(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 2))
+
+            status, entry = tracker.match(NbfCommand.with_values(OPCODE_READ_8, 0x80000000, 2))
+            self.assertEqual((status, entry.command.data_int), (ReplyStatus.MISMATCHED, 1))
+            status, entry = tracker.match(NbfCommand.with_values(OPCODE_READ_8, 0x80000008, 2))
+            self.assertEqual((status, entry), (ReplyStatus.ORPHANED, None))
+            self.assertEqual(len(tracker), 1)
+
+            tracker.add(NbfCommand.with_values(OPCODE_READ_8, 0x80000010, 0), checked=False)
+            status, _ = tracker.match(NbfCommand.with_values(OPCODE_READ_8, 0x80000010, 9))
+            self.assertEqual(status, ReplyStatus.MATCHED)
+
+            tracker.clear()
+            self.assertEqual(len(tracker), 0)
+            self.assertEqual(tracker.stats[OPCODE_READ_8].outstanding, 0)
+            self.assertEqual(tracker.stats[OPCODE_READ_8].mismatched, 1)
+            self.assertEqual(tracker.stats[OPCODE_READ_8].orphaned, 1)
+
+    unittest.main()
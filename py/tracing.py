@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import cProfile
+import pstats
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+# events kept by a trace; older ones are dropped, so a long session keeps its most recent part
+DEFAULT_TRACE_EVENTS = 1 << 18
+
+# tracks (Chrome trace "threads") that events are drawn on; spans on one track never overlap
+# operations, and the times they block for the window or the writer
+TRACK_SENDER = 1
+TRACK_WRITER = 2
+TRACK_READER = 3
+# decoding and correlating replies, which shares the event loop with the sender
+TRACK_PARSER = 4
+TRACK_NAMES = {
+    TRACK_SENDER: 'sender',
+    TRACK_WRITER: 'writer (port writes)',
+    TRACK_READER: 'reader (port reads)',
+    TRACK_PARSER: 'parser',
+}
+
+# functions listed by a profile report
+PROFILE_REPORT_FUNCTIONS = 40
+
+# (phase, name, track, start, duration or value, args); times in perf_counter seconds
+TraceEvent = Tuple[str, str, int, float, float, Optional[Dict[str, Any]]]
+
+class TraceRecorder:
+    """
+    Records what a host session does over time into a ring buffer, and writes it out as a
+    Chrome trace, which chrome://tracing and ui.perfetto.dev display as a timeline.
+
+    Events are recorded per port write, per port read and per chunk of replies parsed, and
+    whenever the sender blocks, rather than per command. Recording one is a tuple appended to a
+    bounded deque, which is safe from the reader and writer threads.
+    """
+    def __init__(self, capacity: int = DEFAULT_TRACE_EVENTS):
+        self.events: Deque[TraceEvent] = deque(maxlen=capacity)
+        self.start_time = time.perf_counter()
+        self.recorded = 0
+
+    def span(self, name: str, track: int, start: float, end: float, args: Optional[Dict[str, Any]] = None):
+        self.events.append(('X', name, track, start, end - start, args))
+        self.recorded += 1
+
+    def counter(self, name: str, value: float, now: float):
+        self.events.append(('C', name, TRACK_SENDER, now, value, None))
+        self.recorded += 1
+
+    def instant(self, name: str, track: int, now: float, args: Optional[Dict[str, Any]] = None):
+        self.events.append(('i', name, track, now, 0.0, args))
+        self.recorded += 1
+
+    @contextmanager
+    def region(self, name: str, track: int = TRACK_SENDER, args: Optional[Dict[str, Any]] = None) -> Iterator[None]:
+        """
+        Records the time spent in a "with" block as a span.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.span(name, track, start, time.perf_counter(), args)
+
+    @property
+    def dropped(self) -> int:
+        return self.recorded - len(self.events)
+
+    def to_chrome(self) -> Dict[str, Any]:
+        pid = os.getpid()
+        trace_events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': track, 'args': {'name': name}}
+            for track, name in TRACK_NAMES.items()
+        ]
+        for phase, name, track, start, value, args in list(self.events):
+            event = {'name': name, 'ph': phase, 'pid': pid, 'tid': track, 'ts': (start - self.start_time) * 1e6}
+            if phase == 'X':
+                event['dur'] = value * 1e6
+            elif phase == 'C':
+                event['args'] = {name: value}
+            elif phase == 'i':
+                event['s'] = 't'
+            if args:
+                event['args'] = args
+            trace_events.append(event)
+        return {
+            'traceEvents': trace_events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'recorded_events': self.recorded, 'dropped_events': self.dropped},
+        }
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome(), f)
+
+def run_profiled(function: Callable[[], Any], path: str) -> Any:
+    """
+    Runs "function" under cProfile and writes where the time went to "path": a pstats file if
+    it ends in .pstats or .prof, for snakeviz or pstats, and a text report of the hottest
+    functions otherwise. Only the calling thread is profiled, which is where HostEngine decodes
+    and correlates replies; the reader and writer threads only do port I/O.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        if path.endswith(('.pstats', '.prof')):
+            profiler.dump_stats(path)
+        else:
+            with open(path, 'w') as f:
+                stats = pstats.Stats(profiler, stream=f)
+                for order in ('tottime', 'cumulative'):
+                    f.write(f"Hottest functions by {order}:\n")
+                    stats.sort_stats(order).print_stats(PROFILE_REPORT_FUNCTIONS)
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+
+    class TestTraceRecorder(unittest.TestCase):
+        def test_chrome_trace(self):
+            recorder = TraceRecorder(capacity=4)
+            now = recorder.start_time
+            recorder.span('write', TRACK_WRITER, now + 0.001, now + 0.002, {'bytes': 14})
+            recorder.counter('outstanding', 3, now + 0.002)
+            with recorder.region('load'):
+                pass
+            thread = threading.Thread(target=recorder.instant, args=('timeout', TRACK_READER, now + 0.003))
+            thread.start()
+            thread.join()
+            recorder.counter('outstanding', 0, now + 0.004)
+
+            self.assertEqual(recorder.dropped, 1)
+            trace = recorder.to_chrome()
+            events = [event for event in trace['traceEvents'] if event['ph'] != 'M']
+            self.assertEqual([event['name'] for event in events], ['outstanding', 'load', 'timeout', 'outstanding'])
+            self.assertEqual(events[0]['args'], {'outstanding': 3})
+            self.assertAlmostEqual(events[0]['ts'], 2000, places=3)
+            self.assertEqual(trace['otherData']['dropped_events'], 1)
+
+        def test_profile(self):
+            with tempfile.TemporaryDirectory() as directory:
+                report = os.path.join(directory, 'profile.txt')
+                self.assertEqual(run_profiled(lambda: sorted(range(1000), key=str)[0], report), 0)
+                with open(report) as f:
+                    self.assertIn('Hottest functions by tottime', f.read())
+                dump = os.path.join(directory, 'profile.pstats')
+                run_profiled(lambda: None, dump)
+                self.assertGreater(pstats.Stats(dump).total_calls, 0)
+
+    unittest.main()
@@ -0,0 +1,497 @@
+import os
+import time
+import select
+import socket
+import threading
+import itertools
+
+from typing import Callable, Dict, Optional, Tuple
+
+import serial
+
+# bytes a memory pipe holds before writes to it block, about what a pty buffers
+DEFAULT_MEMORY_PIPE_BYTES = 64 * 1024
+
+TCP_SCHEME = 'tcp://'
+MEMORY_SCHEME = 'memory://'
+
+class Transport:
+    """
+    A byte stream to a board: a serial port, a TCP connection to a serial server such as ser2net,
+    or an in-process memory pipe. It offers the subset of pyserial's interface host.py and
+    uart.py use, so either works with any of them, along with read_into(), which reads whatever
+    is available straight into a caller's buffer, and wait_readable(), which waits for input
+    without reading it.
+
+    Reads wait up to "timeout" seconds, forever if it is None. Line settings describe the serial
+    link at the far end, even when the transport itself has no line, so that transmit
+    utilization can still be estimated.
+    """
+    def __init__(self, name: str, baudrate: int = 1000000, timeout: Optional[float] = None, bytesize: int = serial.EIGHTBITS, parity: str = serial.PARITY_NONE, stopbits: float = serial.STOPBITS_ONE):
+        self.name = name
+        self.timeout = timeout
+        self._baudrate = baudrate
+        self.bytesize = bytesize
+        self.parity = parity
+        self.stopbits = stopbits
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, value: int):
+        self._baudrate = value
+
+    @property
+    def bits_per_byte(self) -> float:
+        """
+        Bits on the line per byte: a start bit, the data bits, parity and stop bits.
+        """
+        return 1 + self.bytesize + (0 if self.parity == serial.PARITY_NONE else 1) + self.stopbits
+
+    @property
+    def is_open(self) -> bool:
+        raise NotImplementedError
+
+    @property
+    def in_waiting(self) -> int:
+        """
+        Bytes that can be read without waiting.
+        """
+        raise NotImplementedError
+
+    def wait_readable(self, timeout: Optional[float]) -> bool:
+        """
+        Waits up to "timeout" seconds for input; returns whether there is some. Returns early,
+        with False, if cancel_read() is called.
+        """
+        raise NotImplementedError
+
+    def _read_available(self, view: memoryview) -> int:
+        """
+        Reads what is available into "view" without waiting.
+        """
+        raise NotImplementedError
+
+    def read_into(self, buffer) -> int:
+        """
+        Waits up to the timeout for input, then reads as much as is available, up to the size of
+        "buffer", into it. Returns the number of bytes read, 0 if none arrived in time.
+        """
+        if not self.wait_readable(self.timeout):
+            return 0
+        return self._read_available(memoryview(buffer).cast('B'))
+
+    def read(self, size: int = 1) -> bytes:
+        """
+        Reads "size" bytes, or fewer if the timeout passes first, like pyserial.
+        """
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        count = 0
+        while count < size:
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            if not self.wait_readable(remaining):
+                break
+            count += self._read_available(view[count:])
+        return bytes(buffer[:count])
+
+    def write(self, data) -> int:
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Waits until written data has left the host.
+        """
+
+    def reset_input_buffer(self):
+        while self.wait_readable(0):
+            self._read_available(memoryview(bytearray(65536)))
+
+    def cancel_read(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __enter__(self) -> 'Transport':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return self.name
+
+class SerialTransport(Transport):
+    """
+    A serial port or pseudo-terminal, through pyserial. On POSIX, reads go straight from the
+    port's file descriptor into the caller's buffer.
+    """
+    def __init__(self, port_name: str, baudrate: int = 1000000, timeout: Optional[float] = None, bytesize: int = serial.EIGHTBITS, parity: str = serial.PARITY_NONE, stopbits: float = serial.STOPBITS_ONE):
+        super().__init__(port_name, baudrate, timeout, bytesize, parity, stopbits)
+        self.port = serial.Serial(port=port_name, baudrate=baudrate, bytesize=bytesize, parity=parity, stopbits=stopbits, timeout=timeout)
+        self._fd: Optional[int] = getattr(self.port, 'fd', None)
+        # pyserial's own pipe for cancel_read, on POSIX
+        self._abort_fd: Optional[int] = getattr(self.port, 'pipe_abort_read_r', None)
+
+    @Transport.baudrate.setter
+    def baudrate(self, value: int):
+        self._baudrate = value
+        self.port.baudrate = value
+
+    @property
+    def is_open(self) -> bool:
+        return self.port.is_open
+
+    @property
+    def in_waiting(self) -> int:
+        return self.port.in_waiting
+
+    def wait_readable(self, timeout: Optional[float]) -> bool:
+        if self._fd is None:
+            # no descriptor to wait on; poll, as pyserial itself does on these platforms
+            deadline = None if timeout is None else time.perf_counter() + timeout
+            while not self.port.in_waiting:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return False
+                time.sleep(0.001)
+            return True
+
+        readable, _, _ = select.select([self._fd, self._abort_fd], [], [], timeout)
+        if self._abort_fd in readable:
+            os.read(self._abort_fd, 1000)
+            return False
+        return self._fd in readable
+
+    def _read_available(self, view: memoryview) -> int:
+        if self._fd is None:
+            data = self.port.read(min(len(view), self.port.in_waiting))
+            view[:len(data)] = data
+            return len(data)
+        try:
+            count = os.readv(self._fd, [view])
+        except BlockingIOError:
+            return 0
+        if count == 0:
+            raise serial.SerialException(f"{self.name} was disconnected")
+        return count
+
+    def write(self, data) -> int:
+        return self.port.write(data)
+
+    def flush(self):
+        self.port.flush()
+
+    def reset_input_buffer(self):
+        self.port.reset_input_buffer()
+
+    def cancel_read(self):
+        self.port.cancel_read()
+
+    def close(self):
+        self.port.close()
+
+class TcpTransport(Transport):
+    """
+    A raw TCP connection to a serial port server, such as ser2net in raw mode, given as
+    "tcp://host:port". The server sets the line up, so line settings only describe it.
+    """
+    def __init__(self, address: Tuple[str, int], baudrate: int = 1000000, timeout: Optional[float] = None, connect_timeout: float = 10.0):
+        super().__init__(f"{TCP_SCHEME}{address[0]}:{address[1]}", baudrate, timeout)
+        self.socket = socket.create_connection(address, timeout=connect_timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(None)
+        self._abort_r, self._abort_w = socket.socketpair()
+        self._open = True
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    @property
+    def in_waiting(self) -> int:
+        try:
+            import fcntl
+            import termios
+            return int.from_bytes(fcntl.ioctl(self.socket, termios.FIONREAD, b'\0\0\0\0'), 'little')
+        except (ImportError, OSError):
+            return 1 if self.wait_readable(0) else 0
+
+    def wait_readable(self, timeout: Optional[float]) -> bool:
+        readable, _, _ = select.select([self.socket, self._abort_r], [], [], timeout)
+        if self._abort_r in readable:
+            self._abort_r.recv(1000)
+            return False
+        return self.socket in readable
+
+    def _read_available(self, view: memoryview) -> int:
+        count = self.socket.recv_into(view)
+        if count == 0:
+            raise ConnectionError(f"{self.name} closed the connection")
+        return count
+
+    def write(self, data) -> int:
+        self.socket.sendall(data)
+        return len(data)
+
+    def cancel_read(self):
+        self._abort_w.send(b'\0')
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self.socket.close()
+            self._abort_r.close()
+            self._abort_w.close()
+
+class _MemoryPipe:
+    """
+    One direction of a memory transport: a bounded byte buffer shared by two threads.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.cancelled = False
+
+class MemoryTransport(Transport):
+    """
+    One end of an in-process pipe, made by pair() or by opening a MemoryPort. There is no
+    operating system in the way, so it measures what the host side alone can do. Writes block
+    while the pipe holds "capacity" bytes, like a full serial driver buffer.
+    """
+    _names = itertools.count(1)
+
+    def __init__(self, name: str, rx: _MemoryPipe, tx: _MemoryPipe, baudrate: int = 1000000, timeout: Optional[float] = None):
+        super().__init__(name, baudrate, timeout)
+        self._rx = rx
+        self._tx = tx
+
+    @staticmethod
+    def pair(capacity: int = DEFAULT_MEMORY_PIPE_BYTES, name: Optional[str] = None) -> Tuple['MemoryTransport', 'MemoryTransport']:
+        """
+        Returns the host end and the device end of a new pipe.
+        """
+        name = name or f"{MEMORY_SCHEME}pipe-{next(MemoryTransport._names)}"
+        forward = _MemoryPipe(capacity)
+        backward = _MemoryPipe(capacity)
+        return MemoryTransport(name, backward, forward), MemoryTransport(name + '-device', forward, backward)
+
+    @property
+    def is_open(self) -> bool:
+        return not self._tx.closed
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._rx.buffer)
+
+    def wait_readable(self, timeout: Optional[float]) -> bool:
+        rx = self._rx
+        with rx.condition:
+            rx.condition.wait_for(lambda: rx.buffer or rx.closed or rx.cancelled, timeout)
+            rx.cancelled = False
+            return bool(rx.buffer)
+
+    def _read_available(self, view: memoryview) -> int:
+        rx = self._rx
+        with rx.condition:
+            count = min(len(view), len(rx.buffer))
+            view[:count] = rx.buffer[:count]
+            del rx.buffer[:count]
+            rx.condition.notify_all()
+        return count
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        written = 0
+        while written < len(view):
+            written += self.try_write(view[written:], block=True)
+        return written
+
+    def try_write(self, data, block: bool = False) -> int:
+        """
+        Writes as much of "data" as fits in the pipe, waiting for room first if "block" is set.
+        """
+        tx = self._tx
+        with tx.condition:
+            if block:
+                tx.condition.wait_for(lambda: len(tx.buffer) < tx.capacity or tx.closed)
+            if tx.closed:
+                raise BrokenPipeError(f"{self.name} is closed")
+            count = min(len(data), tx.capacity - len(tx.buffer))
+            tx.buffer += data[:count]
+            tx.condition.notify_all()
+        return count
+
+    def flush(self):
+        tx = self._tx
+        with tx.condition:
+            tx.condition.wait_for(lambda: not tx.buffer or tx.closed)
+
+    def cancel_read(self):
+        with self._rx.condition:
+            self._rx.cancelled = True
+            self._rx.condition.notify_all()
+
+    def close(self):
+        for pipe in (self._rx, self._tx):
+            with pipe.condition:
+                pipe.closed = True
+                pipe.condition.notify_all()
+
+class MemoryPort:
+    """
+    A named endpoint that an in-process device, such as the emulator, serves, and that hosts
+    open as "memory://name". Like a serial port, it outlives the hosts that use it: every open
+    connects a new pipe, and "device" is the device end of the latest one. "on_connect" is called
+    after each connection, so that the device can start serving it.
+    """
+    _registry: Dict[str, 'MemoryPort'] = {}
+    _names = itertools.count(1)
+
+    def __init__(self, name: Optional[str] = None, capacity: int = DEFAULT_MEMORY_PIPE_BYTES):
+        self.name = name or f"{MEMORY_SCHEME}port-{next(MemoryPort._names)}"
+        self.capacity = capacity
+        self.device: Optional[MemoryTransport] = None
+        self.on_connect: Optional[Callable[[], None]] = None
+        MemoryPort._registry[self.name] = self
+
+    @staticmethod
+    def lookup(name: str) -> 'MemoryPort':
+        try:
+            return MemoryPort._registry[name]
+        except KeyError:
+            raise serial.SerialException(f"no memory port named \"{name}\"") from None
+
+    def connect(self, baudrate: int = 1000000, timeout: Optional[float] = None) -> MemoryTransport:
+        """
+        Connects a new host, disconnecting the previous one, and returns its end of the pipe.
+        """
+        host, device = MemoryTransport.pair(self.capacity, self.name)
+        host.baudrate = baudrate
+        host.timeout = timeout
+        previous, self.device = self.device, device
+        if previous is not None:
+            previous.close()
+        if self.on_connect is not None:
+            self.on_connect()
+        return host
+
+    def close(self):
+        MemoryPort._registry.pop(self.name, None)
+        if self.device is not None:
+            self.device.close()
+
+def open_transport(name: str, baudrate: int = 1000000, timeout: Optional[float] = None, bytesize: int = serial.EIGHTBITS, parity: str = serial.PARITY_NONE, stopbits: float = serial.STOPBITS_ONE) -> Transport:
+    """
+    Opens "tcp://host:port" as a TCP connection, "memory://name" as a connection to a MemoryPort,
+    and anything else as a serial port or pseudo-terminal.
+    """
+    if name.startswith(TCP_SCHEME):
+        host, _, port = name[len(TCP_SCHEME):].rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"expected {TCP_SCHEME}host:port, got \"{name}\"")
+        return TcpTransport((host.strip('[]'), int(port)), baudrate, timeout)
+    if name.startswith(MEMORY_SCHEME):
+        return MemoryPort.lookup(name).connect(baudrate, timeout)
+    return SerialTransport(name, baudrate, timeout, bytesize, parity, stopbits)
+
+if __name__ == '__main__':
+    import unittest
+
+    class TestTransports(unittest.TestCase):
+        def _exchange(self, host: Transport, far: Transport):
+            host.timeout = 1.0
+            far.timeout = 1.0
+            host.write(b'hello')
+            buffer = bytearray(64)
+            received = bytearray()
+            while len(received) < 5:
+                count = far.read_into(buffer)
+                self.assertGreater(count, 0)
+                received += buffer[:count]
+            self.assertEqual(received, b'hello')
+
+            far.write(b'abc')
+            self.assertEqual(host.read(3), b'abc')
+            host.timeout = 0.05
+            self.assertEqual(host.read(1), b'')
+
+            # a cancelled read returns at once
+            host.timeout = None
+            threading.Timer(0.05, host.cancel_read).start()
+            self.assertEqual(host.read_into(buffer), 0)
+
+        def test_memory(self):
+            host, far = MemoryTransport.pair(capacity=8)
+            self._exchange(host, far)
+
+            # a full pipe blocks writers until the reader catches up
+            writer = threading.Thread(target=host.write, args=(bytes(range(32)),))
+            writer.start()
+            far.timeout = 1.0
+            self.assertEqual(far.read(32), bytes(range(32)))
+            writer.join()
+            host.close()
+            with self.assertRaises(BrokenPipeError):
+                far.write(b'x')
+
+        def test_memory_port(self):
+            port = MemoryPort(capacity=8)
+            connections = []
+            port.on_connect = lambda: connections.append(port.device)
+            first = open_transport(port.name, timeout=1.0)
+            self._exchange(first, port.device)
+
+            # a new host takes over the port, and the previous one is disconnected
+            second = open_transport(port.name, timeout=1.0)
+            self.assertFalse(first.is_open)
+            self.assertEqual(len(connections), 2)
+            self._exchange(second, port.device)
+            port.close()
+            with self.assertRaises(serial.SerialException):
+                open_transport(port.name)
+
+        def test_tcp(self):
+            with socket.socket() as listener:
+                listener.bind(('127.0.0.1', 0))
+                listener.listen(1)
+                host = open_transport(f"tcp://127.0.0.1:{listener.getsockname()[1]}")
+                connection, _ = listener.accept()
+
+            class _Far(TcpTransport):
+                def __init__(self, connection):
+                    Transport.__init__(self, 'far')
+                    self.socket = connection
+                    self._abort_r, self._abort_w = socket.socketpair()
+                    self._open = True
+
+            far = _Far(connection)
+            try:
+                self._exchange(host, far)
+                self.assertEqual(host.in_waiting, 0)
+            finally:
+                host.close()
+                far.close()
+
+        def test_pty(self):
+            import tty
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            host = open_transport(os.ttyname(slave), timeout=1.0)
+            try:
+                host.write(b'ping')
+                self.assertEqual(os.read(master, 4), b'ping')
+                os.write(master, b'pong')
+                buffer = bytearray(16)
+                self.assertEqual(bytes(buffer[:host.read_into(buffer)]), b'pong')
+            finally:
+                host.close()
+                os.close(master)
+                os.close(slave)
+
+    unittest.main()
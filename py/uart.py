@@ -5,8 +5,15 @@ import argparse
 import signal
 import atexit
 import time
+import json
+import struct
+import zlib
+import platform
+import threading
 from tqdm import tqdm
 
+from transport import open_transport
+
 ## Global variables
 # Serial Port
 sp = None
@@ -16,7 +23,7 @@ def getArgs():
   parser = argparse.ArgumentParser(description='UART Driver')
   # UART parameters
   parser.add_argument('-p', '--port', dest='port', type=str, default='COM4',
-                      help='Serial port (full path)')
+                      help='Serial port (full path), or tcp://host:port for a serial port server')
   parser.add_argument('-b', '--baud', dest='baud', type=int, default=1000000,
                       help='Baud Rate (bits per second)')
   parser.add_argument('-d', '--data-bits', dest='bits', default=8, const=8, type=int,
@@ -32,8 +39,8 @@ def getArgs():
                       help='Read timeout')
   # Mode
   parser.add_argument('-m', '--mode', dest='mode', default='char', const='char',
-                      nargs='?', choices=['nbf', 'char', 'hex', 'test'],
-                      help='Input file mode [nbf, char, hex, test]. char and hex modes read from stdin')
+                      nargs='?', choices=['nbf', 'char', 'hex', 'test', 'link'],
+                      help='Input file mode [nbf, char, hex, test, link]. char and hex modes read from stdin')
   parser.add_argument('-f', '--file', dest='infile', default=None, type=str,
                       help='Input file')
   # Test mode parameters
@@ -42,6 +49,15 @@ def getArgs():
   parser.add_argument('--burst', dest='burst', type=int, default=4096,
                       help='Number of bytes per iteration for test')
                       # burst value of 8192 also seems to work well in the simple UART test
+  # Link mode parameters
+  parser.add_argument('--bursts', dest='bursts', type=intList, default=None,
+                      help='Comma-separated burst sizes in bytes to sweep in link mode (default: --burst)')
+  parser.add_argument('--bauds', dest='bauds', type=intList, default=None,
+                      help='Comma-separated baud rates to sweep in link mode (default: --baud)')
+  parser.add_argument('--probes', dest='probes', type=int, default=200,
+                      help='Number of latency probes per baud rate in link mode')
+  parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                      help='Write the link mode JSON report to this file instead of stdout')
   # NBF mode parameters
   parser.add_argument('--nbf-op-bytes', dest='nbf_op_bytes', default=1, type=int,
                       help='Number of bytes per NBF opcode')
@@ -53,6 +69,9 @@ def getArgs():
                       help='Seconds to wait for NBF packets from FPGA before prompting user')
   return parser.parse_args()
 
+def intList(string):
+  return [int(value, 0) for value in string.split(',') if value]
+
 def openFile(infile, mode):
   fp = os.path.abspath(os.path.realpath(infile))
   return open(fp, mode)
@@ -81,8 +100,8 @@ def openSerial(args):
   if (timeout < 0):
     timeout = None
 
-  return serial.Serial(port=args.port, baudrate=args.baud, bytesize=bytesize,
-                       parity=parity, stopbits=stopbits, timeout=timeout)
+  return open_transport(args.port, baudrate=args.baud, bytesize=bytesize,
+                        parity=parity, stopbits=stopbits, timeout=timeout)
 
 ## Formatting Functions
 def encodeString(string):
@@ -130,46 +149,283 @@ def interactiveCh(args):
     print('sent {0} bytes'.format(user_input_length))
     print('readback: {0}'.format(sp.read(user_input_length)))
 
+## Reader Thread
+
+# seconds to wait for a response, or None to wait forever
+def readTimeout(args):
+  return None if args.timeout < 0 else args.timeout
+
+# reads everything the board sends back on its own thread, blocking in the transport instead of
+# polling in_waiting, and timestamps each chunk as it arrives. With a frame decoder it also
+# tracks which link frames came back, and when
+class LinkReader(threading.Thread):
+  def __init__(self, port, decoder=None):
+    super().__init__(daemon=True)
+    self.port = port
+    self.decoder = decoder
+    self.condition = threading.Condition()
+    self.stopping = False
+    self.bytesReceived = 0
+    self.lastArrivalNs = None
+    # sequence number -> arrival time of the first copy of each frame
+    self.arrivals = {}
+    self.duplicates = 0
+    self.outOfOrder = 0
+    self.highestSeq = -1
+    self.buffer = bytearray(65536)
+
+  def run(self):
+    while not self.stopping:
+      count = self.port.read_into(self.buffer)
+      if not count:
+        continue
+      data = bytes(self.buffer[:count])
+      now = time.perf_counter_ns()
+      frames = self.decoder.feed(data) if self.decoder else []
+      with self.condition:
+        self.bytesReceived += len(data)
+        self.lastArrivalNs = now
+        for (kind, seq, sent_ns) in frames:
+          if seq in self.arrivals:
+            self.duplicates += 1
+            continue
+          if seq < self.highestSeq:
+            self.outOfOrder += 1
+          self.highestSeq = max(self.highestSeq, seq)
+          self.arrivals[seq] = now
+        self.condition.notify_all()
+
+  # block until predicate() holds, re-checking whenever bytes arrive; false on timeout
+  def waitFor(self, predicate, timeout):
+    with self.condition:
+      return self.condition.wait_for(predicate, timeout)
+
+  # block until nothing has arrived for quiet seconds
+  def waitQuiet(self, quiet):
+    with self.condition:
+      while self.condition.wait(quiet):
+        pass
+
+  def stop(self):
+    self.stopping = True
+    self.port.cancel_read()
+    self.join()
+
 ## Test Mode
 def runTest(args):
   ba = bytes(bytearray(args.burst))
   total = args.iters * args.burst
-  total_read = 0
-  start_time = time.perf_counter()
+  timeout = readTimeout(args)
+  reader = LinkReader(sp)
+  reader.start()
+  start_time = time.perf_counter_ns()
 
   for i in tqdm(range(int(args.iters))):
-    # write burst of bytes
+    # write burst of bytes, then sleep until the reader has seen all of it come back
     sp.write(ba)
-    # read bytes
-    read = 0
-    while (read < args.burst):
-      n = sp.in_waiting
-      if n:
-        b = sp.read(n)
-        total_read += len(b)
-        read += len(b)
-
-  print('WRITE FINISHED: written: {0} read: {1}'.format(total, total_read))
-
-  timeout_cnt = 0
-  while (total_read < total and timeout_cnt < args.timeout):
-    n = sp.in_waiting
-    if n:
-      b = sp.read(n)
-      total_read += len(b)
-      timeout_cnt = 0
-    else:
-      timeout_cnt += 1
-      time.sleep(1)
-
-  end_time = time.perf_counter()
-  throughput = float(total_read) / (end_time - start_time)
+    expected = (i + 1) * args.burst
+    reader.waitFor(lambda: reader.bytesReceived >= expected, timeout)
+
+  print('WRITE FINISHED: written: {0} read: {1}'.format(total, reader.bytesReceived))
+  reader.waitFor(lambda: reader.bytesReceived >= total, timeout)
+  reader.stop()
+  total_read = reader.bytesReceived
+
+  # measured up to the last byte received, not to when the wait for it gave up
+  end_time = reader.lastArrivalNs or time.perf_counter_ns()
+  throughput = float(total_read) / max((end_time - start_time) / 1e9, 1e-9)
 
   if not total_read == total:
     print('TEST FAILED: written: {0} read: {1}'.format(total, total_read))
   else:
     print('TEST PASSED: written: {0} read: {1} at {2:0.2f} bytes/second'.format(total, total_read, throughput))
 
+## Link Mode
+
+# Everything sent to the loopback design while characterizing the link is cut into frames of a
+# magic byte, the frame kind, a sequence number, the host time the frame was sent at and a CRC of
+# the rest. The echoed stream then shows which frames were lost, duplicated or corrupted and how
+# long each took to come back.
+LINK_FRAME = struct.Struct('<BBIQH')
+LINK_FRAME_BYTES = LINK_FRAME.size
+LINK_FRAME_MAGIC = 0xa5
+LINK_FRAME_PROBE = 0
+LINK_FRAME_BURST = 1
+LINK_REPORT_VERSION = 1
+
+def encodeLinkFrame(kind, seq, sent_ns):
+  body = LINK_FRAME.pack(LINK_FRAME_MAGIC, kind, seq & 0xffffffff, sent_ns, 0)[:-2]
+  return body + struct.pack('<H', zlib.crc32(body) & 0xffff)
+
+# splits received bytes back into (kind, seq, sent_ns) frames, resynchronizing one byte at a
+# time past anything that does not check out
+class LinkFrameDecoder:
+  def __init__(self):
+    self.buffer = bytearray()
+    self.corruptBytes = 0
+
+  def feed(self, data):
+    buf = self.buffer
+    buf += data
+    frames = []
+    offset = 0
+    while len(buf) - offset >= LINK_FRAME_BYTES:
+      if buf[offset] == LINK_FRAME_MAGIC:
+        (magic, kind, seq, sent_ns, crc) = LINK_FRAME.unpack_from(buf, offset)
+        if zlib.crc32(buf[offset:offset+LINK_FRAME_BYTES-2]) & 0xffff == crc:
+          frames.append((kind, seq, sent_ns))
+          offset += LINK_FRAME_BYTES
+          continue
+      self.corruptBytes += 1
+      offset += 1
+    del buf[:offset]
+    return frames
+
+# bits on the wire per byte: start bit, data bits, parity and stop bits
+def bitsPerCharacter(args):
+  return 1 + args.bits + (0 if args.parity == 'none' else 1) + args.stopbits
+
+# count, mean and percentiles of a list of values
+def summarize(values):
+  if not values:
+    return {'count': 0}
+  values = sorted(values)
+  def percentile(p):
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+  return {
+    'count': len(values),
+    'min': values[0],
+    'mean': sum(values) / len(values),
+    'p50': percentile(50),
+    'p90': percentile(90),
+    'p99': percentile(99),
+    'max': values[-1],
+  }
+
+# counts of microsecond values in power-of-two buckets, as [upper bound, count] pairs
+def histogram(values_us):
+  buckets = {}
+  for value in values_us:
+    bound = 1
+    while bound < value:
+      bound *= 2
+    buckets[bound] = buckets.get(bound, 0) + 1
+  return [[bound, buckets[bound]] for bound in sorted(buckets)]
+
+# idle round trips of single frames, each sent only once the previous one came back
+def measureProbes(port, args):
+  reader = LinkReader(port, LinkFrameDecoder())
+  reader.start()
+  timeout = readTimeout(args)
+  sent = {}
+  for seq in range(args.probes):
+    sent[seq] = time.perf_counter_ns()
+    port.write(encodeLinkFrame(LINK_FRAME_PROBE, seq, sent[seq]))
+    reader.waitFor(lambda: seq in reader.arrivals, timeout)
+  reader.stop()
+
+  rtt_us = [(reader.arrivals[seq] - sent[seq]) / 1e3 for seq in sent if seq in reader.arrivals]
+  return {
+    'frames_sent': len(sent),
+    'frames_lost': len(sent) - len(rtt_us),
+    'frames_duplicated': reader.duplicates,
+    'bytes_corrupted': reader.decoder.corruptBytes,
+    'rtt_us': summarize(rtt_us),
+    # the loopback has no clock of its own, so each direction is taken as half the round trip
+    'one_way_us': summarize([rtt / 2 for rtt in rtt_us]),
+    'rtt_histogram_us': histogram(rtt_us),
+  }
+
+# back-to-back bursts of frames, each sent once the previous burst came back, as runTest does
+def measureBursts(port, args, burst, line_bytes_per_second):
+  frames_per_burst = max(1, -(-burst // LINK_FRAME_BYTES))
+  reader = LinkReader(port, LinkFrameDecoder())
+  reader.start()
+  timeout = readTimeout(args)
+  seq = 0
+  burst_us = []
+  start_ns = time.perf_counter_ns()
+  for i in tqdm(range(args.iters), desc='{0} bytes'.format(frames_per_burst * LINK_FRAME_BYTES), leave=False):
+    sent_ns = time.perf_counter_ns()
+    port.write(b''.join(encodeLinkFrame(LINK_FRAME_BURST, seq + j, sent_ns) for j in range(frames_per_burst)))
+    seq += frames_per_burst
+    last = seq - 1
+    expected = seq * LINK_FRAME_BYTES
+    if reader.waitFor(lambda: last in reader.arrivals or reader.bytesReceived >= expected, timeout) and last in reader.arrivals:
+      burst_us.append((reader.arrivals[last] - sent_ns) / 1e3)
+  # give stragglers and duplicates a chance to show up before counting
+  reader.waitQuiet(min(0.1, timeout or 0.1))
+  reader.stop()
+
+  bytes_sent = seq * LINK_FRAME_BYTES
+  received = len(reader.arrivals)
+  elapsed = ((reader.lastArrivalNs or start_ns) - start_ns) / 1e9
+  throughput = received * LINK_FRAME_BYTES / elapsed if elapsed > 0 else 0.0
+  return {
+    'burst_bytes': frames_per_burst * LINK_FRAME_BYTES,
+    'iterations': args.iters,
+    'bytes_sent': bytes_sent,
+    'bytes_received': reader.bytesReceived,
+    'bytes_lost': max(0, bytes_sent + reader.duplicates * LINK_FRAME_BYTES - reader.bytesReceived),
+    'bytes_duplicated': reader.duplicates * LINK_FRAME_BYTES,
+    'bytes_corrupted': reader.decoder.corruptBytes,
+    'frames_lost': seq - received,
+    'frames_duplicated': reader.duplicates,
+    'frames_out_of_order': reader.outOfOrder,
+    'throughput_bytes_per_second': throughput,
+    'line_efficiency': throughput / line_bytes_per_second,
+    'burst_round_trip_us': summarize(burst_us),
+  }
+
+# sweep latency probes and burst sizes over each baud rate
+def characterizeLink(port, args):
+  bauds = args.bauds or [args.baud]
+  bursts = args.bursts or [args.burst]
+  results = []
+  for baud in bauds:
+    port.baudrate = baud
+    port.reset_input_buffer()
+    line_bytes_per_second = baud / bitsPerCharacter(args)
+    result = {
+      'baud': baud,
+      'bits_per_character': bitsPerCharacter(args),
+      'line_bytes_per_second': line_bytes_per_second,
+      'frame_serialization_us': LINK_FRAME_BYTES / line_bytes_per_second * 1e6,
+      'probes': measureProbes(port, args),
+      'bursts': [],
+    }
+    probes = result['probes']
+    print('baud {0}: probe rtt p50 {1:.0f} us p99 {2:.0f} us, {3} of {4} lost'.format(
+      baud, probes['rtt_us'].get('p50', 0), probes['rtt_us'].get('p99', 0), probes['frames_lost'], probes['frames_sent']), file=sys.stderr)
+    for burst in bursts:
+      port.reset_input_buffer()
+      step = measureBursts(port, args, burst, line_bytes_per_second)
+      result['bursts'].append(step)
+      print('baud {0} burst {1}: {2:.0f} bytes/second ({3:.0%} of line rate), lost {4} duplicated {5} corrupted {6} bytes'.format(
+        baud, step['burst_bytes'], step['throughput_bytes_per_second'], step['line_efficiency'],
+        step['bytes_lost'], step['bytes_duplicated'], step['bytes_corrupted']), file=sys.stderr)
+    results.append(result)
+  return results
+
+def runLink(args):
+  report = {
+    'schema_version': LINK_REPORT_VERSION,
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'port': args.port,
+    'data_bits': args.bits,
+    'parity': args.parity,
+    'stop_bits': args.stopbits,
+    'results': characterizeLink(sp, args),
+  }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
 
 ## NBF Mode
 
@@ -240,30 +496,35 @@ def sendNBF(args):
       sp.close()
 
 # listen on serial port for NBF packets
+# reads block until a packet arrives or the read timeout expires, then take everything waiting,
+# so that bursts of packets are decoded and printed together
 def listenNBF(args):
-  timeout_cnt = 0
+  packet_bytes = args.nbf_op_bytes + args.nbf_addr_bytes + args.nbf_data_bytes
+  addr_end = args.nbf_op_bytes + args.nbf_addr_bytes
+  buffer = bytearray()
+  last_rx_time = time.perf_counter()
   # loop until user says stop
   while(True):
-    # check if serial port has bytes, and try to process if it does
-    # some bytes received, read them from serial port
-    if sp.in_waiting > 0:
-      (opcode_in, addr_in, data_in) = readNBF(args)
-      if (opcode_in is None):
-        return
-      print('REPLY: {0}_{1}_{2}'.format(opcode_in, addr_in, data_in))
-      timeout_cnt = 0
-    # no bytes received, increment timeout counter
-    # sleep for a second
-    else:
-      timeout_cnt += 1
-      time.sleep(1)
-
-    if timeout_cnt > args.nbf_listen_timeout:
+    data = sp.read(max(packet_bytes, sp.in_waiting))
+    now = time.perf_counter()
+    if data:
+      buffer += data
+      complete = len(buffer) - len(buffer) % packet_bytes
+      lines = []
+      for offset in range(0, complete, packet_bytes):
+        packet = buffer[offset:offset+packet_bytes]
+        lines.append('REPLY: ' + decodeNBF(packet[:args.nbf_op_bytes], packet[args.nbf_op_bytes:addr_end], packet[addr_end:]))
+      if lines:
+        print('\n'.join(lines))
+      del buffer[:complete]
+      last_rx_time = now
+    # nothing received for a while, ask whether to keep waiting
+    elif now - last_rx_time > args.nbf_listen_timeout:
       resp = input('$ Continue executing (y/n)? ')
       if (resp.lower() in ['n', 'no']):
         return
       else:
-        timeout_cnt = 0
+        last_rx_time = time.perf_counter()
 
 
 # NBF mode entry
@@ -286,6 +547,8 @@ if __name__ == '__main__':
       runNBF(args)
     elif args.mode == 'test':
       runTest(args)
+    elif args.mode == 'link':
+      runLink(args)
   except Exception as e:
     print("caught an exception, closing")
     print(e)
\ No newline at end of file
@@ -0,0 +1,236 @@
+import csv
+from typing import Dict, List, NamedTuple, Optional
+
+from nbf import NBF_COMMAND_LENGTH_BYTES
+
+# receive-side buffering in bp_fpga_host.sv: the UART receive FIFO (uart_rx_buffer_els_p bytes)
+# followed by the NBF command buffer
+FPGA_UART_RX_BUFFER_BYTES = 256
+FPGA_NBF_BUFFER_ENTRIES = 4
+# commands the FPGA host can hold before it has to process one
+FPGA_BUFFERED_COMMANDS = FPGA_UART_RX_BUFFER_BYTES // NBF_COMMAND_LENGTH_BYTES + FPGA_NBF_BUFFER_ENTRIES
+
+DEFAULT_MIN_WINDOW = 1
+DEFAULT_MAX_WINDOW = 1024
+
+# throughput is measured over epochs at least this long, which cover at least a window of replies
+WINDOW_EPOCH_SECONDS = 0.1
+# an epoch must beat the best throughput seen at a smaller window by this fraction to keep growing
+WINDOW_GAIN_THRESHOLD = 0.05
+# once round trips take this many times the fastest one seen, a larger window only adds queueing
+WINDOW_QUEUEING_RTT_RATIO = 2.0
+# after this many epochs without growing, the controller probes a larger window again
+WINDOW_PROBE_EPOCHS = 8
+# a reply that has not arrived within this many smoothed round trips counts as a timeout
+WINDOW_STALL_RTTS = 8.0
+WINDOW_MIN_STALL_SECONDS = 0.25
+# the error bits of the control register are checked after this many replies
+WINDOW_STATUS_CHECK_REPLIES = 4096
+
+class WindowSample(NamedTuple):
+    time: float
+    window: int
+    # replies per second over the epoch ending at "time"
+    throughput: float
+    # smoothed round trip time, in seconds
+    rtt: float
+    # what changed the window: 'grow', 'shrink', 'hold', or the reason for a backoff
+    reason: str
+
+class WindowController:
+    """
+    Sizes the sliding window of outstanding replies from measurements, rather than a fixed guess.
+
+    Round trip times are measured on every reply and throughput over short epochs. While the
+    window is what limits the sender, it grows as long as each step still raises throughput:
+    doubling at first, then in smaller steps. When throughput stops rising the window holds, and
+    shrinks if round trips show that the extra commands are only queueing. Timeouts, reply
+    violations and error bits reported by the target halve the window immediately, since they
+    suggest the FPGA host's receive buffers are overflowing.
+
+    The window starts at the number of commands the FPGA host can buffer.
+    """
+    def __init__(self, initial: int = FPGA_BUFFERED_COMMANDS, minimum: int = DEFAULT_MIN_WINDOW, maximum: int = DEFAULT_MAX_WINDOW):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = max(minimum, min(maximum, initial))
+
+        self.srtt: Optional[float] = None
+        self.min_rtt: Optional[float] = None
+        self.throughput = 0.0
+        self.peak_throughput = 0.0
+        self.history: List[WindowSample] = []
+        self.backoffs: Dict[str, int] = {}
+
+        self._slow_start = True
+        self._best_throughput = 0.0
+        self._epochs_since_growth = 0
+        self._epoch_start: Optional[float] = None
+        self._epoch_replies = 0
+        self._epoch_limited = False
+        self._replies_since_status_check = 0
+
+    def _resize(self, size: int) -> bool:
+        size = max(self.minimum, min(self.maximum, size))
+        changed = size != self.size
+        self.size = size
+        return changed
+
+    def _record(self, now: float, reason: str):
+        self.history.append(WindowSample(now, self.size, self.throughput, self.srtt or 0.0, reason))
+
+    def on_limited(self):
+        """
+        Notes that a command had to wait for room in the window.
+        """
+        self._epoch_limited = True
+
+    def on_reply(self, rtt: float, now: float) -> bool:
+        """
+        Accounts for a reply that took "rtt" seconds. Returns True if the window changed.
+        """
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self._replies_since_status_check += 1
+
+        if self._epoch_start is None:
+            self._epoch_start = now - rtt
+        self._epoch_replies += 1
+        elapsed = now - self._epoch_start
+        if elapsed < WINDOW_EPOCH_SECONDS or self._epoch_replies < self.size:
+            return False
+
+        self.throughput = self._epoch_replies / elapsed
+        self.peak_throughput = max(self.peak_throughput, self.throughput)
+        limited = self._epoch_limited
+        self._epoch_start = now
+        self._epoch_replies = 0
+        self._epoch_limited = False
+        return self._end_epoch(now, limited)
+
+    def _end_epoch(self, now: float, limited: bool) -> bool:
+        if not limited:
+            # the sender did not fill the window, so its size had no effect on this epoch
+            return False
+
+        changed = False
+        if self.throughput > self._best_throughput * (1 + WINDOW_GAIN_THRESHOLD):
+            self._best_throughput = self.throughput
+            self._epochs_since_growth = 0
+            step = self.size if self._slow_start else max(1, self.size // 4)
+            changed = self._resize(self.size + step)
+            reason = 'grow'
+        else:
+            self._slow_start = False
+            self._epochs_since_growth += 1
+            if self.srtt > WINDOW_QUEUEING_RTT_RATIO * self.min_rtt:
+                changed = self._resize(self.size - max(1, self.size // 8))
+                reason = 'shrink'
+            elif self._epochs_since_growth >= WINDOW_PROBE_EPOCHS:
+                # conditions may have changed since the best throughput was measured
+                self._best_throughput = self.throughput
+                self._epochs_since_growth = 0
+                changed = self._resize(self.size + max(1, self.size // 4))
+                reason = 'grow'
+            else:
+                reason = 'hold'
+
+        self._record(now, reason)
+        return changed
+
+    def back_off(self, reason: str, now: float) -> bool:
+        """
+        Halves the window after a timeout, reply violation or reported error. Returns True if
+        the window changed.
+        """
+        self.backoffs[reason] = self.backoffs.get(reason, 0) + 1
+        self._slow_start = False
+        self._best_throughput = 0.0
+        self._epochs_since_growth = 0
+        self._epoch_start = None
+        self._epoch_replies = 0
+        self._epoch_limited = False
+        changed = self._resize(self.size // 2)
+        self._record(now, reason)
+        return changed
+
+    def stall_seconds(self) -> float:
+        """
+        How long the oldest outstanding reply may take before it counts as a timeout.
+        """
+        if self.srtt is None:
+            return WINDOW_MIN_STALL_SECONDS
+        return max(WINDOW_MIN_STALL_SECONDS, WINDOW_STALL_RTTS * self.srtt)
+
+    def status_check_due(self) -> bool:
+        """
+        Returns True, once per WINDOW_STATUS_CHECK_REPLIES replies, when the target's error
+        bits should be read.
+        """
+        if self._replies_since_status_check < WINDOW_STATUS_CHECK_REPLIES:
+            return False
+        self._replies_since_status_check = 0
+        return True
+
+    def write_history(self, path: str):
+        """
+        Writes the window size and throughput at the end of every epoch and backoff to a CSV file.
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(WindowSample._fields)
+            writer.writerows(self.history)
+
+    def __str__(self):
+        rtt = f"{self.srtt * 1000:.2f} ms" if self.srtt is not None else "n/a"
+        return f"window {self.size}, {self.throughput:.0f} replies/s, rtt {rtt}"
+
+if __name__ == '__main__':
+    import unittest
+
+    class TestWindowController(unittest.TestCase):
+        def _run_epoch(self, controller: WindowController, now: float, throughput: float, rtt: float = 0.001) -> float:
+            samples = len(controller.history)
+            while len(controller.history) == samples:
+                controller.on_limited()
+                now += 1 / throughput
+                controller.on_reply(rtt, now)
+            return now
+
+        def test_grows_while_throughput_rises(self):
+            controller = WindowController(initial=4)
+            now = 0.0
+            for throughput in (1000, 2000, 4000):
+                now = self._run_epoch(controller, now, throughput)
+            self.assertEqual(controller.size, 32)
+
+            now = self._run_epoch(controller, now, 4000)
+            self.assertEqual(controller.size, 32)
+            self.assertEqual(controller.history[-1].reason, 'hold')
+
+        def test_shrinks_when_queueing(self):
+            controller = WindowController(initial=64)
+            now = self._run_epoch(controller, 0.0, 4000, rtt=0.001)
+            now = self._run_epoch(controller, now, 4000, rtt=0.010)
+            self.assertLess(controller.size, 128)
+            self.assertEqual(controller.history[-1].reason, 'shrink')
+
+        def test_back_off(self):
+            controller = WindowController(initial=16, minimum=2)
+            self.assertTrue(controller.back_off('timeout', 1.0))
+            self.assertEqual(controller.size, 8)
+            controller.back_off('rd_error', 2.0)
+            controller.back_off('rd_error', 3.0)
+            controller.back_off('rd_error', 4.0)
+            self.assertEqual(controller.size, 2)
+            self.assertEqual(controller.backoffs, {'timeout': 1, 'rd_error': 3})
+
+        def test_unlimited_epochs_leave_window(self):
+            controller = WindowController(initial=4)
+            now = 0.0
+            for i in range(1000):
+                now += 0.001
+                controller.on_reply(0.001, now)
+            self.assertEqual(controller.size, 4)
+
+    unittest.main()
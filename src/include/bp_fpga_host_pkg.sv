@@ -12,4 +12,10 @@
   // default value of control register
   localparam fpga_host_ctrl_gp = 32'h0000_0000;
 
+  // capabilities reported by control register reads
+  localparam fpga_host_caps_s fpga_host_caps_gp = '{burst_write: 1'b1};
+
+  // most data words carried by one burst write
+  localparam fpga_host_burst_max_words_gp = 256;
+
  endpackage
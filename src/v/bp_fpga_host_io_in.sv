@@ -16,6 +16,7 @@
  * Outputs:
  *   io_cmd_o - IO commands to BlackParrot generated from PC Host NBF packets
  *            - includes write and read memory, nbf fence, nbf finish
+ *            - burst writes are expanded into one 8-byte write per data word
  *            - io_cmd_o may block if network is full
  *
  *   nbf_o - NBF packets to bp_fpga_host_io_out
@@ -47,8 +48,11 @@ module bp_fpga_host_io_in
     , parameter uart_data_bits_p = 8 // between 5 and 9 bits
 
     , parameter nbf_buffer_els_p = 4
+    , parameter burst_buffer_els_p = 4
 
     , localparam nbf_uart_packets_lp = (nbf_width_lp / uart_data_bits_p)
+    , localparam burst_uart_packets_lp = (dword_width_gp / uart_data_bits_p)
+    , localparam burst_count_width_lp = `BSG_WIDTH(fpga_host_burst_max_words_gp)
 
     `declare_bp_bedrock_mem_if_widths(paddr_width_p, dword_width_gp, lce_id_width_p, lce_assoc_p, io)
     )
@@ -127,6 +131,11 @@ module bp_fpga_host_io_in
   bp_fpga_host_nbf_s nbf_lo;
   assign nbf_o = nbf_lo;
 
+  // Bytes from UART RX are NBF packets, except for the data words that follow a burst write
+  // packet, which are counted down by rx_burst_words_r and routed to burst_sipo
+  logic [burst_count_width_lp-1:0] rx_burst_words_r, rx_burst_words_n;
+  wire rx_to_burst = (rx_burst_words_r != '0);
+
   // Process bytes from UART RX
   // NBF packet arrives opcode, address (LSB to MSB), data (LSB to MSB)
   logic nbf_sipo_ready_and_lo;
@@ -141,7 +150,7 @@ module bp_fpga_host_io_in
     (.clk_i(clk_i)
      ,.reset_i(reset_i)
      // from UART RX
-     ,.v_i(rx_v_i)
+     ,.v_i(rx_v_i & ~rx_to_burst)
      ,.ready_and_o(nbf_sipo_ready_and_lo)
      ,.data_i(rx_i)
      // to nbf_buffer
@@ -149,7 +158,49 @@ module bp_fpga_host_io_in
      ,.ready_and_i(nbf_sipo_ready_and_li)
      ,.data_o(nbf_sipo_lo)
      );
-  assign rx_yumi_o = rx_v_i & nbf_sipo_ready_and_lo;
+
+  // Process burst data words from UART RX, LSB to MSB
+  logic burst_sipo_ready_and_lo;
+  logic burst_sipo_v_lo, burst_sipo_ready_and_li;
+  logic [dword_width_gp-1:0] burst_sipo_lo;
+  bsg_serial_in_parallel_out_passthrough
+   #(.width_p(uart_data_bits_p)
+     ,.els_p(burst_uart_packets_lp)
+     ,.hi_to_lo_p(0)
+     )
+    burst_sipo
+    (.clk_i(clk_i)
+     ,.reset_i(reset_i)
+     // from UART RX
+     ,.v_i(rx_v_i & rx_to_burst)
+     ,.ready_and_o(burst_sipo_ready_and_lo)
+     ,.data_i(rx_i)
+     // to burst_buffer
+     ,.v_o(burst_sipo_v_lo)
+     ,.ready_and_i(burst_sipo_ready_and_li)
+     ,.data_o(burst_sipo_lo)
+     );
+  assign rx_yumi_o = rx_v_i & (rx_to_burst ? burst_sipo_ready_and_lo : nbf_sipo_ready_and_lo);
+
+  // a burst write packet leaving nbf_sipo routes its data words to burst_sipo
+  wire nbf_sipo_burst = nbf_sipo_v_lo & nbf_sipo_ready_and_li
+                        & (nbf_sipo_lo.opcode == e_fpga_host_nbf_burst_write_8);
+  always_comb begin
+    rx_burst_words_n = rx_burst_words_r;
+    if (nbf_sipo_burst) begin
+      rx_burst_words_n = nbf_sipo_lo.data[0+:burst_count_width_lp];
+    end else if (burst_sipo_v_lo & burst_sipo_ready_and_li) begin
+      rx_burst_words_n = rx_burst_words_r - 1'b1;
+    end
+  end
+
+  always_ff @(posedge clk_i) begin
+    if (reset_i) begin
+      rx_burst_words_r <= '0;
+    end else begin
+      rx_burst_words_r <= rx_burst_words_n;
+    end
+  end
 
   // Buffer arriving NBF commands from UART RX
   logic nbf_buffer_v_lo, nbf_buffer_yumi_li;
@@ -172,6 +223,27 @@ module bp_fpga_host_io_in
      ,.data_o(nbf_buffer_lo)
      );
 
+  // Buffer arriving burst data words, which the FSM drains after the burst write packet
+  logic burst_buffer_v_lo, burst_buffer_yumi_li;
+  logic [dword_width_gp-1:0] burst_buffer_lo;
+  bsg_fifo_1r1w_small
+   #(.width_p(dword_width_gp)
+     ,.els_p(burst_buffer_els_p)
+     ,.ready_THEN_valid_p(0)
+     )
+    burst_buffer
+    (.clk_i(clk_i)
+     ,.reset_i(reset_i)
+     // from burst_sipo
+     ,.v_i(burst_sipo_v_lo)
+     ,.ready_o(burst_sipo_ready_and_li)
+     ,.data_i(burst_sipo_lo)
+     // to FSM
+     ,.v_o(burst_buffer_v_lo)
+     ,.yumi_i(burst_buffer_yumi_li)
+     ,.data_o(burst_buffer_lo)
+     );
+
   wire is_fence_packet = (nbf_buffer_lo.opcode == e_fpga_host_nbf_fence);
   wire is_finish_packet = (nbf_buffer_lo.opcode == e_fpga_host_nbf_finish);
   wire is_ctrl_set = (nbf_buffer_lo.opcode == e_fpga_host_ctrl_set);
@@ -179,15 +251,22 @@ module bp_fpga_host_io_in
   wire is_ctrl_read = (nbf_buffer_lo.opcode == e_fpga_host_ctrl_read);
   wire is_ctrl_write = (nbf_buffer_lo.opcode == e_fpga_host_ctrl_write);
   wire is_ctrl_packet = is_ctrl_set | is_ctrl_clear | is_ctrl_read | is_ctrl_write;
+  wire is_burst_packet = (nbf_buffer_lo.opcode == e_fpga_host_nbf_burst_write_8);
+  wire [burst_count_width_lp-1:0] burst_packet_words = nbf_buffer_lo.data[0+:burst_count_width_lp];
 
   typedef enum logic [1:0]
   {
     e_reset
     , e_send_nbf
+    , e_send_burst
   } io_in_state_e;
 
   io_in_state_e state_r, state_n;
 
+  // address and remaining words of the burst write being expanded
+  logic [paddr_width_p-1:0] burst_addr_r, burst_addr_n;
+  logic [burst_count_width_lp-1:0] burst_words_r, burst_words_n;
+
   // Flow control for BedRock network
   logic [`BSG_WIDTH(bedrock_max_credits_p)-1:0] credit_count_lo;
   bsg_flow_counter
@@ -206,19 +285,28 @@ module bp_fpga_host_io_in
   always_ff @(posedge clk_i) begin
     if (reset_i) begin
       state_r <= e_reset;
+      burst_addr_r <= '0;
+      burst_words_r <= '0;
     end else begin
       state_r <= state_n;
+      burst_addr_r <= burst_addr_n;
+      burst_words_r <= burst_words_n;
     end
   end
 
+  // the nbf buffer is only processed between bursts
+  wire nbf_buffer_active = nbf_buffer_v_lo & (state_r == e_send_nbf);
   // nbf buffer sends packet to nbf_o port for finish and fence
-  wire nbf_buffer_to_nbf_o = nbf_buffer_v_lo & (is_finish_packet | (credits_empty_lo & is_fence_packet) | is_ctrl_read);
-  // nbf buffer output should be sunk for control writes
-  wire nbf_ctrl_sink = nbf_buffer_v_lo & (is_ctrl_set | is_ctrl_clear | is_ctrl_write);
+  wire nbf_buffer_to_nbf_o = nbf_buffer_active & (is_finish_packet | (credits_empty_lo & is_fence_packet) | is_ctrl_read);
+  // nbf buffer output should be sunk for control writes, and for burst writes once their
+  // address and length are captured
+  wire nbf_ctrl_sink = nbf_buffer_active & (is_ctrl_set | is_ctrl_clear | is_ctrl_write | is_burst_packet);
 
   always_comb begin
     state_n = state_r;
     ctrl_n = ctrl_r;
+    burst_addr_n = burst_addr_r;
+    burst_words_n = burst_words_r;
     ctrl_n.rd_error |= (rx_frame_error_i | rx_parity_error_i | rx_overflow_error_i);
 
     // outputs
@@ -231,6 +319,7 @@ module bp_fpga_host_io_in
     // bufer dequeue signals
     io_resp_yumi_li = 1'b0;
     nbf_buffer_yumi_li = '0;
+    burst_buffer_yumi_li = '0;
 
     // form io_cmd from current nbf_buffer output
     io_cmd_data_o = {'0, nbf_buffer_lo.data};
@@ -276,7 +365,7 @@ module bp_fpga_host_io_in
         // requires available credits and that NBF cmd is not fence, finish, or control
         io_cmd_v_o = nbf_buffer_v_lo & ~credits_full_lo
                      & ~is_fence_packet & ~is_finish_packet
-                     & ~is_ctrl_packet;
+                     & ~is_ctrl_packet & ~is_burst_packet;
 
         // Option 2 - send nbf_o back to PC Host
         // send NBF packet to bp_fpga_host_io_out for current NBF command
@@ -288,7 +377,7 @@ module bp_fpga_host_io_in
           nbf_lo.opcode = e_fpga_host_nbf_finish;
         end else if (is_ctrl_read) begin
           nbf_lo.opcode = e_fpga_host_ctrl_read;
-          nbf_lo.data = {'0, ctrl_r};
+          nbf_lo.data = {'0, fpga_host_caps_gp, ctrl_r};
           // clear read and write error bits on read
           ctrl_n.rd_error = 1'b0;
           ctrl_n.wr_error = 1'b0;
@@ -300,6 +389,13 @@ module bp_fpga_host_io_in
         nbf_buffer_yumi_li = (io_cmd_v_o & io_cmd_ready_and_i) | (nbf_v_o & nbf_ready_and_i)
                              | nbf_ctrl_sink;
 
+        // start expanding a burst write into its data words
+        if (nbf_buffer_v_lo & is_burst_packet & (burst_packet_words != '0)) begin
+          burst_addr_n = nbf_buffer_lo.addr;
+          burst_words_n = burst_packet_words;
+          state_n = e_send_burst;
+        end
+
         // process control register writes
         if (nbf_buffer_v_lo) begin
           // set bits specified by one-hot mask from address field
@@ -319,54 +415,71 @@ module bp_fpga_host_io_in
           end
         end
 
-        // Process IO responses
-        if (io_resp_v_lo) begin
-          unique case (io_resp.msg_type.mem)
-            // uc_wr was NBF store to BP - control register determines if response needs to be sent
-            // back to PC Host
-            e_bedrock_mem_uc_wr: begin
-              // write response required
-              if (ctrl_r.wr_resp) begin
-                // can only process if nbf_o not in use
-                if (~nbf_buffer_to_nbf_o) begin
-                  nbf_v_o = 1'b1;
-                  io_resp_yumi_li = nbf_ready_and_i;
-                  unique case (io_resp.size)
-                    e_bedrock_msg_size_4: nbf_lo.opcode = e_fpga_host_nbf_write_4;
-                    e_bedrock_msg_size_8: nbf_lo.opcode = e_fpga_host_nbf_write_8;
-                    default: nbf_lo.opcode = e_fpga_host_nbf_error;
-                  endcase
-                  nbf_lo.addr = io_resp.addr;
-                  nbf_lo.data = '0;
-                end
-              end
-              // no response needs to be sent to PC Host - sink response
-              else begin
-                  io_resp_yumi_li = 1'b1;
-              end
-            end
-            // uc_rd is response from NBF read from BP - send NBF packet
-            // to bp_fpga_host_io_out
-            e_bedrock_mem_uc_rd: begin
-              // can only process if nbf_o not in use
-              if (~nbf_buffer_to_nbf_o) begin
-                nbf_v_o = 1'b1;
-                io_resp_yumi_li = nbf_ready_and_i;
-                unique case (io_resp.size)
-                  e_bedrock_msg_size_4: nbf_lo.opcode = e_fpga_host_nbf_read_4;
-                  e_bedrock_msg_size_8: nbf_lo.opcode = e_fpga_host_nbf_read_8;
-                  default: nbf_lo.opcode = e_fpga_host_nbf_error;
-                endcase
-                nbf_lo.addr = io_resp.addr;
-                nbf_lo.data = io_resp_data[0+:nbf_data_width_p];
-              end
-            end
-            default: begin end
-          endcase // io_resp msg_type
-        end // io_resp_v_lo
       end // e_send_nbf
+      e_send_burst: begin
+        // send one 8-byte write per burst data word
+        io_cmd_v_o = burst_buffer_v_lo & ~credits_full_lo;
+        io_cmd.addr = burst_addr_r;
+        io_cmd.size = e_bedrock_msg_size_8;
+        io_cmd.msg_type.mem = e_bedrock_mem_uc_wr;
+        io_cmd.subop = e_bedrock_store;
+        io_cmd_data_o = burst_buffer_lo;
+
+        burst_buffer_yumi_li = io_cmd_v_o & io_cmd_ready_and_i;
+        if (burst_buffer_yumi_li) begin
+          burst_addr_n = burst_addr_r + paddr_width_p'(8);
+          burst_words_n = burst_words_r - 1'b1;
+          state_n = (burst_words_r == burst_count_width_lp'(1)) ? e_send_nbf : e_send_burst;
+        end
+      end // e_send_burst
       default: begin end
     endcase // state_r
+
+    // Process IO responses, in every state
+    if (io_resp_v_lo) begin
+      unique case (io_resp.msg_type.mem)
+        // uc_wr was NBF store to BP - control register determines if response needs to be sent
+        // back to PC Host
+        e_bedrock_mem_uc_wr: begin
+          // write response required
+          if (ctrl_r.wr_resp) begin
+            // can only process if nbf_o not in use
+            if (~nbf_buffer_to_nbf_o) begin
+              nbf_v_o = 1'b1;
+              io_resp_yumi_li = nbf_ready_and_i;
+              unique case (io_resp.size)
+                e_bedrock_msg_size_4: nbf_lo.opcode = e_fpga_host_nbf_write_4;
+                e_bedrock_msg_size_8: nbf_lo.opcode = e_fpga_host_nbf_write_8;
+                default: nbf_lo.opcode = e_fpga_host_nbf_error;
+              endcase
+              nbf_lo.addr = io_resp.addr;
+              nbf_lo.data = '0;
+            end
+          end
+          // no response needs to be sent to PC Host - sink response
+          else begin
+              io_resp_yumi_li = 1'b1;
+          end
+        end
+        // uc_rd is response from NBF read from BP - send NBF packet
+        // to bp_fpga_host_io_out
+        e_bedrock_mem_uc_rd: begin
+          // can only process if nbf_o not in use
+          if (~nbf_buffer_to_nbf_o) begin
+            nbf_v_o = 1'b1;
+            io_resp_yumi_li = nbf_ready_and_i;
+            unique case (io_resp.size)
+              e_bedrock_msg_size_4: nbf_lo.opcode = e_fpga_host_nbf_read_4;
+              e_bedrock_msg_size_8: nbf_lo.opcode = e_fpga_host_nbf_read_8;
+              default: nbf_lo.opcode = e_fpga_host_nbf_error;
+            endcase
+            nbf_lo.addr = io_resp.addr;
+            nbf_lo.data = io_resp_data[0+:nbf_data_width_p];
+          end
+        end
+        default: begin end
+      endcase // io_resp msg_type
+    end // io_resp_v_lo
   end // always_comb
 
 endmodule